@@ -1,14 +1,11 @@
 from __future__ import annotations
-from PIL import Image
-import numpy as np
-import unicodedata
 
 from typing import Optional, Tuple, List
 from abc import ABC, abstractmethod
 from enum import Enum
-from tqdm import tqdm
 
 from ultlf import UltlfCP
+from measure import LETTER_SPACING, ELLIPSIS, glyph, text_width, fit, wrap
 
 from data import EventLayout, Rectangle, Color, Event
 
@@ -20,15 +17,26 @@ class Canvas(ABC):
     def __call__(self, x: int, y: int) -> Color:
         pass
 
-    def preview(self):
-        img = Image.new("RGB", (CANVAS_WIDTH, CANVAS_HEIGHT))
-        for i in tqdm(range(CANVAS_HEIGHT * CANVAS_WIDTH), unit="px", unit_scale=True):
-            y = i // CANVAS_WIDTH
-            x = i % CANVAS_WIDTH
+    def preview(self, width: int = CANVAS_WIDTH, height: int = CANVAS_HEIGHT):
+        from PIL import Image
+        from tqdm import tqdm
+
+        img = Image.new("RGB", (width, height))
+        for i in tqdm(range(height * width), unit="px", unit_scale=True):
+            y = i // width
+            x = i % width
             img.putpixel((x, y), self(x, y).rgb())
 
         img.show()
 
+    # palette indices of every pixel in rect, row by row
+    def rasterize(self, rect: Rectangle) -> bytes:
+        return bytes(
+            self(x, y).to_screen_color_idx()
+            for y in range(rect.y0, rect.y1)
+            for x in range(rect.x0, rect.x1)
+        )
+
 class Background(Canvas):
     def __init__(self, color: Color):
         self.color = color
@@ -107,23 +115,6 @@ class DitheredRectangle(Canvas):
 
         return inside()
 
-LETTER_SPACING = 1
-
-# gives a list of indices where it's "okay" to put a line break in text
-def text_breakpoint_indices(text: str) -> List[int]:
-    indices = []
-    for ch_idx, (ch, next) in enumerate(zip(text[:-1], text[1:])):
-        i = ch_idx+1
-        ch_cat = unicodedata.category(ch)
-        next_cat = unicodedata.category(next)
-
-        # stupid stupid stupid
-        if ch_cat[0] != next_cat[0]:
-            indices.append(i)
-
-    indices.reverse()
-    return indices
-
 class Text(Canvas):
     def __init__(
         self,
@@ -137,8 +128,8 @@ class Text(Canvas):
         align_right: bool = False,
     ):
         self.inner = inner
-        self.chars: List[UltlfCP] = [UltlfCP.from_ch(ch) for ch in text]
-        self.total_width = sum(ch.width for ch in self.chars) + LETTER_SPACING * (len(self.chars) - 1)
+        self.chars: List[UltlfCP] = [glyph(ch) for ch in text]
+        self.total_width = text_width(text)
         self.text = text
 
         self.color = color
@@ -151,35 +142,17 @@ class Text(Canvas):
     # tries to cut at a word boundary
     # if ellipsis is set, we add '...' if the text is broken
     def fit_width(self, width: int, ellipsis: bool) -> Optional[str]:
-        width //= self.scale
-
-        prefix_widths = [] # index i is total width of self.chars[:i+1]
-        at = -LETTER_SPACING
-        for ch in self.chars:
-            at += ch.width + LETTER_SPACING
-            prefix_widths.append(at)
-
-        if prefix_widths[-1] < width:
-            # don't need to cut anything
+        cut = fit(self.text, width, scale=self.scale, ellipsis=ellipsis)
+        if cut is None:
             return None
 
-        ellipsis_width = 0
-        if ellipsis:
-            period = UltlfCP.from_ch('.')
-            ellipsis_width = (period.width + LETTER_SPACING) * 3
-
-        for i in text_breakpoint_indices(self.text):
-            if prefix_widths[i-1] + ellipsis_width < width:
-                # we can fit up to and including index i
-                self.chars = self.chars[:i]
-                remaining = self.text[i:]
-                if ellipsis:
-                    for i in range(3):
-                        self.chars.append(UltlfCP.from_ch('.'))
-                self.total_width = sum(ch.width for ch in self.chars) + LETTER_SPACING * (len(self.chars) - 1)
-                return remaining
-        self.chars = []
-        return self.text
+        remaining = self.text[cut:]
+        shown = self.text[:cut]
+        if ellipsis and cut > 0:
+            shown += ELLIPSIS
+        self.chars = [glyph(ch) for ch in shown]
+        self.total_width = text_width(shown)
+        return remaining
 
     def __call__(self, x, y):
         xr = (x - self.x0) // self.scale
@@ -263,34 +236,21 @@ class CalendarEvent(Canvas):
         self.inner_rect = rect.shrink(3) # at least Nx27
 
         if time_start is not None:
-            # add title
-            title_canvas = Text(
-                self.canvas,
-                text=title,
-                scale=2,
-                x0=self.inner_rect.x0,
-                y0=self.inner_rect.y0,
-                color=Color.BLACK,
-            )
-
             time_width_px = 24 if self.time_start is not None or self.time_end is not None else 0
-
             remaining_width = self.inner_rect.width - time_width_px
+
+            # title, and whatever doesn't fit in it in smaller text below
             # TODO: This should maybe try only to break between words
-            remaining_text = title_canvas.fit_width(remaining_width, ellipsis=False)
-            if remaining_text is None:
-                self.canvas = title_canvas
-            else:
-                subtitle = Text(
-                    title_canvas,
-                    text=remaining_text,
-                    scale=1,
+            lines = wrap(title, remaining_width, scales=(2, 1), ellipsis=True)
+            for line, scale, dy in zip(lines, (2, 1), (0, 18)): # scale*2 gives 18 pixel of title
+                self.canvas = Text(
+                    self.canvas,
+                    text=line,
+                    scale=scale,
                     x0=self.inner_rect.x0,
-                    y0=self.inner_rect.y0 + 18, # scale*2 gives 18 pixel of title
+                    y0=self.inner_rect.y0 + dy,
                     color=Color.BLACK,
                 )
-                subtitle.fit_width(remaining_width, ellipsis=True)
-                self.canvas = subtitle
 
         # draw times
         if self.time_start is not None:
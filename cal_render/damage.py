@@ -0,0 +1,138 @@
+from __future__ import annotations
+from typing import Any, List, Optional, Tuple
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import numpy as np
+
+from data import Rectangle
+from display import Display
+from layout import CalendarCanvas, Placement
+
+# re-rendering only the rows of a frame that changed since the last one. a CalendarCanvas is its
+# time axis (ticks and breaks) with event tiles drawn on top in order, each tile only covering its
+# rectangle. when the time axis is the same as last time, a row can only have changed if the tiles
+# covering it did, so only those rows are rasterized again and the rest are kept
+
+# what the previous frame of a display was made from, and its pixels
+@dataclass
+class FrameState:
+    display: Display
+    params: Any # everything else the canvas depends on, like dark mode and pixels per hour
+    axis: List[Tuple[datetime, datetime]]
+    placements: List[Placement]
+    raster: np.ndarray # screen color indices, rows of columns
+
+    @staticmethod
+    def from_frame(frame: bytes, canvas: CalendarCanvas, display: Display, params: Any) -> FrameState:
+        return FrameState(
+            display=display,
+            params=params,
+            axis=axis_of(canvas),
+            placements=list(canvas.placements),
+            raster=display.decode(frame),
+        )
+
+def axis_of(canvas: CalendarCanvas) -> List[Tuple[datetime, datetime]]:
+    return [(r.start, r.end) for r in canvas.time_ranges]
+
+# rows [y0, y1) where the tiles drawn differ, or are drawn in a different order
+def damaged_bands(old: List[Placement], new: List[Placement], height: int) -> List[Tuple[int, int]]:
+    # between two edges, every tile covers either all rows or none
+    edges = sorted({0, height} | {min(max(p[i], 0), height) for p in old + new for i in (1, 3)})
+
+    bands: List[Tuple[int, int]] = []
+    for y0, y1 in zip(edges, edges[1:]):
+        covering_old = [p for p in old if p[1] < y1 and p[3] > y0]
+        covering_new = [p for p in new if p[1] < y1 and p[3] > y0]
+        if covering_old == covering_new:
+            continue
+        if len(bands) > 0 and bands[-1][1] == y0:
+            bands[-1] = (bands[-1][0], y1)
+        else:
+            bands.append((y0, y1))
+    return bands
+
+# the encoded frame of canvas and its state, made from the previous state. None if the time axis,
+# display or params changed, and everything has to be rasterized
+def rerender(previous: Optional[FrameState], canvas: CalendarCanvas, display: Display, params: Any) -> Optional[Tuple[bytes, FrameState]]:
+    if previous is None:
+        return None
+    axis = axis_of(canvas)
+    if previous.display.key() != display.key() or previous.params != params or previous.axis != axis:
+        return None
+
+    bands = damaged_bands(previous.placements, canvas.placements, display.height)
+    raster = previous.raster.copy()
+    for y0, y1 in bands:
+        rows = canvas.rasterize(Rectangle(x0=0, y0=y0, x1=display.width, y1=y1))
+        raster[y0:y1] = np.frombuffer(rows, dtype=np.uint8).reshape(y1 - y0, display.width)
+    print(f"Rasterized {sum(y1 - y0 for y0, y1 in bands)} of {display.height} rows")
+
+    state = FrameState(display=display, params=params, axis=axis, placements=list(canvas.placements), raster=raster)
+    return display.encode(raster), state
+
+def test_damaged_bands():
+    from data import Color
+
+    a = (0, 10, 50, 40, "a", Color.RED, Color.RED, "10:00", "11:00")
+    b = (0, 30, 50, 60, "b", Color.RED, Color.RED, "10:30", "11:30")
+    b_moved = (0, 35, 50, 60, "b", Color.RED, Color.RED, "10:30", "11:30")
+    c = (0, 90, 50, 130, "c", Color.RED, Color.RED, "12:00", "13:00")
+
+    assert damaged_bands([a, b, c], [a, b, c], 100) == []
+    assert damaged_bands([a, b], [a, b_moved], 100) == [(30, 60)]
+    assert damaged_bands([a, b], [b, a], 100) == [(30, 40)] # only where they overlap
+    assert damaged_bands([a], [a, c], 100) == [(90, 100)] # cut at the bottom
+
+def test_rerender():
+    import random
+    from data import Event, Color
+    from layout import Schedule
+    from tiles import TileCache
+
+    display = Display(width=160, height=240, rotation=90, encoding="p4")
+    params = (False, 20, 10)
+    titles = ["Möte", "Lunch", "Fika med alla", "Yoga"]
+    day = datetime(2025, 1, 20, 8)
+    hour, minute = timedelta(hours=1), timedelta(minutes=1)
+
+    def canvas(events: List[Event]) -> CalendarCanvas:
+        return CalendarCanvas(
+            bounding_rect=Rectangle(x0=0, y0=0, x1=display.width, y1=display.height),
+            schedule=Schedule.from_events(events),
+            pixels_per_hour=params[1],
+            pixels_per_break=params[2],
+            tile_cache=TileCache(),
+        )
+
+    def full(c: CalendarCanvas) -> bytes:
+        return display.encode(np.frombuffer(c.rasterize(Rectangle(x0=0, y0=0, x1=display.width, y1=display.height)), dtype=np.uint8).reshape(display.height, display.width))
+
+    random.seed(3)
+    # events on the hour, so moving one within its hour keeps the time axis
+    events = [
+        Event(title=titles[i % 4], start=day + i * 3 * hour + 15 * minute, end=day + i * 3 * hour + 45 * minute, color1=Color.BLUE, color2=Color.RED)
+        for i in range(3)
+    ]
+    first = canvas(events)
+    state = FrameState.from_frame(full(first), first, display, params)
+
+    for _ in range(3):
+        i = random.randrange(len(events))
+        shift = random.choice([-10, 5, 10]) * minute
+        e = events[i]
+        events[i] = Event(title=e.title + "!", start=e.start + shift, end=e.end + shift, color1=Color.GREEN, color2=e.color2)
+        c = canvas(events)
+        rerendered = rerender(state, c, display, params)
+        assert rerendered is not None
+        frame, state = rerendered
+        assert frame == full(c)
+
+    # a new time range moves everything
+    events.append(Event(title="Sent", start=day + 12 * hour, end=day + 13 * hour, color1=Color.BLUE, color2=Color.RED))
+    assert rerender(state, canvas(events), display, params) is None
+    assert rerender(state, c, display, (True, 20, 10)) is None
+
+if __name__ == "__main__":
+    test_damaged_bands()
+    test_rerender()
@@ -35,6 +35,10 @@ class Color(Enum):
             return 6
         return 7 # should be unreachable
 
+    @staticmethod
+    def from_screen_color_idx(idx: int) -> Color:
+        return SCREEN_COLORS[idx]
+
     @staticmethod
     def from_str(name: str) -> Color:
         name = name.upper()
@@ -54,6 +58,18 @@ class Color(Enum):
             return Color.ORANGE
         raise ValueError(f"No such color: {name}")
 
+# indexed by Color.to_screen_color_idx
+SCREEN_COLORS = [
+    Color.BLACK,
+    Color.WHITE,
+    Color.GREEN,
+    Color.BLUE,
+    Color.RED,
+    Color.YELLOW,
+    Color.ORANGE,
+    Color.INVALID,
+]
+
 class Rectangle:
     # contains x0, y0, does not contain x1, y1
     def __init__(
@@ -70,8 +86,8 @@ class Rectangle:
         assert(y1 is not None or height is not None)
         self.x0 = x0
         self.y0 = y0
-        self.x1 = x1 or x0 + width # type: ignore
-        self.y1 = y1 or y0 + height # type: ignore
+        self.x1 = x1 if x1 is not None else x0 + width # type: ignore
+        self.y1 = y1 if y1 is not None else y0 + height # type: ignore
 
     def __repr__(self):
         return f"Rectangle(xy0=({self.x0}, {self.y0}), xy1=({self.x1}, {self.y1}))"
@@ -108,6 +124,9 @@ class Event:
     color1: Color
     color2: Color
 
+    uid: Optional[str] = None
+    recurrence_id: Optional[datetime] = None
+
     def duration(self) -> timedelta:
         return self.end - self.start
 
@@ -0,0 +1,214 @@
+from __future__ import annotations
+from typing import List, Tuple
+from datetime import datetime, timedelta, date, time
+
+from data import Rectangle, EventLayout, Event, Color
+
+# a single day, midnight to midnight from top to bottom, with events where they are in the day instead of on
+# a time axis of only the busy hours like layout.CalendarCanvas. events are placed longest first,
+# each as wide as it can be while leaving room for the events after it that overlap it, to the right
+# of the events before it that it overlaps
+#
+# which events overlap is kept over the distinct pixel rows events start or end at, in two segment
+# trees, so laying out n events is O(n log n). days are as long as they are in local time, 23 or 25
+# hours when daylight saving time starts or ends
+
+MIN_HEIGHT = 33 # CalendarEvent needs that much
+
+# max over ranges of slots, with a value added to ranges
+class RangeAdd:
+    def __init__(self, n: int):
+        self.n = n
+        self.best = [0] * (4 * n) # highest in the subtree, with what's been added to the node
+        self.added = [0] * (4 * n) # added to every slot under the node
+
+    def add(self, l: int, r: int, v: int, node: int = 1, lo: int = 0, hi: int = -1):
+        hi = self.n if hi < 0 else hi
+        if r <= lo or hi <= l:
+            return
+        if l <= lo and hi <= r:
+            self.best[node] += v
+            self.added[node] += v
+            return
+        mid = (lo + hi) // 2
+        self.add(l, r, v, 2 * node, lo, mid)
+        self.add(l, r, v, 2 * node + 1, mid, hi)
+        self.best[node] = max(self.best[2 * node], self.best[2 * node + 1]) + self.added[node]
+
+    def max(self, l: int, r: int, node: int = 1, lo: int = 0, hi: int = -1) -> float:
+        hi = self.n if hi < 0 else hi
+        if r <= lo or hi <= l:
+            return float("-inf")
+        if l <= lo and hi <= r:
+            return self.best[node]
+        mid = (lo + hi) // 2
+        return max(self.max(l, r, 2 * node, lo, mid), self.max(l, r, 2 * node + 1, mid, hi)) + self.added[node]
+
+# rows [y0, y1) of an event, at least MIN_HEIGHT and within the day
+def rows(event: Event, day: date, height: int) -> Tuple[int, int]:
+    day_start = datetime.combine(day, time.min)
+    day_end = datetime.combine(day + timedelta(days=1), time.min)
+    # naive times are local, astimezone gives them their UTC offset so differences are real time
+    length = day_end.astimezone() - day_start.astimezone()
+
+    def date_to_pixel(t: datetime) -> int:
+        return int((t.astimezone() - day_start.astimezone()) / length * height)
+
+    y0 = date_to_pixel(event.start) if event.start > day_start else 0
+    y1 = date_to_pixel(event.end) if event.end < day_end else height
+    y1 = max(y1, y0 + MIN_HEIGHT)
+    if y1 > height: # late events are moved up, to fit
+        y0, y1 = max(height - MIN_HEIGHT, 0), height
+    return y0, y1
+
+# a rectangle for each event, in the same order. all events must be at least partly in the day
+def layout(
+    events: List[Event],
+    day: date,
+    width: int,
+    height: int,
+) -> List[EventLayout]:
+    from intervals import MaxTree
+
+    day_start = datetime.combine(day, time.min)
+    day_end = datetime.combine(day + timedelta(days=1), time.min)
+
+    spans = [rows(e, day, height) for e in events]
+    ys = sorted({y for span in spans for y in span})
+    slot = {y: i for i, y in enumerate(ys)}
+    n_slots = max(len(ys) - 1, 1)
+
+    # number of events not yet placed covering each slot, and how far right the ones placed reach
+    unplaced = RangeAdd(n_slots)
+    placed_right = MaxTree(n_slots)
+    for y0, y1 in spans:
+        unplaced.add(slot[y0], slot[y1], 1)
+
+    xs = [(0, 0)] * len(events)
+    for i in sorted(range(len(events)), key=lambda i: -events[i].duration()):
+        l, r = slot[spans[i][0]], slot[spans[i][1]]
+        unplaced.add(l, r, -1)
+        x0 = placed_right.max(l, r)
+        max_overlap = int(unplaced.max(l, r)) + 1 # + 1 to include this event
+        x1 = x0 + (width - x0) // max_overlap
+        placed_right.raise_to(l, r, x1)
+        xs[i] = (x0, x1)
+
+    return [
+        EventLayout(
+            rect=Rectangle(x0=x0, y0=y0, x1=x1, y1=y1),
+            start_time=event.start.strftime("%H:%M") if event.start > day_start else None,
+            end_time=event.end.strftime("%H:%M") if event.end < day_end else None,
+        )
+        for event, (y0, y1), (x0, x1) in zip(events, spans, xs)
+    ]
+
+# the events of day, drawn over the whole width and height
+def day_canvas(events: List[Event], day: date, width: int, height: int, dark_mode: bool = False):
+    from canvas import Canvas, Background, CalendarEvent
+
+    day_start = datetime.combine(day, time.min)
+    day_end = datetime.combine(day + timedelta(days=1), time.min)
+    events = [e for e in events if e.start < day_end and (e.end > day_start or e.start >= day_start)]
+
+    canvas: Canvas = Background(Color.BLACK if dark_mode else Color.WHITE)
+    for event, event_layout in zip(events, layout(events, day, width, height)):
+        canvas = CalendarEvent.from_event(canvas, event, event_layout)
+    return canvas
+
+def test_layout():
+    import random
+    from fetch_calendar import local_timezone
+
+    # the old way, counting later events over every pixel
+    def layout_per_pixel(events: List[Event], day: date, width: int, height: int) -> List[Tuple[int, int]]:
+        spans = [rows(e, day, height) for e in events]
+        xs = [[0, 0] for _ in events]
+        order = sorted(range(len(events)), key=lambda i: -events[i].duration())
+        for n, i in enumerate(order):
+            overlap = [0] * height
+            for j in order[n + 1:]:
+                for px in range(*spans[j]):
+                    overlap[px] += 1
+            max_overlap = max(overlap[spans[i][0]:spans[i][1]]) + 1
+            xs[i][1] = xs[i][0] + (width - xs[i][0]) // max_overlap
+            for j in order[n + 1:]:
+                if spans[j][0] < spans[i][1] and spans[j][1] > spans[i][0]:
+                    xs[j][0] = max(xs[j][0], xs[i][1])
+        return [(x0, x1) for x0, x1 in xs]
+
+    random.seed(5)
+    day = date(2025, 1, 20)
+    start_of_day = datetime.combine(day, time.min)
+
+    def random_events(n: int) -> List[Event]:
+        events = []
+        for i in range(n):
+            start = start_of_day + timedelta(minutes=random.randrange(-60, 24 * 60))
+            end = max(start, start_of_day) + timedelta(minutes=random.choice([0, 15, 30, 60, 90, 240, 24 * 60]))
+            events.append(Event(title=f"event {i}", start=start, end=end, color1=Color.BLUE, color2=Color.RED))
+        return events
+
+    for n in (0, 1, 5, 30, 80):
+        events = random_events(n)
+        layouts = layout(events, day, 480, 800)
+        assert [(l.rect.x0, l.rect.x1) for l in layouts] == layout_per_pixel(events, day, 480, 800)
+        for e, l in zip(events, layouts):
+            assert 0 <= l.rect.y0 and l.rect.y1 <= 800 and l.rect.height >= MIN_HEIGHT
+            assert (l.start_time is None) == (e.start <= start_of_day)
+            assert (l.end_time is None) == (e.end >= start_of_day + timedelta(days=1))
+
+    # two events side by side, then one below them the whole width
+    nine = start_of_day + timedelta(hours=9)
+    hour = timedelta(hours=1)
+    events = [
+        Event(title="a", start=nine, end=nine + 2 * hour, color1=Color.BLUE, color2=Color.RED),
+        Event(title="b", start=nine + hour, end=nine + 2 * hour, color1=Color.BLUE, color2=Color.RED),
+        Event(title="c", start=nine + 3 * hour, end=nine + 4 * hour, color1=Color.BLUE, color2=Color.RED),
+    ]
+    assert [(l.rect.x0, l.rect.x1) for l in layout(events, day, 480, 800)] == [(0, 240), (240, 480), (0, 480)]
+
+    # the day daylight saving time starts is 23 hours long, and 02:00-03:00 is skipped
+    with local_timezone("Europe/Stockholm"):
+        spring = datetime(2025, 3, 30)
+        events = [
+            Event(title="a", start=spring + timedelta(hours=1), end=spring + timedelta(hours=3), color1=Color.BLUE, color2=Color.RED),
+            Event(title="b", start=spring + timedelta(hours=12), end=spring + timedelta(hours=14), color1=Color.BLUE, color2=Color.RED),
+        ]
+        assert [(l.rect.y0, l.rect.y1) for l in layout(events, spring.date(), 480, 23 * 40)] == [(40, 80), (11 * 40, 13 * 40)]
+
+    # dense days take O(log n) visits to tree nodes per event, not O(n)
+    global RangeAdd
+    class CountingRangeAdd(RangeAdd):
+        visits = 0
+
+        def add(self, *args):
+            CountingRangeAdd.visits += 1
+            super().add(*args)
+
+    events = random_events(5000)
+    original, RangeAdd = RangeAdd, CountingRangeAdd
+    try:
+        layout(events, day, 480, 800)
+    finally:
+        RangeAdd = original
+    assert len(events) < CountingRangeAdd.visits < 2 * 4 * 11 * len(events) # two adds per event, a few nodes per level of at most 801 slots
+
+if __name__ == "__main__":
+    import random
+
+    day = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def random_dates() -> Tuple[datetime, datetime]:
+        duration_s = abs(random.gauss(0, 3600 * 2))
+        start_s = random.random() * 86400
+        start = day + timedelta(seconds=start_s - duration_s/2)
+        end = start + timedelta(seconds=duration_s)
+        return max(start, day), min(end, day + timedelta(days=1))
+
+    events = []
+    for i in range(30):
+        start, end = random_dates()
+        events.append(Event(f"event #{i}", start=start, end=end, color1=Color.BLUE, color2=Color.BLUE))
+
+    day_canvas(events, day.date(), 480, 800).preview()
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from typing import Dict, List, Tuple
+import numpy as np
+
+from event_table import EventTable
+
+# the same event showing up more than once, typically a shared meeting in more than one calendar.
+# copies are found by UID and RECURRENCE-ID (or start, for recurring events expanded without one).
+# events without a UID, from feeds that leave them out, are found by title, start and end instead.
+# events with different UIDs are never merged, even with the same content. the first copy is kept,
+# taking the color of the second copy with a different color as its secondary color
+
+def normalize_title(title: str) -> str:
+    return " ".join(str(title).casefold().split())
+
+def dedup(table: EventTable) -> EventTable:
+    if len(table) == 0:
+        return table
+
+    # normalize each distinct title once
+    normalized: Dict[str, int] = {}
+    norm_of_title = np.array([normalized.setdefault(normalize_title(t), len(normalized)) for t in table.titles], dtype=np.int32)
+    norm_ids = norm_of_title[table.title_id].tolist()
+
+    starts = table.start.astype(np.int64).tolist()
+    ends = table.end.astype(np.int64).tolist()
+    uid_ids = table.uid_id.tolist()
+    # for expanded recurrences without a RECURRENCE-ID, the start tells instances apart
+    instances = np.where(np.isnat(table.recurrence_id), table.start, table.recurrence_id).astype(np.int64).tolist()
+    color1 = table.color1.tolist()
+    color2 = table.color2.copy()
+
+    by_uid: Dict[Tuple[int, int], int] = {}
+    by_content: Dict[Tuple[int, int, int], int] = {}
+    combined = set() # events that already got a color from a copy
+    keep: List[int] = []
+
+    for i in range(len(table)):
+        uid_key = (uid_ids[i], instances[i]) if uid_ids[i] >= 0 else None
+        content_key = (norm_ids[i], starts[i], ends[i])
+
+        if uid_key is not None:
+            first = by_uid.get(uid_key)
+        else:
+            first = by_content.get(content_key)
+
+        if first is None:
+            keep.append(i)
+            first = i
+        elif color1[i] != color1[first] and first not in combined:
+            color2[first] = color1[i]
+            combined.add(first)
+
+        if uid_key is not None:
+            by_uid.setdefault(uid_key, first)
+        by_content.setdefault(content_key, first)
+
+    deduped = EventTable(
+        start=table.start,
+        end=table.end,
+        title_id=table.title_id,
+        titles=table.titles,
+        color1=table.color1,
+        color2=color2,
+        uid_id=table.uid_id,
+        uids=table.uids,
+        recurrence_id=table.recurrence_id,
+    )
+    return deduped.take(np.array(keep, dtype=np.int64))
+
+def test_dedup():
+    from datetime import datetime, timedelta
+    from data import Event, Color
+
+    t = datetime(2025, 1, 20, 10)
+    h = timedelta(hours=1)
+    def e(title, start, color, uid=None, recurrence_id=None):
+        return Event(title=title, start=start, end=start + h, color1=color, color2=Color.WHITE, uid=uid, recurrence_id=recurrence_id)
+
+    events = [
+        e("Möte", t, Color.BLUE, uid="m"),
+        e("Lunch", t + 2 * h, Color.BLUE),
+        e("Möte (kopia)", t, Color.RED, uid="m"), # same uid, different title
+        e("  lunch ", t + 2 * h, Color.GREEN), # same title, normalized
+        e("Lunch", t + 2 * h, Color.RED), # colors are only combined once
+        e("Stand-up", t + 4 * h, Color.BLUE, uid="s", recurrence_id=t + 4 * h),
+        e("Stand-up", t + 28 * h, Color.BLUE, uid="s", recurrence_id=t + 28 * h), # another instance
+        e("Stand-up", t + 28 * h, Color.RED, uid="s", recurrence_id=t + 28 * h),
+        e("Fika", t + 6 * h, Color.BLUE, uid="f1"),
+        e("Fika", t + 6 * h, Color.GREEN, uid="f2"), # different uids, so not a copy even with the same content
+        e("fika", t + 6 * h, Color.RED), # no uid, a copy of the first with the same content
+    ]
+    deduped = dedup(EventTable.from_events(events)).to_events()
+    assert [(d.title, d.start, d.color1, d.color2) for d in deduped] == [
+        ("Möte", t, Color.BLUE, Color.RED),
+        ("Lunch", t + 2 * h, Color.BLUE, Color.GREEN),
+        ("Stand-up", t + 4 * h, Color.BLUE, Color.WHITE),
+        ("Stand-up", t + 28 * h, Color.BLUE, Color.RED),
+        ("Fika", t + 6 * h, Color.BLUE, Color.RED),
+        ("Fika", t + 6 * h, Color.GREEN, Color.WHITE),
+    ]
+
+    # expanded recurrences without RECURRENCE-ID are told apart by their start
+    series = [e("Yoga", t + i * 24 * h, Color.GREEN, uid="y") for i in range(3)]
+    assert len(dedup(EventTable.from_events(series))) == 3
+
+if __name__ == "__main__":
+    test_dedup()
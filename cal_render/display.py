@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from itertools import repeat
+
+from canvas import CANVAS_WIDTH, CANVAS_HEIGHT
+from data import Color, SCREEN_COLORS
+
+# the size of a display and how it wants its pixels. configured in secrets.toml, the default is
+# the 7.3 inch panel of eink_bridge:
+#
+# [[display]]
+# name = "hall"
+# width = 480
+# height = 800
+# rotation = 90 # see Display.lines
+# encoding = "p8" # one pixel per byte, or "p4" for two pixels per byte, first one in the high bits
+# palette = { ORANGE = 4 } # the value sent for each color, if it's not the screen color index
+# devices = ["192.168.1.20"] # addresses of devices with this display
+
+ENCODINGS = ["p8", "p4"]
+
+@dataclass(frozen=True)
+class Display:
+    name: str = "default"
+    width: int = CANVAS_WIDTH
+    height: int = CANVAS_HEIGHT
+    rotation: int = 90
+    encoding: str = "p8"
+    palette: Tuple[int, ...] = tuple(range(len(SCREEN_COLORS))) # by screen color index
+    devices: Tuple[str, ...] = field(default=(), compare=False)
+
+    def __post_init__(self):
+        if self.rotation not in (0, 90, 180, 270):
+            raise ValueError(f"display {self.name}: rotation must be 0, 90, 180 or 270, not {self.rotation}")
+        if self.encoding not in ENCODINGS:
+            raise ValueError(f"display {self.name}: encoding must be one of {ENCODINGS}, not {self.encoding!r}")
+        if self.encoding == "p4" and (self.line_length() % 2 != 0 or max(self.palette) > 15):
+            raise ValueError(f"display {self.name}: p4 needs an even line length and colors below 16")
+
+    @staticmethod
+    def from_obj(data: Any) -> Display:
+        palette = list(range(len(SCREEN_COLORS)))
+        for name, value in data.get("palette", {}).items():
+            palette[Color.from_str(name).to_screen_color_idx()] = value
+
+        return Display(
+            name=data["name"],
+            width=data.get("width", CANVAS_WIDTH),
+            height=data.get("height", CANVAS_HEIGHT),
+            rotation=data.get("rotation", 90),
+            encoding=data.get("encoding", "p8"),
+            palette=tuple(palette),
+            devices=tuple(data.get("devices", [])),
+        )
+
+    # everything a frame for this display depends on, for frame_cache.frame_key
+    def key(self) -> List[Any]:
+        return [self.width, self.height, self.rotation, self.encoding, list(self.palette)]
+
+    def n_lines(self) -> int:
+        return self.height if self.rotation in (0, 180) else self.width
+
+    def line_length(self) -> int:
+        return self.width if self.rotation in (0, 180) else self.height
+
+    def frame_size(self) -> int:
+        n_pixels = self.width * self.height
+        return n_pixels if self.encoding == "p8" else n_pixels // 2
+
+    # the order pixels are sent in, as x and y coordinates of each line
+    #   0: rows from top to bottom, each left to right
+    #   90: columns from right to left, each top to bottom
+    #   180: rows from bottom to top, each right to left
+    #   270: columns from left to right, each bottom to top
+    def lines(self) -> Iterator[Tuple[Sequence[int], Sequence[int]]]:
+        w, h = self.width, self.height
+        if self.rotation == 0:
+            for y in range(h):
+                yield range(w), repeat(y, w) # type: ignore
+        elif self.rotation == 90:
+            for x in range(w - 1, -1, -1):
+                yield repeat(x, h), range(h) # type: ignore
+        elif self.rotation == 180:
+            for y in range(h - 1, -1, -1):
+                yield range(w - 1, -1, -1), repeat(y, w) # type: ignore
+        else:
+            for x in range(w):
+                yield repeat(x, h), range(h - 1, -1, -1) # type: ignore
+
+    # screen color indices to what's sent
+    def encode_line(self, line: bytes) -> bytes:
+        line = line.translate(self._palette_table())
+        if self.encoding == "p4":
+            return bytes((line[i] << 4) | line[i + 1] for i in range(0, len(line), 2))
+        return line
+
+    def _palette_table(self) -> bytes:
+        return bytes(self.palette[i] if i < len(self.palette) else i for i in range(256))
+
+    # the whole frame from rows of screen color indices, same as encoding every line
+    def encode(self, rows) -> bytes:
+        import numpy as np
+
+        lines = np.rot90(np.asarray(rows, dtype=np.uint8), k=self.rotation // 90)
+        wire = np.frombuffer(self._palette_table(), dtype=np.uint8)[lines].reshape(-1)
+        if self.encoding == "p4":
+            wire = (wire[0::2] << 4) | wire[1::2]
+        return wire.tobytes()
+
+    # inverse of encoding every line, as rows of screen color indices. for previews and tests
+    def decode(self, frame: bytes):
+        import numpy as np
+
+        wire = np.frombuffer(frame, dtype=np.uint8)
+        if self.encoding == "p4":
+            wire = np.stack([wire >> 4, wire & 0xf], axis=1).reshape(-1)
+        inverse = np.arange(256, dtype=np.uint8)
+        for idx, value in reversed(list(enumerate(self.palette))):
+            inverse[value] = idx
+        lines = inverse[wire].reshape(self.n_lines(), self.line_length())
+        # lines() is the raster rotated counter-clockwise by rotation
+        return np.rot90(lines, k=-self.rotation // 90)
+
+DEFAULT_DISPLAY = Display()
+
+def displays_from_obj(data: Any) -> List[Display]:
+    displays = [Display.from_obj(x) for x in data.get("display", [])]
+    names = [d.name for d in displays]
+    if len(set(names)) != len(names):
+        raise ValueError(f"display names must be unique, got {names}")
+    return displays if len(displays) > 0 else [DEFAULT_DISPLAY]
+
+def load_displays(path: str) -> List[Display]:
+    import toml
+
+    return displays_from_obj(toml.load(open(path, "r")))
+
+# the first display listing the device, otherwise the first one
+def display_for(displays: List[Display], device: Optional[str]) -> Display:
+    for d in displays:
+        if device in d.devices:
+            return d
+    return displays[0]
+
+def test_display():
+    import numpy as np
+    from canvas import Canvas
+
+    class Gradient(Canvas):
+        def __call__(self, x: int, y: int) -> Color:
+            return SCREEN_COLORS[(x + 3 * y) % 7]
+
+    for rotation in (0, 90, 180, 270):
+        for encoding in ENCODINGS:
+            d = Display(width=6, height=4, rotation=rotation, encoding=encoding, palette=(1, 0, 2, 3, 4, 5, 6, 7))
+            frame = b"".join(d.encode_line(bytes(Gradient()(x, y).to_screen_color_idx() for x, y in zip(xs, ys))) for xs, ys in d.lines())
+            assert len(frame) == d.frame_size()
+            expected = np.array([[(x + 3 * y) % 7 for x in range(6)] for y in range(4)])
+            assert (d.decode(frame) == expected).all(), (rotation, encoding)
+            assert d.encode(expected) == frame, (rotation, encoding)
+
+    # the device order of eink_bridge
+    d = DEFAULT_DISPLAY
+    first_xs, first_ys = next(iter(d.lines()))
+    assert list(zip(first_xs, first_ys))[:2] == [(CANVAS_WIDTH - 1, 0), (CANVAS_WIDTH - 1, 1)]
+
+    displays = displays_from_obj({"display": [
+        {"name": "a", "width": 800, "height": 480, "rotation": 0},
+        {"name": "b", "encoding": "p4", "palette": {"ORANGE": 5}, "devices": ["10.0.0.2"]},
+    ]})
+    assert display_for(displays, "10.0.0.2").name == "b"
+    assert display_for(displays, "10.0.0.3").name == "a"
+    assert displays[1].palette[Color.ORANGE.to_screen_color_idx()] == 5
+    assert displays[1].frame_size() == CANVAS_WIDTH * CANVAS_HEIGHT // 2
+    assert displays_from_obj({}) == [DEFAULT_DISPLAY]
+
+    try:
+        Display(rotation=45)
+        assert False
+    except ValueError:
+        pass
+
+if __name__ == "__main__":
+    test_display()
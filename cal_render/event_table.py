@@ -0,0 +1,254 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence
+from datetime import datetime, timedelta
+import numpy as np
+
+from data import Event, Color, SCREEN_COLORS
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_datetime(t: np.datetime64) -> datetime:
+    return EPOCH + timedelta(microseconds=int(t.astype("datetime64[us]").astype(np.int64)))
+
+# ids into a list of the distinct values, -1 for None
+def intern_optional(values: Sequence[Optional[str]]):
+    interned: Dict[str, int] = {}
+    ids = np.array([-1 if v is None else interned.setdefault(v, len(interned)) for v in values], dtype=np.int32)
+    return ids, list(interned)
+
+def optional_datetimes(values: Sequence[Optional[datetime]]) -> np.ndarray:
+    return np.array([np.datetime64("NaT") if v is None else v for v in values], dtype="datetime64[us]").reshape(-1)
+
+# events as columns instead of one Event per event. titles are interned, colors are stored as
+# screen color indices. filtering, sorting and overlap checks are done on whole columns at a time
+class EventTable:
+    def __init__(
+        self,
+        *,
+        start: np.ndarray, # datetime64[us]
+        end: np.ndarray, # datetime64[us]
+        title_id: np.ndarray, # index into titles
+        titles: List[str],
+        color1: np.ndarray, # Color.to_screen_color_idx
+        color2: np.ndarray,
+        uid_id: Optional[np.ndarray] = None, # index into uids, -1 if the event has no UID
+        uids: Optional[List[str]] = None,
+        recurrence_id: Optional[np.ndarray] = None, # datetime64[us], NaT if not a recurrence
+    ):
+        assert(len(start) == len(end) == len(title_id) == len(color1) == len(color2))
+        self.start = start
+        self.end = end
+        self.title_id = title_id
+        self.titles = titles
+        self.color1 = color1
+        self.color2 = color2
+        self.uid_id = uid_id if uid_id is not None else np.full(len(start), -1, dtype=np.int32)
+        self.uids = uids if uids is not None else []
+        self.recurrence_id = recurrence_id if recurrence_id is not None else np.full(len(start), np.datetime64("NaT"), dtype="datetime64[us]")
+
+    @staticmethod
+    def from_columns(
+        titles: Sequence[str],
+        starts: Sequence[datetime],
+        ends: Sequence[datetime],
+        color1: Color,
+        color2: Color,
+        uids: Optional[Sequence[Optional[str]]] = None,
+        recurrence_ids: Optional[Sequence[Optional[datetime]]] = None,
+    ) -> EventTable:
+        interned: Dict[str, int] = {}
+        title_id = np.fromiter((interned.setdefault(t, len(interned)) for t in titles), dtype=np.int32, count=len(titles))
+        uid_id, uid_list = intern_optional(uids if uids is not None else [None] * len(titles))
+        return EventTable(
+            start=np.array(starts, dtype="datetime64[us]").reshape(-1),
+            end=np.array(ends, dtype="datetime64[us]").reshape(-1),
+            title_id=title_id,
+            titles=list(interned),
+            color1=np.full(len(titles), color1.to_screen_color_idx(), dtype=np.uint8),
+            color2=np.full(len(titles), color2.to_screen_color_idx(), dtype=np.uint8),
+            uid_id=uid_id,
+            uids=uid_list,
+            recurrence_id=optional_datetimes(recurrence_ids if recurrence_ids is not None else [None] * len(titles)),
+        )
+
+    @staticmethod
+    def from_events(events: Sequence[Event]) -> EventTable:
+        interned: Dict[str, int] = {}
+        uid_id, uids = intern_optional([e.uid for e in events])
+        return EventTable(
+            start=np.array([e.start for e in events], dtype="datetime64[us]").reshape(-1),
+            end=np.array([e.end for e in events], dtype="datetime64[us]").reshape(-1),
+            title_id=np.array([interned.setdefault(e.title, len(interned)) for e in events], dtype=np.int32),
+            titles=list(interned),
+            color1=np.array([e.color1.to_screen_color_idx() for e in events], dtype=np.uint8),
+            color2=np.array([e.color2.to_screen_color_idx() for e in events], dtype=np.uint8),
+            uid_id=uid_id,
+            uids=uids,
+            recurrence_id=optional_datetimes([e.recurrence_id for e in events]),
+        )
+
+    @staticmethod
+    def concat(tables: Sequence[EventTable]) -> EventTable:
+        if len(tables) == 0:
+            return EventTable.from_events([])
+
+        # re-intern titles and uids across tables
+        interned: Dict[str, int] = {}
+        interned_uids: Dict[str, int] = {}
+        title_ids = []
+        uid_ids = []
+        for t in tables:
+            remap = np.array([interned.setdefault(title, len(interned)) for title in t.titles], dtype=np.int32)
+            title_ids.append(remap[t.title_id] if len(t) > 0 else t.title_id)
+            # with -1 (no uid) mapping to the last element
+            remap_uid = np.array([interned_uids.setdefault(uid, len(interned_uids)) for uid in t.uids] + [-1], dtype=np.int32)
+            uid_ids.append(remap_uid[t.uid_id])
+
+        return EventTable(
+            start=np.concatenate([t.start for t in tables]),
+            end=np.concatenate([t.end for t in tables]),
+            title_id=np.concatenate(title_ids),
+            titles=list(interned),
+            color1=np.concatenate([t.color1 for t in tables]),
+            color2=np.concatenate([t.color2 for t in tables]),
+            uid_id=np.concatenate(uid_ids),
+            uids=list(interned_uids),
+            recurrence_id=np.concatenate([t.recurrence_id for t in tables]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def take(self, idx: np.ndarray) -> EventTable:
+        return EventTable(
+            start=self.start[idx],
+            end=self.end[idx],
+            title_id=self.title_id[idx],
+            titles=self.titles,
+            color1=self.color1[idx],
+            color2=self.color2[idx],
+            uid_id=self.uid_id[idx],
+            uids=self.uids,
+            recurrence_id=self.recurrence_id[idx],
+        )
+
+    # events at least partly between start and end
+    def window(self, start: datetime, end: datetime) -> EventTable:
+        mask = (self.start < np.datetime64(end, "us")) & (self.end > np.datetime64(start, "us"))
+        return self.take(np.flatnonzero(mask))
+
+    # the parts of events between start and end, cut to fit. unlike window, events of no length
+    # right at start are kept
+    def clip(self, start: datetime, end: datetime) -> EventTable:
+        t0, t1 = np.datetime64(start, "us"), np.datetime64(end, "us")
+        inside = self.take(np.flatnonzero((self.start < t1) & ((self.end > t0) | (self.start >= t0))))
+        return EventTable(
+            start=np.maximum(inside.start, t0),
+            end=np.minimum(inside.end, t1),
+            title_id=inside.title_id,
+            titles=inside.titles,
+            color1=inside.color1,
+            color2=inside.color2,
+            uid_id=inside.uid_id,
+            uids=inside.uids,
+            recurrence_id=inside.recurrence_id,
+        )
+
+    # applies f to every distinct title, once
+    def map_titles(self, f) -> EventTable:
+        return EventTable(
+            start=self.start,
+            end=self.end,
+            title_id=self.title_id,
+            titles=[f(t) for t in self.titles],
+            color1=self.color1,
+            color2=self.color2,
+            uid_id=self.uid_id,
+            uids=self.uids,
+            recurrence_id=self.recurrence_id,
+        )
+
+    def duration_us(self) -> np.ndarray:
+        return (self.end - self.start).astype(np.int64)
+
+    # longest first, ties keep their order
+    def sorted_by_length(self) -> EventTable:
+        return self.take(np.argsort(-self.duration_us(), kind="stable"))
+
+    def sorted_by_start(self) -> EventTable:
+        return self.take(np.lexsort((self.end, self.start)))
+
+    # overlaps[i, j] is whether events i and j overlap. i overlaps with itself if it isn't empty
+    def overlap_matrix(self) -> np.ndarray:
+        return (self.start[:, None] < self.end[None, :]) & (self.start[None, :] < self.end[:, None])
+
+    # number of other events overlapping each event, in O(n log n)
+    def overlap_counts(self) -> np.ndarray:
+        starts = np.sort(self.start)
+        ends = np.sort(self.end)
+        started_before_end = np.searchsorted(starts, self.end, side="left") # start_j < end_i
+        ended_before_start = np.searchsorted(ends, self.start, side="right") # end_j <= start_i
+        counts = started_before_end - ended_before_start
+
+        # that also subtracts empty events at the start of an empty event, which never overlap it
+        empty = self.start >= self.end
+        empty_starts = np.sort(self.start[empty])
+        n_empty_at = np.searchsorted(empty_starts, self.start, side="right") - np.searchsorted(empty_starts, self.start, side="left")
+        return counts + np.where(empty, n_empty_at, -1) # a non-empty event overlaps itself
+
+    def title(self, i: int) -> str:
+        return self.titles[self.title_id[i]]
+
+    def uid(self, i: int) -> Optional[str]:
+        return self.uids[self.uid_id[i]] if self.uid_id[i] >= 0 else None
+
+    def event(self, i: int) -> Event:
+        recurrence_id = self.recurrence_id[i]
+        return Event(
+            title=self.title(i),
+            start=to_datetime(self.start[i]),
+            end=to_datetime(self.end[i]),
+            color1=SCREEN_COLORS[self.color1[i]],
+            color2=SCREEN_COLORS[self.color2[i]],
+            uid=self.uid(i),
+            recurrence_id=None if np.isnat(recurrence_id) else to_datetime(recurrence_id),
+        )
+
+    def to_events(self) -> List[Event]:
+        return [self.event(i) for i in range(len(self))]
+
+def test_event_table():
+    import random
+
+    random.seed(1)
+    day = datetime(2025, 1, 20)
+    events = []
+    for i in range(300):
+        start = day + timedelta(minutes=random.randrange(0, 7 * 24 * 60))
+        end = start + timedelta(minutes=random.randrange(0, 300))
+        events.append(Event(title=f"event {i % 17}", start=start, end=end, color1=Color.RED, color2=Color.BLUE))
+
+    table = EventTable.from_events(events)
+    assert len(table.titles) == 17
+    assert table.to_events() == events
+
+    w0, w1 = day + timedelta(days=2), day + timedelta(days=3)
+    assert table.window(w0, w1).to_events() == [e for e in events if not (e.start >= w1 or e.end <= w0)]
+    clipped = table.clip(w0, w1).to_events()
+    assert [(e.title, e.start, e.end) for e in clipped] == [
+        (e.title, max(e.start, w0), min(e.end, w1)) for e in events if e.start < w1 and (e.end > w0 or e.start >= w0)
+    ]
+
+    assert table.sorted_by_length().to_events() == sorted(events, key=lambda e: e.end - e.start, reverse=True)
+
+    counts = [sum(1 for j, f in enumerate(events) if i != j and e.overlaps_with(f)) for i, e in enumerate(events)]
+    assert table.overlap_counts().tolist() == counts
+    matrix = table.overlap_matrix()
+    assert [int(row.sum()) - int(row[i]) for i, row in enumerate(matrix)] == counts
+
+    both = EventTable.concat([table, EventTable.from_events(events[:3] + [events[0]])])
+    assert both.to_events() == events + events[:3] + [events[0]]
+    assert len(both.titles) == 17
+
+if __name__ == "__main__":
+    test_event_table()
@@ -1,30 +1,142 @@
 from __future__ import annotations
-from typing import List, Any, Union, Optional
-import caldav
-import toml
-from dataclasses import dataclass
+from typing import Callable, Dict, List, Any, Tuple, Union, Optional
+from dataclasses import dataclass, field
+from contextlib import contextmanager
 from data import Event, Color
-from datetime import datetime, timedelta, date, time
-import requests
-import icalendar
-import re
-
-TE_COURSE = re.compile(r"^(?:Kurskod: (?P<kurskod>[^.]+)\. Kursnamn: (?P<kursnamn>[^,]+)(, )?)+(?P<sak>.*)$")
-TE_RUBRIK = re.compile(r"^(?:Rubrik: )(?P<rubrik>.+)$")
-def timeedit_parse(summary):
-    m = re.match(TE_COURSE, summary)
-    if m:
-        kod = m.group("kurskod")
-        namn = m.group("kursnamn")
-        sak = m.group("sak")
-        return f"{kod} — {sak} ({namn})"
-
-    m = re.match(TE_RUBRIK, summary)
-    if m:
-        return m.group("rubrik")
-
-    print(f"oddball: {summary!r}")
-    return summary
+from event_table import EventTable
+from titles import TitlePipeline, pipeline_for
+from metrics import CALENDAR_FETCH_SECONDS, CALENDAR_PARSE_SECONDS, CALENDAR_ERRORS, CALENDAR_LAST_SUCCESS
+from memory import MEMORY
+from datetime import datetime, timedelta, date, time, timezone
+import os
+import time as time_module
+
+CALDAV_NS = "{urn:ietf:params:xml:ns:caldav}"
+
+# only the properties we render, with recurring events expanded by the server
+CALENDAR_QUERY = """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop>
+    <C:calendar-data>
+      <C:comp name="VCALENDAR">
+        <C:comp name="VEVENT">
+          <C:prop name="SUMMARY"/>
+          <C:prop name="DTSTART"/>
+          <C:prop name="DTEND"/>
+          <C:prop name="DURATION"/>
+          <C:prop name="UID"/>
+          <C:prop name="RECURRENCE-ID"/>
+        </C:comp>
+      </C:comp>
+      <C:expand start="{start}" end="{end}"/>
+    </C:calendar-data>
+  </D:prop>
+  <C:filter>
+    <C:comp-filter name="VCALENDAR">
+      <C:comp-filter name="VEVENT">
+        <C:time-range start="{start}" end="{end}"/>
+      </C:comp-filter>
+    </C:comp-filter>
+  </C:filter>
+</C:calendar-query>
+"""
+
+# start and end are local time, like everything else
+def calendar_query(start: datetime, end: datetime) -> str:
+    fmt = "%Y%m%dT%H%M%SZ"
+    return CALENDAR_QUERY.format(start=start.astimezone(timezone.utc).strftime(fmt), end=end.astimezone(timezone.utc).strftime(fmt))
+
+# the iCalendar text of each object in a calendar-query response
+def calendar_data(multistatus: Union[str, bytes]) -> List[str]:
+    import xml.etree.ElementTree as ET
+
+    if isinstance(multistatus, str):
+        multistatus = multistatus.encode()
+    tree = ET.fromstring(multistatus)
+    return [el.text for el in tree.iter(CALDAV_NS + "calendar-data") if el.text]
+
+# columns of events, as they're collected before making an EventTable:
+# titles, starts, ends, uids, recurrence ids
+Columns = Tuple[List[str], List[datetime], List[datetime], List[Optional[str]], List[Optional[datetime]]]
+
+# in local time. times with a time zone are converted, expanded recurrences come back from the
+# server in UTC. floating times are kept as they are
+def to_datetime(t: Union[datetime, date]) -> datetime:
+    if isinstance(t, datetime):
+        return t.astimezone().replace(tzinfo=None) if t.tzinfo is not None else t
+    else:
+        return datetime.combine(t, time.min)
+
+def vevent_columns(icals: List[str]) -> Columns:
+    import icalendar
+
+    titles: List[str] = []
+    starts: List[datetime] = []
+    ends: List[datetime] = []
+    uids: List[Optional[str]] = []
+    recurrence_ids: List[Optional[datetime]] = []
+    for data in icals:
+        ical = icalendar.Calendar.from_ical(data)
+        for vevent in ical.walk("VEVENT"):
+            start = to_datetime(vevent.get("DTSTART").dt)
+            if vevent.get("DTEND") is not None:
+                end = to_datetime(vevent.get("DTEND").dt)
+            elif vevent.get("DURATION") is not None:
+                end = start + vevent.get("DURATION").dt
+            else:
+                end = start
+            if end == start and start.time() == time.min:
+                end += timedelta(days=1) # adjust for whole-day events
+
+            titles.append(vevent.get("SUMMARY"))
+            starts.append(start)
+            ends.append(end)
+            uid = vevent.get("UID")
+            uids.append(str(uid) if uid is not None else None)
+            recurrence_id = vevent.get("RECURRENCE-ID")
+            recurrence_ids.append(to_datetime(recurrence_id.dt) if recurrence_id is not None else None)
+    return titles, starts, ends, uids, recurrence_ids
+
+# one client per CalDAV account, kept between fetches. collections are discovered once, and the
+# connection is reused for all calendars on the account
+class CalDAVAccount:
+    def __init__(self, url: str, username: Optional[str], password: Optional[str]):
+        import caldav
+
+        self.url = url
+        self.client = caldav.DAVClient(url=url, username=username, password=password)
+        self._collections: Optional[List[Any]] = None
+
+    def collections(self) -> List[Any]:
+        if self._collections is None:
+            self._collections = self.client.principal().calendars()
+        return self._collections
+
+    # by display name or URL. None is the first one
+    def collection(self, selector: Optional[str]) -> Any:
+        collections = self.collections()
+        if len(collections) == 0:
+            raise ValueError(f"no calendars at {self.url}")
+        if selector is None:
+            return collections[0]
+        for c in collections:
+            if selector == c.get_display_name() or selector.rstrip("/") == str(c.url).rstrip("/"):
+                return c
+        names = ", ".join(repr(c.get_display_name()) for c in collections)
+        raise ValueError(f"no calendar {selector!r} at {self.url}, found {names}")
+
+    # one REPORT
+    def query(self, collection: Any, start: datetime, end: datetime) -> List[str]:
+        response = self.client.report(str(collection.url), calendar_query(start, end), depth=1)
+        return calendar_data(response.raw)
+
+CALDAV_ACCOUNTS: Dict[Tuple[str, Optional[str], Optional[str]], CalDAVAccount] = {}
+
+def caldav_account(url: str, username: Optional[str], password: Optional[str]) -> CalDAVAccount:
+    key = (url, username, password)
+    if key not in CALDAV_ACCOUNTS:
+        CALDAV_ACCOUNTS[key] = CalDAVAccount(url, username, password)
+    return CALDAV_ACCOUNTS[key]
 
 @dataclass
 class Calendar:
@@ -35,6 +147,9 @@ class Calendar:
     url: str
     color1: Color
     color2: Color
+    calendar: Optional[str] = None # which of the account's CalDAV calendars, by name or URL
+    titles: List[Any] = field(default_factory=list) # title rules, see titles.py
+    name: Optional[str] = None # for metrics and logs
 
     @staticmethod
     def from_obj(data: Any) -> Calendar:
@@ -46,60 +161,114 @@ class Calendar:
             url = data["url"],
             color1=Color.from_str(data["color1"]),
             color2=Color.from_str(data["color2"]),
+            calendar = data.get("calendar"),
+            titles = data.get("titles", []),
+            name = data.get("name"),
         )
 
-    def load_events(self, day: date, n_days: int) -> List[Event]:
-        day_start = datetime.combine(day, time.min)
-        day_end = day_start + timedelta(days=n_days)
+    # without the full url, which may have secrets in it
+    def label(self) -> str:
+        from urllib.parse import urlparse
 
-        def to_datetime(t: Union[datetime, date], start: bool) -> datetime:
-            if isinstance(t, datetime):
-                return t.replace(tzinfo=None)
-            else:
-                return datetime.combine(t, time.min)
-
-        if self.is_caldav:
-            with caldav.DAVClient(url=self.url, username=self.username, password=self.password) as client:
-                conn = client.principal()
-                calendar = conn.calendar()
-                caldav_events = calendar.search(start=day_start, end=day_end, event=True, expand=True)
-                events = []
-                for caldav_event in caldav_events:
-                    vevent = caldav_event.vobject_instance.vevent
-                    title = vevent.summary.value
+        if self.name is not None:
+            return self.name
+        return (urlparse(self.url).hostname or "") + (f"/{self.calendar}" if self.calendar is not None else "")
 
-                    start: datetime = to_datetime(vevent.dtstart.value, start=True)
-                    end: datetime = to_datetime(vevent.dtend.value, start=False)
+    def title_pipeline(self) -> Optional[TitlePipeline]:
+        rules = ([{"timeedit": True}] if self.timeedit_parse else []) + self.titles
+        if len(rules) == 0:
+            return None
+        return pipeline_for(rules)
 
-                    if start >= day_end or end <= day_start:
-                        # event is out of range
-                        continue
+    # everything deciding what's fetched, the rest only changes how events are shown
+    def source_key(self) -> Tuple[Any, ...]:
+        return (self.is_caldav, self.url, self.username, self.password, self.calendar)
 
-                    events.append(Event(title=title, start=start, end=end, color1=self.color1, color2=self.color2))
+    def load_events(self, day: date, n_days: int) -> List[Event]:
+        return self.load_table(day, n_days).to_events()
+
+    # the events as columns, see event_table.EventTable. calendars sharing fetched share the
+    # responses of their CalDAV collections. with a cache, what was fetched less than max_age
+    # seconds ago is used instead of fetching again
+    def load_table(
+        self,
+        day: date,
+        n_days: int,
+        fetched: Optional[Dict[Any, Columns]] = None,
+        cache: Optional[FetchCache] = None,
+        max_age: Optional[float] = None,
+    ) -> EventTable:
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=n_days)
 
-                return events
+        columns = cache.get(self.source_key(), (day_start, day_end), max_age) if cache is not None else None
+        if columns is None:
+            try:
+                columns = self.fetch_columns(day_start, day_end, fetched if fetched is not None else {})
+            except Exception:
+                CALENDAR_ERRORS.inc(calendar=self.label())
+                raise
+            CALENDAR_LAST_SUCCESS.set(datetime.now().timestamp(), calendar=self.label())
+            if cache is not None:
+                cache.put(self.source_key(), (day_start, day_end), columns)
+        titles, starts, ends, uids, recurrence_ids = columns
+
+        # drop events out of range before rewriting titles, each distinct title is rewritten once
+        table = EventTable.from_columns(titles, starts, ends, self.color1, self.color2, uids, recurrence_ids).window(day_start, day_end)
+        pipeline = self.title_pipeline()
+        if pipeline is not None:
+            table = table.map_titles(pipeline)
+        return table
+
+    def fetch_columns(self, day_start: datetime, day_end: datetime, fetched: Dict[Any, Columns]) -> Columns:
+        if self.is_caldav:
+            account = caldav_account(self.url, self.username, self.password)
+            try:
+                collection = account.collection(self.calendar)
+                key = (str(collection.url), day_start, day_end)
+                if key not in fetched:
+                    with CALENDAR_FETCH_SECONDS.time(calendar=self.label()):
+                        icals = account.query(collection, day_start, day_end)
+                    with CALENDAR_PARSE_SECONDS.time(calendar=self.label()), MEMORY.stage("parse"):
+                        fetched[key] = vevent_columns(icals)
+            except Exception:
+                # rediscover next time, in case the collections changed
+                CALDAV_ACCOUNTS.pop((self.url, self.username, self.password), None)
+                raise
+            return fetched[key]
         else:
-            data = requests.get(self.url).text
-            ical = icalendar.Calendar.from_ical(data)
-            events = []
-
-            for vevent in ical.walk("VEVENT"):
-                title = vevent.get("SUMMARY")
-                if self.timeedit_parse:
-                    title = timeedit_parse(title)
-
-                start = to_datetime(vevent.get("DTSTART").dt, start=True)
-                end = to_datetime(vevent.get("DTEND").dt, start=False)
-                if end == start and start.time() == time.min:
-                    end += timedelta(days=1) # adjust for whole-day events
-
-                if start >= day_end or end <= day_start:
-                    # event is out of range
-                    continue
-
-                events.append(Event(title=title, start=start, end=end, color1=self.color1, color2=self.color2))
-
-            return events
+            import requests
+
+            with CALENDAR_FETCH_SECONDS.time(calendar=self.label()):
+                response = requests.get(self.url)
+                response.raise_for_status()
+                data = response.text
+            with CALENDAR_PARSE_SECONDS.time(calendar=self.label()), MEMORY.stage("parse"):
+                return vevent_columns([data])
+
+# fetched calendars, by Calendar.source_key, kept between renders. only the last window of each
+# source is kept
+class FetchCache:
+    def __init__(self, clock: Callable[[], float] = time_module.time):
+        self.clock = clock
+        self.columns: Dict[Tuple[Any, ...], Tuple[Tuple[datetime, datetime], float, Columns]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source: Tuple[Any, ...], window: Tuple[datetime, datetime], max_age: Optional[float]) -> Optional[Columns]:
+        entry = self.columns.get(source)
+        if max_age is None or entry is None or entry[0] != window or self.clock() - entry[1] > max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def put(self, source: Tuple[Any, ...], window: Tuple[datetime, datetime], columns: Columns):
+        self.columns[source] = (window, self.clock(), columns)
+
+    def invalidate(self, source: Tuple[Any, ...]):
+        self.columns.pop(source, None)
 
 @dataclass
 class Secrets:
@@ -109,11 +278,212 @@ class Secrets:
     def from_obj(data: Any) -> Secrets:
         return Secrets(calendars=[Calendar.from_obj(x) for x in data["calendar"]])
 
+    @staticmethod
+    def load(path: str) -> Secrets:
+        import toml
+
+        return Secrets.from_obj(toml.load(open(path, "r")))
+
+    # with events that are in more than one calendar merged, see dedup.py
+    def load_events(self, day: date, n_days: int) -> List[Event]:
+        from dedup import dedup
+
+        return dedup(self.load_table(day, n_days)).to_events()
+
+    def load_table(self, day: date, n_days: int, cache: Optional[FetchCache] = None, max_age: Optional[float] = None) -> EventTable:
+        fetched: Dict[Any, Columns] = {}
+        return EventTable.concat([cal.load_table(day, n_days, fetched, cache, max_age) for cal in self.calendars])
+
+# how the calendars differ between two versions of the secrets file
+@dataclass
+class SecretsChange:
+    refetch: List[Calendar] # new, or fetching something else than before
+    restyled: List[Calendar] # fetching the same, but shown differently
+    removed: List[Calendar]
+
+    def __bool__(self) -> bool:
+        return len(self.refetch) + len(self.restyled) + len(self.removed) > 0
+
+def diff_secrets(old: Secrets, new: Secrets) -> SecretsChange:
+    unmatched = list(old.calendars)
+    change = SecretsChange(refetch=[], restyled=[], removed=[])
+    for cal in new.calendars:
+        if cal in unmatched:
+            unmatched.remove(cal)
+            continue
+        same_source = next((o for o in unmatched if o.source_key() == cal.source_key()), None)
+        if same_source is not None:
+            unmatched.remove(same_source)
+            change.restyled.append(cal)
+        else:
+            change.refetch.append(cal)
+    change.removed = unmatched
+    return change
+
+# the secrets file, parsed again only when it has changed. checked by modification time and size
+# first, and content after that, so saving it without changes doesn't count
+class SecretsWatcher:
+    def __init__(self, path: str):
+        self.path = path
+        self.stat: Optional[Tuple[int, int]] = None
+        self.digest: Optional[bytes] = None
+        self.secrets: Optional[Secrets] = None
+
+    # what changed since the last check, None if nothing did. the first check counts everything as new
+    def check(self) -> Optional[SecretsChange]:
+        import hashlib
+        import toml
+
+        st = os.stat(self.path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self.stat:
+            return None
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.stat = stat
+        digest = hashlib.sha256(data).digest()
+        if digest == self.digest:
+            return None
+
+        secrets = Secrets.from_obj(toml.loads(data.decode("utf-8")))
+        change = diff_secrets(self.secrets if self.secrets is not None else Secrets(calendars=[]), secrets)
+        self.digest = digest
+        self.secrets = secrets
+        return change if change else None
+
+    def load(self) -> Secrets:
+        self.check()
+        assert(self.secrets is not None)
+        return self.secrets
+
+@contextmanager
+def local_timezone(tz: str):
+    old = os.environ.get("TZ")
+    os.environ["TZ"] = tz
+    time_module.tzset()
+    try:
+        yield
+    finally:
+        if old is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = old
+        time_module.tzset()
+
+def test_calendar_query():
+    with local_timezone("UTC"):
+        query = calendar_query(datetime(2025, 1, 20), datetime(2025, 1, 23))
+    assert '<C:time-range start="20250120T000000Z" end="20250123T000000Z"/>' in query
+    assert '<C:expand start="20250120T000000Z" end="20250123T000000Z"/>' in query
+
+    # the local day, not the UTC one
+    with local_timezone("Europe/Stockholm"):
+        query = calendar_query(datetime(2025, 1, 20), datetime(2025, 1, 23))
+    assert '<C:time-range start="20250119T230000Z" end="20250122T230000Z"/>' in query
+    assert '<C:expand start="20250119T230000Z" end="20250122T230000Z"/>' in query
+
+    def ical(*lines: str) -> str:
+        return "\r\n".join(["BEGIN:VCALENDAR", "VERSION:2.0", "BEGIN:VEVENT", *lines, "END:VEVENT", "END:VCALENDAR", ""])
+
+    objects = [
+        ical("UID:a", "SUMMARY:with end", "DTSTART:20250120T100000Z", "DTEND:20250120T113000Z"),
+        ical("UID:b", "SUMMARY:with duration", "DTSTART:20250121T090000Z", "DURATION:PT45M"),
+        ical("UID:c", "SUMMARY:all day", "DTSTART;VALUE=DATE:20250122"),
+        ical("UID:d", "SUMMARY:floating", "DTSTART:20250122T080000", "DTEND:20250122T090000"),
+        ical("UID:e", "SUMMARY:in new york", "DTSTART;TZID=America/New_York:20250122T080000", "DTEND;TZID=America/New_York:20250122T090000"),
+    ]
+    multistatus = '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+    for i, data in enumerate(objects):
+        multistatus += f"<D:response><D:href>/cal/{i}.ics</D:href><D:propstat><D:prop><C:calendar-data>{data}</C:calendar-data></D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>"
+    multistatus += "</D:multistatus>"
+
+    assert [d.replace("\r\n", "\n") for d in calendar_data(multistatus)] == [d.replace("\r\n", "\n") for d in objects]
+    with local_timezone("Europe/Stockholm"):
+        titles, starts, ends, uids, _ = vevent_columns(calendar_data(multistatus))
+    assert uids == ["a", "b", "c", "d", "e"]
+    assert titles == ["with end", "with duration", "all day", "floating", "in new york"]
+    # UTC and other time zones in local time
+    assert starts == [datetime(2025, 1, 20, 11), datetime(2025, 1, 21, 10), datetime(2025, 1, 22), datetime(2025, 1, 22, 8), datetime(2025, 1, 22, 14)]
+    assert ends == [datetime(2025, 1, 20, 12, 30), datetime(2025, 1, 21, 10, 45), datetime(2025, 1, 23), datetime(2025, 1, 22, 9), datetime(2025, 1, 22, 15)]
+
+def test_secrets_watcher():
+    import tempfile
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    ics = "\r\n".join([
+        "BEGIN:VCALENDAR", "VERSION:2.0",
+        "BEGIN:VEVENT", "UID:a", "SUMMARY:Möte", "DTSTART:20250120T100000", "DTEND:20250120T110000", "END:VEVENT",
+        "END:VCALENDAR", "",
+    ]).encode()
+    requests_made: List[str] = []
+
+    class Feed(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_made.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/calendar")
+            self.send_header("Content-Length", str(len(ics)))
+            self.end_headers()
+            self.wfile.write(ics)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Feed)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    def calendar(path: str, color: str) -> str:
+        return f'[[calendar]]\nis_caldav = false\nurl = "{url}{path}"\ncolor1 = "{color}"\ncolor2 = "RED"\n'
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "secrets.toml")
+        def write(text: str, mtime_ns: int):
+            with open(path, "w") as f:
+                f.write(text)
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+        watcher = SecretsWatcher(path)
+        cache = FetchCache()
+        def load() -> EventTable:
+            change = watcher.check()
+            for cal in (change.removed if change is not None else []):
+                cache.invalidate(cal.source_key())
+            return watcher.secrets.load_table(date(2025, 1, 20), 1, cache, max_age=3600) # type: ignore
+
+        write(calendar("/a.ics", "BLUE") + calendar("/b.ics", "GREEN"), 10**9)
+        assert load().to_events()[0].color1 == Color.BLUE
+        assert requests_made == ["/a.ics", "/b.ics"]
+
+        # saved again without changes
+        write(calendar("/a.ics", "BLUE") + calendar("/b.ics", "GREEN"), 2 * 10**9)
+        assert watcher.check() is None
+
+        # a new color doesn't fetch anything again
+        write(calendar("/a.ics", "ORANGE") + calendar("/b.ics", "GREEN"), 3 * 10**9)
+        change = diff_secrets(watcher.secrets, Secrets.load(path)) # type: ignore
+        assert [c.color1 for c in change.restyled] == [Color.ORANGE] and change.refetch == []
+        assert [e.color1 for e in load().to_events()] == [Color.ORANGE, Color.GREEN]
+        assert requests_made == ["/a.ics", "/b.ics"]
+
+        # only the calendar with a new url is
+        write(calendar("/a.ics", "ORANGE") + calendar("/c.ics", "GREEN"), 4 * 10**9)
+        load()
+        assert requests_made == ["/a.ics", "/b.ics", "/c.ics"]
+        assert len(cache.columns) == 2
+
+        # and without max_age, everything is
+        watcher.secrets.load_table(date(2025, 1, 20), 1, cache) # type: ignore
+        assert requests_made == ["/a.ics", "/b.ics", "/c.ics", "/a.ics", "/c.ics"]
+    httpd.shutdown()
+
 run_old = False
 
 if __name__ == "__main__" and run_old:
+    import toml
     from canvas import Canvas, Background, CalendarEvent, CANVAS_WIDTH, CANVAS_HEIGHT
-    from layout_old import layout
+    from day_view import layout
 
     secrets = Secrets.from_obj(toml.load(open("./secrets.toml", "r")))
 
@@ -138,6 +508,7 @@ if __name__ == "__main__" and run_old:
     canvas.preview()
 
 if __name__ == "__main__" and not run_old:
+    import toml
     from canvas import Canvas, Background
     from data import Color, Rectangle
     from layout import CalendarCanvas
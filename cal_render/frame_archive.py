@@ -0,0 +1,329 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import argparse
+import bisect
+import json
+import os
+import time
+import zlib
+
+from display import Display
+
+# every frame sent to each device, for debugging and for going through a device's history. frames
+# are appended to a file per device, as keyframes (zlib compressed) and deltas against the previous
+# frame (xor, with the runs of zeros left out). an index of when each frame was sent gives random
+# access, a frame is decoded from the keyframe before it. frames are mostly the same from wake to
+# wake, so deltas are small, often empty
+#
+#   python frame_archive.py list 192.168.1.20
+#   python frame_archive.py extract 192.168.1.20 --at 2025-01-20T08:00 -o frame.png
+
+def default_archive_path() -> str:
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "cal-render", "history")
+
+# zeros between changed bytes shorter than this are kept in the run, a new run costs a few bytes
+MIN_GAP = 8
+
+def write_varint(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data: bytes, i: int) -> Tuple[int, int]:
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+# runs of changed bytes, as (zeros skipped, length, xor of the bytes)
+def encode_delta(previous: bytes, frame: bytes) -> bytes:
+    import numpy as np
+
+    assert(len(previous) == len(frame))
+    x = np.frombuffer(previous, dtype=np.uint8) ^ np.frombuffer(frame, dtype=np.uint8)
+    changed = np.flatnonzero(x)
+    if len(changed) == 0:
+        return b""
+
+    breaks = np.flatnonzero(np.diff(changed) > MIN_GAP)
+    starts = changed[np.concatenate([[0], breaks + 1])].tolist()
+    ends = (changed[np.concatenate([breaks, [len(changed) - 1]])] + 1).tolist()
+
+    out = bytearray()
+    pos = 0
+    for start, end in zip(starts, ends):
+        write_varint(out, start - pos)
+        write_varint(out, end - start)
+        out.extend(x[start:end].tobytes())
+        pos = end
+    return bytes(out)
+
+def apply_delta(previous: bytes, delta: bytes) -> bytes:
+    import numpy as np
+
+    frame = np.frombuffer(previous, dtype=np.uint8).copy()
+    i = 0
+    pos = 0
+    while i < len(delta):
+        skip, i = read_varint(delta, i)
+        n, i = read_varint(delta, i)
+        pos += skip
+        frame[pos:pos + n] ^= np.frombuffer(delta, dtype=np.uint8, count=n, offset=i)
+        i += n
+        pos += n
+    return frame.tobytes()
+
+def display_obj(display: Display) -> Dict[str, Any]:
+    return {
+        "name": display.name,
+        "width": display.width,
+        "height": display.height,
+        "rotation": display.rotation,
+        "encoding": display.encoding,
+        "palette": list(display.palette),
+    }
+
+def display_from_obj(data: Dict[str, Any]) -> Display:
+    return Display(**{**data, "palette": tuple(data["palette"])})
+
+@dataclass
+class Entry:
+    t: float
+    offset: int # in the data file
+    length: int
+    keyframe: bool
+    display: Dict[str, Any] # display_obj
+
+# one device's frames. the data file is only appended to, and a line is added to the index after
+# its frame is written, so a crash at most loses the last frame
+class DeviceArchive:
+    def __init__(self, path: str, keyframe_interval: int = 32):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.data_path = os.path.join(path, "frames.bin")
+        self.index_path = os.path.join(path, "index.jsonl")
+
+        self.entries: List[Entry] = []
+        if os.path.exists(self.index_path):
+            size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+            with open(self.index_path, "r") as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    e = Entry(**json.loads(line))
+                except (ValueError, TypeError):
+                    break # cut off by a crash
+                if e.offset + e.length > size:
+                    break
+                self.entries.append(e)
+
+            # drop what was cut off, so new frames don't end up after it
+            if len(self.entries) < len(lines):
+                with open(self.index_path, "w") as f:
+                    f.writelines(json.dumps(e.__dict__) + "\n" for e in self.entries)
+            end = self.entries[-1].offset + self.entries[-1].length if len(self.entries) > 0 else 0
+            if size > end:
+                os.truncate(self.data_path, end)
+
+        self.last: Optional[bytes] = None # last frame, decoded on the first append
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, frame: bytes, display: Display, t: Optional[float] = None):
+        t = t if t is not None else time.time()
+        if self.last is None and len(self.entries) > 0:
+            self.last = self.frame(len(self.entries) - 1)
+
+        obj = display_obj(display)
+        since_keyframe = next((i for i, e in enumerate(reversed(self.entries)) if e.keyframe), None)
+        keyframe = (
+            self.last is None
+            or len(self.last) != len(frame)
+            or self.entries[-1].display != obj
+            or since_keyframe is None
+            or since_keyframe + 1 >= self.keyframe_interval
+        )
+        data = zlib.compress(frame) if keyframe else encode_delta(self.last, frame) # type: ignore
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.data_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        entry = Entry(t=t, offset=offset, length=len(data), keyframe=keyframe, display=obj)
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(entry.__dict__) + "\n")
+        self.entries.append(entry)
+        self.last = frame
+
+    def _read(self, e: Entry) -> bytes:
+        with open(self.data_path, "rb") as f:
+            f.seek(e.offset)
+            return f.read(e.length)
+
+    # the i:th frame, from the keyframe before it
+    def frame(self, i: int) -> bytes:
+        k = i
+        while not self.entries[k].keyframe:
+            k -= 1
+        frame = zlib.decompress(self._read(self.entries[k]))
+        for e in self.entries[k + 1:i + 1]:
+            frame = apply_delta(frame, self._read(e))
+        return frame
+
+    # index of the frame showing at t, the last one sent before it
+    def index_at(self, t: float) -> Optional[int]:
+        i = bisect.bisect_right([e.t for e in self.entries], t) - 1
+        return i if i >= 0 else None
+
+    def display(self, i: int) -> Display:
+        return display_from_obj(self.entries[i].display)
+
+class FrameArchive:
+    def __init__(self, path: str, keyframe_interval: int = 32):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.archives: Dict[str, DeviceArchive] = {}
+
+    def device(self, device: str) -> DeviceArchive:
+        if device not in self.archives:
+            name = "".join(c if c.isalnum() or c in ".-" else "_" for c in device)
+            self.archives[device] = DeviceArchive(os.path.join(self.path, name), self.keyframe_interval)
+        return self.archives[device]
+
+    def append(self, device: str, frame: bytes, display: Display, t: Optional[float] = None):
+        self.device(device).append(frame, display, t)
+
+    def devices(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.listdir(self.path))
+
+def parse_time(s: str) -> float:
+    from datetime import datetime
+
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.fromisoformat(s).timestamp()
+
+def main():
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser("cal-render-history", description="Frames sent to devices")
+    parser.add_argument("--archive", default=default_archive_path(), help="Directory of the archive, as given to serve --frame-archive")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    parser_list = subparsers.add_parser("list", help="List devices, or the frames sent to a device")
+    parser_list.add_argument("device", nargs="?")
+
+    parser_extract = subparsers.add_parser("extract", help="Save a frame as an image")
+    parser_extract.add_argument("device")
+    which = parser_extract.add_mutually_exclusive_group()
+    which.add_argument("--at", help="Time (unix seconds or ISO 8601), the frame showing then is saved. the last one by default")
+    which.add_argument("-i", "--index", type=int, help="Number of the frame, from list. negative counts from the end")
+    parser_extract.add_argument("-o", "--output", default="frame.png")
+    env = parser.parse_args()
+
+    archive = FrameArchive(env.archive)
+    if env.subcommand == "list":
+        if env.device is None:
+            for d in archive.devices():
+                print(d)
+            return
+        history = archive.device(env.device)
+        for i, e in enumerate(history.entries):
+            kind = "key" if e.keyframe else "delta"
+            print(f"{i:5} {datetime.fromtimestamp(e.t).isoformat(timespec='seconds')} {e.display['name']:10} {kind:5} {e.length:7} bytes")
+
+    elif env.subcommand == "extract":
+        from serve import decode
+
+        history = archive.device(env.device)
+        if len(history) == 0:
+            raise SystemExit(f"nothing archived for {env.device}")
+        if env.at is not None:
+            i = history.index_at(parse_time(env.at))
+            if i is None:
+                raise SystemExit(f"nothing sent to {env.device} before {env.at}")
+        else:
+            i = env.index if env.index is not None else -1
+            i = i % len(history)
+        decode(history.frame(i), history.display(i)).save(env.output)
+        print(f"frame {i} from {datetime.fromtimestamp(history.entries[i].t).isoformat(timespec='seconds')} saved to {env.output}")
+
+def test_delta():
+    import random
+
+    random.seed(2)
+    a = bytes(random.randrange(7) for _ in range(5000))
+    b = bytearray(a)
+    for i in [0, 3, 9, 100, 101, 4000, 4999]:
+        b[i] = (b[i] + 1) % 7
+    b = bytes(b)
+    delta = encode_delta(a, b)
+    assert apply_delta(a, delta) == b
+    assert len(delta) < 40
+    assert encode_delta(a, a) == b""
+    assert apply_delta(a, b"") == a
+
+    for n in (0, 127, 128, 300, 2 ** 21):
+        out = bytearray()
+        write_varint(out, n)
+        assert read_varint(bytes(out), 0) == (n, len(out))
+
+def test_frame_archive():
+    import tempfile
+    import random
+
+    random.seed(4)
+    display = Display(width=16, height=10, rotation=90)
+    p4 = Display(name="small", width=16, height=10, rotation=0, encoding="p4")
+    frames = []
+    frame = bytes(random.randrange(7) for _ in range(display.frame_size()))
+    for i in range(12):
+        b = bytearray(frame)
+        for _ in range(random.randrange(3)):
+            b[random.randrange(len(b))] = random.randrange(7)
+        frame = bytes(b)
+        frames.append((display, frame))
+    frames.append((p4, frame[:p4.frame_size()])) # a different display starts a new keyframe
+    frames.append((p4, frame[:p4.frame_size()]))
+
+    with tempfile.TemporaryDirectory() as d:
+        archive = FrameArchive(d, keyframe_interval=5)
+        for i, (disp, f) in enumerate(frames[:8]):
+            archive.append("10.0.0.2", f, disp, t=1000 + i)
+        # picks up where it left off, after a restart
+        archive = FrameArchive(d, keyframe_interval=5)
+        for i, (disp, f) in enumerate(frames[8:], 8):
+            archive.append("10.0.0.2", f, disp, t=1000 + i)
+
+        history = FrameArchive(d).device("10.0.0.2")
+        assert [history.frame(i) for i in range(len(frames))] == [f for _, f in frames]
+        assert [e.keyframe for e in history.entries] == [True, False, False, False, False] * 2 + [True, False, True, False]
+        assert history.display(12) == p4
+        assert history.index_at(999) is None
+        assert history.index_at(1003.5) == 3
+        assert history.index_at(5000) == len(frames) - 1
+        assert archive.devices() == ["10.0.0.2"]
+
+        # frames cut off by a crash are dropped, the last one is empty since it's the same as the one before
+        os.truncate(history.data_path, history.entries[-2].offset + history.entries[-2].length - 1)
+        archive = FrameArchive(d)
+        assert len(archive.device("10.0.0.2")) == len(frames) - 2
+        archive.append("10.0.0.2", frames[-1][1], p4, t=2000)
+        history = FrameArchive(d).device("10.0.0.2")
+        assert len(history) == len(frames) - 1
+        assert history.frame(len(history) - 1) == frames[-1][1]
+
+if __name__ == "__main__":
+    main()
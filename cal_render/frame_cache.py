@@ -0,0 +1,136 @@
+from __future__ import annotations
+from typing import List, Optional
+from datetime import date
+import hashlib
+import json
+import os
+
+from data import Event
+from display import Display, DEFAULT_DISPLAY
+
+# bump whenever the rendering code changes what a frame looks like for the same inputs
+FRAME_VERSION = 1
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cal-render", "frames")
+
+# layout breaks ties by input order, so everything is rendered in this order
+def canonical_order(events: List[Event]) -> List[Event]:
+    return sorted(events, key=lambda e: (e.start, e.end, e.title, e.color1.name, e.color2.name))
+
+# hash of everything the rendered frame depends on
+def frame_key(
+    events: List[Event],
+    *,
+    day: date,
+    n_days: int,
+    dark_mode: bool,
+    pixels_per_hour: int,
+    pixels_per_break: int,
+    display: Display = DEFAULT_DISPLAY,
+    layout: str = "window",
+) -> str:
+    obj = {
+        "version": FRAME_VERSION,
+        "display": display.key(),
+        "layout": layout,
+        "day": day.isoformat(),
+        "n_days": n_days,
+        "dark_mode": dark_mode,
+        "pixels_per_hour": pixels_per_hour,
+        "pixels_per_break": pixels_per_break,
+        "events": [
+            [e.title, e.start.isoformat(), e.end.isoformat(), e.color1.name, e.color2.name]
+            for e in canonical_order(events)
+        ],
+    }
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+# encoded frames on disk, keyed by frame_key. least recently used frames are removed when the
+# total size goes above max_bytes
+class FrameCache:
+    def __init__(self, path: str, max_bytes: int = 32 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + ".frame")
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._file(key), "rb") as f:
+                frame = f.read()
+            os.utime(self._file(key)) # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frame
+
+    def put(self, key: str, frame: bytes):
+        tmp = self._file(key) + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(frame)
+        os.replace(tmp, self._file(key)) # never leave half-written frames around
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".frame"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def test_frame_cache():
+    import tempfile
+    from datetime import datetime
+    from data import Color
+
+    e = lambda t, h: Event(title=t, start=datetime(2025, 1, 20, h), end=datetime(2025, 1, 20, h+1), color1=Color.RED, color2=Color.RED)
+    kw = dict(day=date(2025, 1, 20), n_days=7, dark_mode=False, pixels_per_hour=50, pixels_per_break=30)
+
+    k = frame_key([e("a", 9), e("b", 10)], **kw)
+    assert k == frame_key([e("b", 10), e("a", 9)], **kw)
+    assert k != frame_key([e("a", 9), e("c", 10)], **kw)
+    assert k != frame_key([e("a", 9), e("b", 10)], **{**kw, "dark_mode": True})
+    assert k != frame_key([e("a", 9), e("b", 10)], **kw, display=Display(encoding="p4"))
+    assert k == frame_key([e("a", 9), e("b", 10)], **kw, display=Display(name="other", devices=("10.0.0.2",)))
+    assert k != frame_key([e("a", 9), e("b", 10)], **kw, layout="day")
+
+    with tempfile.TemporaryDirectory() as d:
+        cache = FrameCache(d, max_bytes=25)
+        cache.put("a", b"a" * 10)
+        cache.put("b", b"b" * 10)
+        os.utime(cache._file("a"), (0, 0))
+        assert cache.get("b") == b"b" * 10
+        cache.put("c", b"c" * 10) # evicts a
+        assert cache.get("a") is None
+        assert FrameCache(d).get("c") == b"c" * 10
+        assert (cache.hits, cache.misses) == (1, 1)
+
+if __name__ == "__main__":
+    test_frame_cache()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+from typing import List
+
+# n slots, all starting at initial, where ranges of slots can be raised and the highest in a range
+# looked up, in O(log n) each. for finding the overlapping intervals placed so far without looking
+# at every one of them, see layout.layout_events and day_view.layout
+class MaxTree:
+    def __init__(self, n: int, initial: int = 0):
+        self.initial = initial
+        self.size = 1
+        while self.size < n:
+            self.size *= 2
+        self.best: List[int] = [initial] * (2 * self.size) # highest in the subtree
+        self.floor: List[int] = [initial] * (2 * self.size) # every slot in the subtree is at least this
+
+    # raises slots [l, r) to at least v
+    def raise_to(self, l: int, r: int, v: int):
+        if l >= r:
+            return
+        best, floor = self.best, self.floor
+        l += self.size
+        r += self.size
+        i, j = l >> 1, (r - 1) >> 1
+        while l < r:
+            if l & 1:
+                if best[l] < v:
+                    best[l] = v
+                if floor[l] < v:
+                    floor[l] = v
+                l += 1
+            if r & 1:
+                r -= 1
+                if best[r] < v:
+                    best[r] = v
+                if floor[r] < v:
+                    floor[r] = v
+            l >>= 1
+            r >>= 1
+        # everything above the first and last slot has one of them under it
+        while i > 0:
+            if best[i] < v:
+                best[i] = v
+            if best[j] < v:
+                best[j] = v
+            i >>= 1
+            j >>= 1
+
+    # the highest of slots [l, r), initial if it's empty
+    def max(self, l: int, r: int) -> int:
+        if l >= r:
+            return self.initial
+        best, floor = self.best, self.floor
+        result = self.initial
+        l += self.size
+        r += self.size
+        i, j = l >> 1, (r - 1) >> 1
+        while l < r:
+            if l & 1:
+                if best[l] > result:
+                    result = best[l]
+                l += 1
+            if r & 1:
+                r -= 1
+                if best[r] > result:
+                    result = best[r]
+            l >>= 1
+            r >>= 1
+        # raised ranges covering the whole subtree of a node above the first or last slot
+        while i > 0:
+            if floor[i] > result:
+                result = floor[i]
+            if floor[j] > result:
+                result = floor[j]
+            i >>= 1
+            j >>= 1
+        return result
+
+def test_max_tree():
+    import random
+
+    random.seed(6)
+    for n in (1, 2, 7, 64, 100):
+        tree = MaxTree(n, initial=-1)
+        slots = [-1] * n
+        for _ in range(300):
+            l, r = sorted(random.randrange(n + 1) for _ in range(2))
+            if random.random() < 0.5:
+                v = random.randrange(1000)
+                tree.raise_to(l, r, v)
+                for i in range(l, r):
+                    slots[i] = max(slots[i], v)
+            else:
+                assert tree.max(l, r) == max(slots[l:r], default=-1)
+
+if __name__ == "__main__":
+    test_max_tree()
@@ -1,9 +1,14 @@
 from __future__ import annotations
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import numpy as np
+import os
 from data import Event, Rectangle, Color
 from canvas import Canvas, CalendarEvent, Text, Background
+from tiles import TileCache, TILE_CACHE
+from event_table import EventTable, to_datetime
 
 weekday_names = ["Må", "Ti", "On", "To", "Fr", "Lö", "Sö"]
 
@@ -43,41 +48,59 @@ def test_timerange():
     assert t.start == datetime(2025, 1, 1, 13, 0, 0)
     assert t.end == datetime(2025, 1, 1, 15, 0, 0)
 
+def as_table(events: Union[List[Event], EventTable]) -> EventTable:
+    return events if isinstance(events, EventTable) else EventTable.from_events(events)
+
+def floor_hour(t: np.ndarray) -> np.ndarray:
+    return t.astype("datetime64[h]").astype("datetime64[us]")
+
 # gives hour-aligned ranges
 def time_ranges(
-    events: List[Event],
+    events: Union[List[Event], EventTable],
     coalesce: timedelta = timedelta(hours=1), # how long between two ranges for them to combine
     inactive: timedelta = timedelta(hours=1), # how long with no activity for range to break
 ) -> List[TimeRange]:
-    if len(events) == 0:
+    table = as_table(events)
+    if len(table) == 0:
         return []
 
-    # should be non-overlapping
-    ranges: List[TimeRange] = []
-
-    def does_overlap(r1: TimeRange, r2: TimeRange) -> bool:
-        return r1.start <= r2.end + coalesce and r2.start <= r1.end + coalesce
-
-    for event in events:
-        if event.end - event.start < 2 * inactive:
-            ranges.append(TimeRange.round_to_hour(event.start, event.end))
-        else:
-            ranges.append(TimeRange.round_to_hour(event.start, event.start + inactive))
-            ranges.append(TimeRange.round_to_hour(event.end - inactive, event.end))
-
-    ranges.sort(key=lambda x: x.start)
+    # short events give one range, long ones one at the start and one at the end
+    # same as TimeRange.round_to_hour, for all events at once
+    inactive_us = np.timedelta64(inactive, "us")
+    round_up = np.timedelta64(3600 - 1, "s")
+    is_long = table.end - table.start >= 2 * inactive_us
+    long_idx = np.flatnonzero(is_long)
+
+    starts = np.concatenate([
+        floor_hour(table.start),
+        floor_hour(table.end[long_idx] - inactive_us),
+    ])
+    ends = np.concatenate([
+        floor_hour(np.where(is_long, table.start + inactive_us, table.end) + round_up),
+        floor_hour(table.end[long_idx] + round_up),
+    ])
+    # sort by start, keeping the order the ranges would have been made in
+    made_order = np.concatenate([2 * np.arange(len(table)), 2 * long_idx + 1])
+    order = np.lexsort((made_order, starts))
+    starts = starts[order].astype(np.int64).tolist()
+    ends = ends[order].astype(np.int64).tolist()
 
     # coalesce ranges
+    coalesce_us = int(np.timedelta64(coalesce, "us").astype(np.int64))
     coalesced = []
-    current = ranges[0]
-    for r in ranges[1:]:
-        if does_overlap(current, r):
-            current.end = r.end
+    current_start, current_end = starts[0], ends[0]
+    for start, end in zip(starts[1:], ends[1:]):
+        if current_start <= end + coalesce_us and start <= current_end + coalesce_us:
+            current_end = end
         else:
-            coalesced.append(current)
-            current = r
+            coalesced.append((current_start, current_end))
+            current_start, current_end = start, end
+    coalesced.append((current_start, current_end))
 
-    return coalesced + [current]
+    return [
+        TimeRange(start=to_datetime(np.datetime64(s, "us")), end=to_datetime(np.datetime64(e, "us")))
+        for s, e in coalesced
+    ]
 
 def test_timeranges():
     import random
@@ -123,35 +146,64 @@ class LayoutedEvent:
     event: Event
     start_ratio: float # 0 = all the way to the left
     end_ratio: float # 1 = all the way to the right
+    ranges: Optional[Tuple[int, int]] = None # indices of the time ranges it's drawn in, all if None
 
-def layout_events(events: List[Event], sort_by_length: bool = True) -> List[LayoutedEvent]:
-    if sort_by_length:
-        events.sort(key=lambda e: e.end - e.start, reverse=True)
+# events placed left to right, each as wide as the events after it that it overlaps allow. which
+# earlier events overlap each event is looked up in a MaxTree over the times events start and end at,
+# so it's O(n log n) time and O(n) memory
+def layout_events(events: Union[List[Event], EventTable], sort_by_length: bool = True) -> List[LayoutedEvent]:
+    from intervals import MaxTree
 
-    layouted = [
-        LayoutedEvent(event=e, start_ratio=0, end_ratio=0) for e in events
-    ]
-    n_later_overlaps = [0 for _ in events]
-    for i in range(len(events) - 1, -1, -1):
-        e = events[i]
-        n_overlaps = 0
-        for j in range(i+1, len(events)):
-            e2 = events[j]
-            if e.overlaps_with(e2):
-                n_overlaps = max(n_overlaps, 1 + n_later_overlaps[j])
-        n_later_overlaps[i] = n_overlaps
-
-    for i, (layout, overlaps) in enumerate(zip(layouted, n_later_overlaps)):
-        remaining = 1 - layout.start_ratio
-        size = remaining / (1 + overlaps)
-        layout.end_ratio = layout.start_ratio + size
-        for l in layouted[i+1:]:
-            if layout.event.overlaps_with(l.event):
-                l.start_ratio = layout.end_ratio
+    table = as_table(events)
+    if sort_by_length:
+        table = table.sorted_by_length()
+    n = len(table)
+
+    # slot 2k is the k:th distinct time, 2k + 1 the times between it and the next. an event covers
+    # the times strictly between its start and end, an empty event the time it's at. empty events
+    # at the same time don't overlap, so they're kept in a tree of their own that only non-empty
+    # events look in
+    times = np.unique(np.concatenate([table.start, table.end]))
+    k_start = np.searchsorted(times, table.start) * 2
+    k_end = np.searchsorted(times, table.end) * 2
+    empty = (table.start >= table.end).tolist()
+    lo = np.where(empty, k_start, k_start + 1).tolist()
+    hi = np.where(empty, k_start + 1, k_end).tolist()
+    n_slots = 2 * len(times)
+
+    def placed(initial: int) -> Tuple[MaxTree, MaxTree]:
+        return MaxTree(n_slots, initial), MaxTree(n_slots, initial) # non-empty, empty
+
+    def overlapping(trees: Tuple[MaxTree, MaxTree], i: int) -> int:
+        found = trees[0].max(lo[i], hi[i])
+        return found if empty[i] else max(found, trees[1].max(lo[i], hi[i]))
+
+    # how many events after each one it shares its width with, going back from the last
+    n_later_overlaps = [0] * n
+    trees = placed(0)
+    for i in range(n - 1, -1, -1):
+        n_later_overlaps[i] = overlapping(trees, i) # 1 + the most of a later event it overlaps
+        trees[empty[i]].raise_to(lo[i], hi[i], n_later_overlaps[i] + 1)
+
+    # each event starts where the last event before it that it overlaps ends
+    end_ratios: List[float] = []
+    layouted = []
+    trees = placed(-1)
+    for i in range(n):
+        before = overlapping(trees, i)
+        start_ratio = end_ratios[before] if before >= 0 else 0.0
+        remaining = 1 - start_ratio
+        size = remaining / (1 + n_later_overlaps[i])
+        end_ratio = start_ratio + size
+        end_ratios.append(end_ratio)
+        trees[empty[i]].raise_to(lo[i], hi[i], i)
+        layouted.append(LayoutedEvent(event=table.event(i), start_ratio=start_ratio, end_ratio=end_ratio))
 
     return layouted
 
 def test_layout():
+    import random
+
     e = lambda dhm0, dhm1: Event(title="mjau", start=datetime(2025, 1, *dhm0, 0), end=datetime(2025, 1, *dhm1, 0), color1=Color.RED, color2=Color.RED)
 
     es = [
@@ -177,6 +229,187 @@ def test_layout():
         (0, 0.5), (0.5, 1), (0.5, 1), # last three
     ]
 
+    # the same as going through every pair of events, with empty events and events at the same times
+    def layout_pairwise(table: EventTable) -> List[Tuple[float, float]]:
+        overlaps = table.overlap_matrix()
+        n_later_overlaps = np.zeros(len(table), dtype=np.int64)
+        for i in range(len(table) - 1, -1, -1):
+            later = overlaps[i, i+1:]
+            if later.any():
+                n_later_overlaps[i] = 1 + n_later_overlaps[i+1:][later].max()
+        start_ratios = np.zeros(len(table))
+        ratios = []
+        for i in range(len(table)):
+            start_ratio = float(start_ratios[i])
+            end_ratio = start_ratio + (1 - start_ratio) / (1 + int(n_later_overlaps[i]))
+            start_ratios[i+1:][overlaps[i, i+1:]] = end_ratio
+            ratios.append((start_ratio, end_ratio))
+        return ratios
+
+    random.seed(7)
+    for n in (0, 1, 10, 200):
+        starts = [datetime(2025, 1, 20, 8) + timedelta(minutes=15 * random.randrange(40)) for _ in range(n)]
+        es = [Event(title="mjau", start=s, end=s + timedelta(minutes=random.choice([0, 0, 15, 30, 60, 180])), color1=Color.RED, color2=Color.RED) for s in starts]
+        table = EventTable.from_events(es).sorted_by_length()
+        assert [(l.start_ratio, l.end_ratio) for l in layout_events(table, sort_by_length=False)] == layout_pairwise(table)
+
+# everything about where events go that doesn't depend on the size of the display, so it can be
+# shared between displays
+@dataclass
+class Schedule:
+    time_ranges: List[TimeRange]
+    layouted: List[LayoutedEvent]
+
+    @staticmethod
+    def from_events(events: Union[List[Event], EventTable]) -> Schedule:
+        table = as_table(events)
+        return Schedule(time_ranges=time_ranges(table), layouted=layout_events(table))
+
+    # every day on its own, with events cut at midnight, stacked in day order. overlaps are only
+    # looked for within a day, and days whose events haven't changed are taken from memo. days are
+    # laid out in parallel processes when there are at least parallel_min_events to lay out, below
+    # that starting the processes and sending events back and forth takes longer than it saves
+    @staticmethod
+    def by_day(
+        events: Union[List[Event], EventTable],
+        memo: Optional[DayScheduleMemo] = None,
+        parallel_min_events: int = 10000,
+        workers: Optional[int] = None,
+    ) -> Schedule:
+        table = as_table(events)
+        memo = memo if memo is not None else DAY_SCHEDULES
+
+        days = []
+        for day in day_starts(table):
+            segments = table.clip(day, day + timedelta(days=1))
+            if len(segments) > 0:
+                days.append((DayScheduleMemo.key(day, segments), segments))
+
+        schedules = {}
+        todo = []
+        for key, segments in days:
+            schedule = memo.get(key)
+            if schedule is None:
+                todo.append((key, segments))
+            else:
+                schedules[key] = schedule
+
+        parallel = (workers or os.cpu_count() or 1) > 1
+        if parallel and len(todo) > 1 and sum(len(segments) for _, segments in todo) >= parallel_min_events:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # not forked, serve has other threads running by now, and forking those can deadlock
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method)) as pool:
+                results = list(pool.map(Schedule.from_events, [segments for _, segments in todo]))
+        else:
+            results = [Schedule.from_events(segments) for _, segments in todo]
+        for (key, _), schedule in zip(todo, results):
+            memo.put(key, schedule)
+            schedules[key] = schedule
+
+        # keep each day's events in that day's ranges, they would otherwise show up where days meet
+        stacked = Schedule(time_ranges=[], layouted=[])
+        for key, _ in days:
+            schedule = schedules[key]
+            first, last = len(stacked.time_ranges), len(stacked.time_ranges) + len(schedule.time_ranges)
+            stacked.time_ranges.extend(schedule.time_ranges)
+            stacked.layouted.extend(replace(l, ranges=(first, last)) for l in schedule.layouted)
+        return stacked
+
+LAYOUTS = ["window", "day"]
+
+def make_schedule(events: Union[List[Event], EventTable], layout: str = "window") -> Schedule:
+    if layout == "day":
+        return Schedule.by_day(events)
+    assert(layout == "window"), f"layout must be one of {LAYOUTS}, not {layout!r}"
+    return Schedule.from_events(events)
+
+# midnights of the days events are on
+def day_starts(table: EventTable) -> List[datetime]:
+    if len(table) == 0:
+        return []
+    first = table.start.min().astype("datetime64[D]")
+    # an event ending at midnight isn't on the next day
+    last = np.maximum(table.end - np.timedelta64(1, "us"), table.start).max().astype("datetime64[D]")
+    return [to_datetime(d.astype("datetime64[us]")) for d in np.arange(first, last + 1)]
+
+# schedules of single days, by the day and its events in order, least recently used ones dropped
+class DayScheduleMemo:
+    def __init__(self, size: int = 64):
+        self.size = size
+        self.memo: OrderedDict[Tuple, Schedule] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(day: datetime, segments: EventTable) -> Tuple:
+        return (
+            day,
+            tuple(segments.titles[i] for i in segments.title_id.tolist()),
+            segments.start.astype(np.int64).tobytes(),
+            segments.end.astype(np.int64).tobytes(),
+            segments.color1.tobytes(),
+            segments.color2.tobytes(),
+        )
+
+    def get(self, key: Tuple) -> Optional[Schedule]:
+        if key in self.memo:
+            self.hits += 1
+            self.memo.move_to_end(key)
+            return self.memo[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple, schedule: Schedule):
+        self.memo[key] = schedule
+        while len(self.memo) > self.size:
+            self.memo.popitem(last=False)
+
+DAY_SCHEDULES = DayScheduleMemo()
+
+def test_schedule_by_day():
+    e = lambda t, dh0, dh1: Event(title=t, start=datetime(2025, 1, *dh0), end=datetime(2025, 1, *dh1), color1=Color.RED, color2=Color.BLUE)
+
+    es = [
+        e("a", (20, 9), (20, 10)),
+        e("b", (20, 9), (20, 11)),
+        e("natt", (20, 23), (21, 1)), # cut at midnight
+        e("c", (21, 9), (21, 10)), # doesn't overlap b, on a different day
+        e("d", (22, 0), (22, 0)), # no length, at midnight
+    ]
+    memo = DayScheduleMemo()
+    s = Schedule.by_day(es, memo=memo)
+    assert [(r.start.day, r.start.hour, r.end.hour) for r in s.time_ranges] == [
+        (20, 9, 11), (20, 23, 0),
+        (21, 0, 1), (21, 9, 10),
+        (22, 0, 0),
+    ]
+    assert [(l.event.title, l.event.start.day, l.event.start.hour, l.start_ratio, l.end_ratio, l.ranges) for l in s.layouted] == [
+        ("b", 20, 9, 0, 0.5, (0, 2)),
+        ("a", 20, 9, 0.5, 1, (0, 2)),
+        ("natt", 20, 23, 0, 1, (0, 2)),
+        ("natt", 21, 0, 0, 1, (2, 4)),
+        ("c", 21, 9, 0, 1, (2, 4)),
+        ("d", 22, 0, 0, 1, (4, 5)),
+    ]
+    assert (memo.hits, memo.misses) == (0, 3)
+
+    # only the changed day is laid out again
+    es[3] = e("c", (21, 10), (21, 11))
+    s2 = Schedule.by_day(es, memo=memo)
+    assert (memo.hits, memo.misses) == (2, 4)
+    assert s2.layouted[:3] == s.layouted[:3]
+
+    # the same in parallel
+    assert Schedule.by_day(es, memo=DayScheduleMemo(), parallel_min_events=0, workers=2) == s2
+    assert make_schedule(es, "window") == Schedule.from_events(es)
+
+# an event tile: x0, y0, x1, y1, title, color1, color2, time_start, time_end
+Placement = Tuple[int, int, int, int, str, Color, Color, Optional[str], Optional[str]]
+
 class TimeTick(Canvas):
     def __init__(
         self,
@@ -231,12 +464,14 @@ class CalendarCanvas(Canvas):
         self,
         *,
         bounding_rect: Rectangle,
-        events: List[Event],
+        events: Union[List[Event], EventTable, None] = None,
+        schedule: Optional[Schedule] = None, # instead of events
 
         background: Optional[Canvas] = None,
         dark_mode: bool = False,
         pixels_per_hour: int = 50,
         pixels_per_break: int = 30,
+        tile_cache: TileCache = TILE_CACHE,
     ):
         bounding_rect.x0 += 80 # offset for tick marks
         bounding_rect.y0 += 6 # offset for tick marks
@@ -247,7 +482,12 @@ class CalendarCanvas(Canvas):
         else:
             self.canvas = Background(Color.BLACK if dark_mode else Color.WHITE)
 
-        self.time_ranges = time_ranges(events)
+        if schedule is None:
+            assert(events is not None)
+            schedule = Schedule.from_events(events)
+        self.time_ranges = schedule.time_ranges
+        # every event tile drawn, in order, for damage.rerender
+        self.placements: List[Placement] = []
         time_range_pixel_intervals: List[Tuple[int, int]] = []
         y = bounding_rect.y0
         is_first = True
@@ -263,11 +503,11 @@ class CalendarCanvas(Canvas):
             y += height + pixels_per_break
             is_first = False
 
-        layouted = layout_events(events)
-
-        for l in layouted:
+        for l in schedule.layouted:
             e = l.event
-            for rng, (rp0, rp1) in zip(self.time_ranges, time_range_pixel_intervals):
+            for i, (rng, (rp0, rp1)) in enumerate(zip(self.time_ranges, time_range_pixel_intervals)):
+                if l.ranges is not None and not l.ranges[0] <= i < l.ranges[1]:
+                    continue
                 r0 = (e.start - rng.start) / (rng.end - rng.start)
                 r1 = (e.end - rng.start) / (rng.end - rng.start)
 
@@ -279,14 +519,18 @@ class CalendarCanvas(Canvas):
                         y1 = y0 + 33 # force size
                     x0 = l.start_ratio * (bounding_rect.x1 - bounding_rect.x0) + bounding_rect.x0
                     x1 = l.end_ratio * (bounding_rect.x1 - bounding_rect.x0) + bounding_rect.x0
-                    self.canvas = CalendarEvent(
+                    rect = Rectangle(x0=round(x0), x1=round(x1), y0=round(y0), y1=round(y1))
+                    time_start = e.start.strftime("%H:%M") if r0 >= 0 else None
+                    time_end = e.end.strftime("%H:%M") if r1 <= 1 else None
+                    self.placements.append((rect.x0, rect.y0, rect.x1, rect.y1, e.title, e.color1, e.color2, time_start, time_end))
+                    self.canvas = tile_cache.event(
                         self.canvas,
-                        Rectangle(x0=round(x0), x1=round(x1), y0=round(y0), y1=round(y1)),
+                        rect,
                         title=e.title,
                         color1=e.color1,
                         color2=e.color2,
-                        time_start=e.start.strftime("%H:%M") if r0 >= 0 else None,
-                        time_end=e.end.strftime("%H:%M") if r1 <= 1 else None,
+                        time_start=time_start,
+                        time_end=time_end,
                     )
 
 
@@ -298,6 +542,7 @@ if __name__ == "__main__":
     test_timeranges()
     test_timerange()
     test_layout()
+    test_schedule_by_day()
 
 
     e = lambda t, dhm0, dhm1: Event(title=t, start=datetime(2025, 1, *dhm0, 0), end=datetime(2025, 1, *dhm1, 0), color1=Color.RED, color2=Color.RED)
@@ -1,75 +1,167 @@
-from fetch_calendar import Secrets
-from layout import CalendarCanvas
-from data import Rectangle, Color
-from canvas import Background
-from serve import send
-import socket
-import toml
-import os
-
-secrets_path = os.path.join(os.path.dirname(__file__), "secrets.toml")
-
-from datetime import datetime, date
+from timing import Timer
+timer = Timer(enabled=False) # started as early as possible, enabled by --timing
 
+import os
+import sys
 import argparse
 
-parser = argparse.ArgumentParser("cal-render")
-
-parser.add_argument("-d", "--date", required=False, help="Date (in YYYY-MM-DD) to render calendar for")
-parser.add_argument("-n", "--n-days", nargs=1, required=False, default=7, type=int, help="Number of days in the future to show")
-parser.add_argument("--dark", action="store_true", help="Dark mode")
-parser.add_argument("--secrets", dest="secrets_path", required=False, type=str, help="Path to calendar secrets TOML file", default=secrets_path)
-
-subparser = parser.add_subparsers(dest="subcommand")
-
-parser_preview = subparser.add_parser("preview")
-
-parser_serve = subparser.add_parser("serve")
-parser_serve.add_argument("-o", "--once", action="store_true", help="Quit after one request has been served")
-parser_serve.add_argument("-p", "--port", default=2137, type=int, help="Port to listen on")
-
-env = parser.parse_args()
-secrets_path = env.secrets_path or secrets_path
-
-def render_date() -> date:
-    if env.date is None:
-        return datetime.today().date()
-    return datetime.strptime(env.date, "%Y-%m-%d").date()
-
-# early exit if the date is unparsable
-print("(initially) working with", render_date())
-print("loading secrets from", secrets_path)
-
-if env.subcommand == "preview":
-    secrets = Secrets.from_obj(toml.load(open(secrets_path, "r")))
-
-    events = [ev for cal in secrets.calendars for ev in cal.load_events(render_date(), env.n_days)]
-
-    c = CalendarCanvas(bounding_rect=Rectangle(x0=0, y0=0, x1=480, y1=800), events=events, dark_mode=env.dark)
-
-    c.preview()
-
-elif env.subcommand == "serve":
-    while True:
-        secrets = Secrets.from_obj(toml.load(open(secrets_path, "r")))
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(("0.0.0.0", env.port))
-        s.listen(1)
-        print(f"Listening on port {env.port}")
-
-        conn, addr = s.accept()
-        print(f"Connection from {addr}. Fetching calendar")
-
-        events = [ev for cal in secrets.calendars for ev in cal.load_events(render_date(), env.n_days)]
+from datetime import datetime, date
+from typing import Tuple
 
-        c = CalendarCanvas(bounding_rect=Rectangle(x0=0, y0=0, x1=480, y1=800), events=events, dark_mode=env.dark)
+# anything heavy (PIL, numpy, caldav, ...) is imported only on the code paths that need it,
+# keep it that way so restarts are quick. see test_startup_time
 
-        print(f"Sending content")
-        send(conn, c)
-        print(f"Closing connection")
-        s.close()
+secrets_path = os.path.join(os.path.dirname(__file__), "secrets.toml")
 
-        if env.once:
-            break
+# modules that must not be loaded before argparse has run
+HEAVY_MODULES = ["PIL", "numpy", "tqdm", "caldav", "requests", "icalendar", "toml", "fetch_calendar", "layout"]
+STARTUP_BUDGET_S = 0.25 # on top of a bare interpreter
+
+def make_parser() -> argparse.ArgumentParser:
+    from frame_cache import default_cache_dir
+    from wakes import default_history_path
+    from shared_frame import default_framebuffer_path
+    from frame_archive import default_archive_path
+
+    parser = argparse.ArgumentParser("cal-render")
+
+    parser.add_argument("-d", "--date", required=False, help="Date (in YYYY-MM-DD) to render calendar for")
+    parser.add_argument("-n", "--n-days", required=False, default=7, type=int, help="Number of days in the future to show")
+    parser.add_argument("--dark", action="store_true", help="Dark mode")
+    parser.add_argument("--secrets", dest="secrets_path", required=False, type=str, help="Path to calendar secrets TOML file", default=secrets_path)
+    parser.add_argument("--timing", action="store_true", help="Print how long startup and each stage took")
+    parser.add_argument("--memory", action="store_true", help="Trace memory use of each stage, and print peaks and where memory was allocated. slow")
+    parser.add_argument("--layout", choices=["window", "day"], default="window", help="Lay out the whole window at once, or every day on its own with events cut at midnight")
+
+    subparser = parser.add_subparsers(dest="subcommand")
+
+    parser_preview = subparser.add_parser("preview")
+    parser_preview.add_argument("--display", help="Name of the [[display]] in the secrets file to preview for, the first one by default")
+    parser_preview.add_argument("--view", choices=["schedule", "day"], default="schedule", help="The busy hours of --n-days days, or all 24 hours of only the first day to scale")
+
+    parser_serve = subparser.add_parser("serve")
+    parser_serve.add_argument("-o", "--once", action="store_true", help="Quit after one request has been served")
+    parser_serve.add_argument("-p", "--port", default=2137, type=int, help="Port to listen on")
+    parser_serve.add_argument("--cache-dir", default=default_cache_dir(), help="Directory to cache rendered frames in")
+    parser_serve.add_argument("--cache-size", default=32, type=int, help="Maximum size of the frame cache, in MiB")
+    parser_serve.add_argument("--wake-history", default=default_history_path(), help="File to remember when devices have connected in")
+    parser_serve.add_argument("--lead", default=120, type=float, help="Seconds before an expected wake to prepare a frame")
+    parser_serve.add_argument("--max-age", default=120, type=float, help="Minutes a prepared frame may be reused for when the calendar doesn't change")
+    parser_serve.add_argument("--stream", action="store_true", help="Start sending a frame while the rest of it is being rasterized")
+    parser_serve.add_argument("--split-renderer", action="store_true", help="Fetch and render in a separate process, sharing frames through --framebuffer")
+    parser_serve.add_argument("--framebuffer", default=default_framebuffer_path(), help="File to share rendered frames between processes in")
+    parser_serve.add_argument("--metrics-port", default=None, type=int, help="Serve Prometheus metrics on this port, on localhost")
+    parser_serve.add_argument("--frame-archive", default=default_archive_path(), help="Directory to keep every frame sent to each device in, see frame_archive.py")
+    parser_serve.add_argument("--no-frame-archive", action="store_true", help="Don't keep frames sent")
+
+    return parser
+
+def main():
+    with timer.stage("argparse"):
+        env = make_parser().parse_args()
+    timer.enabled = env.timing
+    if env.memory:
+        from memory import MEMORY
+        MEMORY.start()
+
+    def render_date() -> date:
+        if env.date is None:
+            return datetime.today().date()
+        return datetime.strptime(env.date, "%Y-%m-%d").date()
+
+    # early exit if the date is unparsable
+    print("(initially) working with", render_date())
+    print("loading secrets from", env.secrets_path)
+
+    if env.subcommand == "preview":
+        with timer.stage("secrets"):
+            from fetch_calendar import Secrets
+            secrets = Secrets.load(env.secrets_path)
+
+        with timer.stage("fetch"):
+            events = secrets.load_events(render_date(), 1 if env.view == "day" else env.n_days)
+
+        from display import load_displays
+        displays = load_displays(env.secrets_path)
+        matching = [d for d in displays if env.display is None or d.name == env.display]
+        if len(matching) == 0:
+            sys.exit(f"no display named {env.display!r}, there's {', '.join(d.name for d in displays)}")
+        display = matching[0]
+
+        with timer.stage("layout"):
+            if env.view == "day":
+                from day_view import day_canvas
+                c = day_canvas(events, render_date(), display.width, display.height, dark_mode=env.dark)
+            else:
+                from layout import CalendarCanvas, make_schedule
+                from data import Rectangle
+                c = CalendarCanvas(bounding_rect=Rectangle(x0=0, y0=0, x1=display.width, y1=display.height), schedule=make_schedule(events, env.layout), dark_mode=env.dark)
+
+        timer.print_report()
+        c.preview(display.width, display.height)
+
+    elif env.subcommand == "serve":
+        from frame_cache import FrameCache
+        from wakes import WakeHistory, RefreshPolicy
+        from serve import Server, Renderer
+        from display import load_displays
+        from metrics import METRICS, STAGE_SECONDS, serve_metrics
+
+        timer.observers.append(lambda name, dt: STAGE_SECONDS.observe(dt, stage=name))
+        displays = load_displays(env.secrets_path) # changing these needs a restart
+
+        def make_renderer() -> Renderer:
+            return Renderer(
+                secrets_path=env.secrets_path,
+                n_days=env.n_days,
+                dark_mode=env.dark,
+                render_date=render_date,
+                frame_cache=FrameCache(env.cache_dir, max_bytes=env.cache_size * 1024 * 1024),
+                wakes=WakeHistory(env.wake_history),
+                policy=RefreshPolicy(lead=env.lead, max_max_age=env.max_age * 60),
+                timer=timer,
+                streaming=env.stream,
+                displays=displays,
+                layout=env.layout,
+            )
+
+        if env.split_renderer:
+            from shared_frame import RendererProcess
+            renderer = RendererProcess(make_renderer, env.framebuffer, displays)
+        else:
+            renderer = make_renderer()
+
+        if env.metrics_port is not None:
+            def render_metrics() -> str:
+                other = renderer.metrics_snapshot()
+                return METRICS.render([other] if other is not None else [])
+            serve_metrics(env.metrics_port, render_metrics)
+
+        from frame_archive import FrameArchive
+        archive = None if env.no_frame_archive else FrameArchive(env.frame_archive)
+
+        Server(port=env.port, renderer=renderer, timer=timer, archive=archive, displays=displays).run(once=env.once)
+
+def test_startup_time():
+    import subprocess
+    import time
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    check = f"import sys, main; main.make_parser(); print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+
+    def cold_start(code: str) -> Tuple[float, str]:
+        # best of a few, to not fail on a single hiccup
+        best = float("inf")
+        for _ in range(3):
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", code], cwd=here, check=True, capture_output=True, text=True).stdout
+            best = min(best, time.perf_counter() - t0)
+        return best, out
+
+    bare, _ = cold_start("pass")
+    ours, loaded = cold_start(check)
+    assert loaded.strip() == "[]", f"heavy modules loaded at startup: {loaded.strip()}"
+    assert ours - bare < STARTUP_BUDGET_S, f"startup took {ours - bare:.3f}s over a bare interpreter"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+from __future__ import annotations
+from typing import List, Optional, Sequence, Tuple
+from functools import lru_cache
+from bisect import bisect_left
+import unicodedata
+
+from ultlf import UltlfCP
+
+LETTER_SPACING = 1
+ELLIPSIS = "..."
+
+# all of these are pure functions of their arguments, so they're memoized. titles repeat a lot
+# between events and renders
+
+@lru_cache(maxsize=None)
+def glyph(ch: str) -> UltlfCP:
+    return UltlfCP.from_ch(ch)
+
+# width of a character including the spacing after it
+@lru_cache(maxsize=None)
+def advance(ch: str) -> int:
+    return glyph(ch).width + LETTER_SPACING
+
+@lru_cache(maxsize=None)
+def _category_class(ch: str) -> str:
+    return unicodedata.category(ch)[0]
+
+# index i is the width of text[:i+1], in unscaled pixels
+@lru_cache(maxsize=4096)
+def prefix_widths(text: str) -> Tuple[int, ...]:
+    widths = []
+    at = -LETTER_SPACING
+    for ch in text:
+        at += advance(ch)
+        widths.append(at)
+    return tuple(widths)
+
+def text_width(text: str) -> int:
+    if len(text) == 0:
+        return 0
+    return prefix_widths(text)[-1]
+
+# indices where it's "okay" to put a line break in text, in increasing order
+@lru_cache(maxsize=4096)
+def breakpoints(text: str) -> Tuple[int, ...]:
+    indices = []
+    for i in range(1, len(text)):
+        # stupid stupid stupid
+        if _category_class(text[i-1]) != _category_class(text[i]):
+            indices.append(i)
+    return tuple(indices)
+
+# width of text[:i] for every breakpoint i. non-decreasing, so it can be bisected
+@lru_cache(maxsize=4096)
+def _breakpoint_widths(text: str) -> Tuple[int, ...]:
+    widths = prefix_widths(text)
+    return tuple(widths[i-1] for i in breakpoints(text))
+
+# where to cut text such that it is less than width pixels wide when drawn at scale
+# cuts at the last possible breakpoint. None if the whole text fits, 0 if nothing fits
+# if ellipsis is set, leaves room for adding ELLIPSIS after the cut
+def fit(text: str, width: int, *, scale: int = 1, ellipsis: bool = False) -> Optional[int]:
+    width //= scale
+
+    if text_width(text) < width:
+        # don't need to cut anything
+        return None
+
+    ellipsis_width = sum(advance(ch) for ch in ELLIPSIS) if ellipsis else 0
+
+    # last breakpoint with text[:i] + ellipsis less than width
+    k = bisect_left(_breakpoint_widths(text), width - ellipsis_width) - 1
+    if k < 0:
+        return 0
+    return breakpoints(text)[k]
+
+# breaks text into lines, line n drawn at scales[n], all at most width pixels wide
+# text not fitting on the last line is cut off, with an ellipsis if ellipsis is set
+def wrap(text: str, width: int, *, scales: Sequence[int] = (1,), ellipsis: bool = True) -> List[str]:
+    lines: List[str] = []
+    rest = text
+    for n, scale in enumerate(scales):
+        is_last = n == len(scales) - 1
+        cut = fit(rest, width, scale=scale, ellipsis=ellipsis and is_last)
+        if cut is None:
+            lines.append(rest)
+            break
+
+        line = rest[:cut]
+        if ellipsis and is_last and cut > 0:
+            line += ELLIPSIS
+        lines.append(line)
+        rest = rest[cut:]
+    return lines
+
+def test_measure():
+    text = "Vattna lila blomma och murgröna"
+    assert breakpoints(text) == (6, 7, 11, 12, 18, 19, 22, 23)
+    assert text_width("") == 0
+    assert text_width(text) == sum(advance(ch) for ch in text) - LETTER_SPACING
+
+    assert fit(text, 1000) is None
+    assert fit(text, 1) == 0
+    for width in range(1, text_width(text) + 2):
+        cut = fit(text, width)
+        if cut is None:
+            assert text_width(text) < width
+            continue
+        if cut > 0:
+            assert text_width(text[:cut]) < width
+        # no later breakpoint would have fit
+        assert all(text_width(text[:i]) >= width for i in breakpoints(text) if i > cut)
+
+    lines = wrap(text, 70, scales=(2, 1))
+    assert len(lines) == 2
+    assert text.startswith(lines[0])
+    assert text_width(lines[0]) * 2 < 70
+    assert lines[1].endswith(ELLIPSIS) and text_width(lines[1]) < 70
+    assert wrap(text, 1000, scales=(2, 1)) == [text]
+    assert "".join(wrap(text, 60, scales=(1,) * len(text), ellipsis=False)) == text
+
+if __name__ == "__main__":
+    test_measure()
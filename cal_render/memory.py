@@ -0,0 +1,156 @@
+from __future__ import annotations
+from typing import List, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass
+import sys
+import tracemalloc
+
+# memory used by each stage, traced with tracemalloc when enabled by --memory. every Timer stage is
+# traced, as is parsing each calendar. tracing makes everything a lot slower, so it's off by default
+#
+# peak is the most allocated at once during the stage, over what was allocated when it started.
+# sites are where what was still allocated at the end of the stage was allocated
+
+@dataclass
+class StageMemory:
+    name: str
+    peak: int # bytes
+    net: int # bytes still allocated at the end
+    max_rss: int # bytes, of the process so far
+    sites: List[Tuple[str, int]] # "file:line", bytes
+
+class MemoryProfiler:
+    def __init__(self, n_sites: int = 3):
+        self.n_sites = n_sites
+        self.active = False
+        self.stages: List[StageMemory] = []
+        # name, allocated at the start, highest seen, snapshot at the start, size of the snapshot
+        self.stack: List[List] = []
+        # bytes held by the snapshots on the stack. they're the profiler's, not the stages', so
+        # they're left out of every figure
+        self.overhead = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        tracemalloc.stop()
+
+    # allocated now, and passes the peak since the last call on to every stage running
+    def _see_peak(self) -> int:
+        current, peak = tracemalloc.get_traced_memory()
+        for entry in self.stack:
+            entry[2] = max(entry[2], peak - self.overhead)
+        return current - self.overhead
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.active:
+            yield
+            return
+
+        current = self._see_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+        before = self._snapshot()
+        size = tracemalloc.get_traced_memory()[0] - allocated
+        self.overhead += size
+        tracemalloc.reset_peak() # taking the snapshot isn't part of any stage
+        self.stack.append([name, current, current, before, size])
+        try:
+            yield
+        finally:
+            current = self._see_peak()
+            name, start, peak, before, size = self.stack.pop()
+            sites = [
+                (f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", stat.size_diff)
+                for stat in self._snapshot().compare_to(before, "lineno")[:self.n_sites]
+                if stat.size_diff > 0
+            ]
+            del before
+            self.overhead -= size
+            self.stages.append(StageMemory(name=name, peak=peak - start, net=current - start, max_rss=peak_rss(), sites=sites))
+            tracemalloc.reset_peak()
+
+    # what's allocated, but not by the profiler itself or tracemalloc
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "*/fnmatch.py"), # filter_traces matches with these
+            tracemalloc.Filter(False, "*/re/*"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ])
+
+    def report(self) -> str:
+        lines = []
+        for s in self.stages:
+            lines.append(f"{s.name:<24} peak {s.peak / 1024:9.1f} KiB, net {s.net / 1024:9.1f} KiB, max rss {s.max_rss / 2**20:7.1f} MiB")
+            for site, size in s.sites:
+                lines.append(f"    {size / 1024:9.1f} KiB  {site}")
+        return "\n".join(lines)
+
+    def print_report(self):
+        if self.active and len(self.stages) > 0:
+            print(self.report())
+        self.stages.clear()
+
+# the highest resident set size of this process so far, in bytes
+def peak_rss() -> int:
+    import resource
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024 # bytes on macOS, KiB elsewhere
+
+MEMORY = MemoryProfiler()
+
+def test_memory_profiler():
+    import json
+
+    m = MemoryProfiler()
+    m.start()
+    try:
+        with m.stage("outer"):
+            kept = json.loads("[" + ",".join(['"' + "x" * 1000 + '"'] * 256) + "]") # 256 KiB, allocated in json
+            with m.stage("inner"):
+                dropped = bytearray(2 * 2**20)
+                del dropped
+    finally:
+        m.stop()
+
+    inner, outer = m.stages
+    assert (inner.name, outer.name) == ("inner", "outer")
+    assert inner.peak >= 2 * 2**20 and inner.net < 64 * 1024
+    # the inner stage's peak counts for the outer one too
+    assert outer.peak >= inner.peak + 256 * 1024
+    assert outer.net >= 256 * 1024
+    assert "json" in outer.sites[0][0]
+    assert outer.max_rss > 0
+    assert "inner" in m.report()
+    del kept
+
+    # snapshots of nested stages aren't counted, even with a lot allocated
+    m = MemoryProfiler()
+    m.start()
+    try:
+        many = [str(i) for i in range(200000)]
+        with m.stage("outer"):
+            with m.stage("inner"):
+                pass
+    finally:
+        m.stop()
+    inner, outer = m.stages
+    for s in (inner, outer):
+        assert s.peak < 16 * 1024 and abs(s.net) < 16 * 1024, s
+        assert all(__file__ not in site and "fnmatch" not in site for site, _ in s.sites)
+    del many
+
+    # does nothing when not started
+    with MemoryProfiler().stage("off"):
+        pass
+
+if __name__ == "__main__":
+    test_memory_profiler()
@@ -0,0 +1,275 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+import copy
+import threading
+import time
+
+# counters, gauges and histograms, exposed over HTTP in the Prometheus text format by `serve
+# --metrics-port`. the renderer process of --split-renderer has its own registry, which is sent to
+# the server process and merged in when scraped
+
+LabelValues = Tuple[str, ...]
+# values of every metric, by name and label values. picklable, to be sent between processes
+Snapshot = Dict[str, Dict[LabelValues, Any]]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + "}"
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[LabelValues, Any] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        assert(set(labels) == set(self.labels)), f"{self.name} has labels {self.labels}, got {tuple(labels)}"
+        return tuple(str(labels[n]) for n in self.labels)
+
+    # combines values of the same metric from another process
+    def merge(self, a: Any, b: Any) -> Any:
+        return b
+
+    def lines(self, values: Dict[LabelValues, Any]) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels, k)} {format_value(v)}" for k, v in sorted(values.items())]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # for totals counted somewhere else, like the hits of a cache
+    def set_total(self, value: float, **labels: Any):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def merge(self, a: Any, b: Any) -> Any:
+        return a + b
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    # values are [count in each bucket (not cumulative), sum, count]
+    def observe(self, value: float, **labels: Any):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels: Any):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def merge(self, a: Any, b: Any) -> Any:
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def lines(self, values: Dict[LabelValues, Any]) -> List[str]:
+        lines = []
+        for k, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts + [count - sum(counts)]):
+                cumulative += n
+                labels = format_labels(self.labels + ("le",), k + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, k)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, k)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        # called before a snapshot is taken, to update metrics that are counted somewhere else
+        self.collectors: List[Callable[[], None]] = []
+
+    def _add(self, metric: Metric) -> Any:
+        assert(metric.name not in self.metrics)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self) -> Snapshot:
+        for collect in self.collectors:
+            collect()
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            with metric.lock:
+                snapshot[name] = copy.deepcopy(metric.values)
+        return snapshot
+
+    # in the Prometheus text format, with the snapshots of other processes merged in
+    def render(self, others: Sequence[Snapshot] = ()) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, metric in self.metrics.items():
+            values = snapshot[name]
+            for other in others:
+                for k, v in other.get(name, {}).items():
+                    values[k] = metric.merge(values[k], v) if k in values else v
+
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.lines(values))
+        return "\n".join(lines) + "\n"
+
+METRICS = Registry()
+
+STAGE_SECONDS = METRICS.histogram("calrender_stage_seconds", "Time spent in each stage of serving a wake or preparing a frame", ["stage"])
+CALENDAR_FETCH_SECONDS = METRICS.histogram("calrender_calendar_fetch_seconds", "Time spent downloading each calendar", ["calendar"])
+CALENDAR_PARSE_SECONDS = METRICS.histogram("calrender_calendar_parse_seconds", "Time spent parsing each calendar", ["calendar"])
+CALENDAR_ERRORS = METRICS.counter("calrender_calendar_errors_total", "Failed fetches of each calendar", ["calendar"])
+CALENDAR_LAST_SUCCESS = METRICS.gauge("calrender_calendar_last_success_timestamp_seconds", "When each calendar was last fetched successfully", ["calendar"])
+LAST_REFRESH = METRICS.gauge("calrender_last_refresh_timestamp_seconds", "When a frame was last prepared")
+CONNECTIONS = METRICS.counter("calrender_connections_total", "Connections from devices, by protocol", ["protocol"])
+ACTIVE_CONNECTIONS = METRICS.gauge("calrender_active_connections", "Connections being served")
+BYTES_SENT = METRICS.counter("calrender_bytes_sent_total", "Frame bytes sent to devices, by protocol", ["protocol"])
+CACHE_HITS = METRICS.counter("calrender_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = METRICS.counter("calrender_cache_misses_total", "Cache misses", ["cache"])
+CACHE_HIT_RATIO = METRICS.gauge("calrender_cache_hit_ratio", "Hits over lookups, since start", ["cache"])
+
+def observe_cache(cache: str, hits: int, misses: int):
+    CACHE_HITS.set_total(hits, cache=cache)
+    CACHE_MISSES.set_total(misses, cache=cache)
+    CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses > 0 else 0, cache=cache)
+
+# serves render() on /metrics from a background thread
+def serve_metrics(port: int, render: Callable[[], str], host: str = "127.0.0.1"):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
+
+def test_metrics():
+    r = Registry()
+    stages = r.histogram("stage_seconds", "stages", ["stage"], buckets=(0.1, 1))
+    sent = r.counter("bytes_total", "bytes")
+    active = r.gauge("active", "active")
+    hits = r.counter("hits_total", "hits", ["cache"])
+    r.collectors.append(lambda: hits.set_total(3, cache='ti"le'))
+
+    stages.observe(0.05, stage="fetch")
+    stages.observe(0.5, stage="fetch")
+    stages.observe(5, stage="fetch")
+    sent.inc(100)
+    active.inc()
+
+    other = Registry()
+    other_stages = other.histogram("stage_seconds", "stages", ["stage"], buckets=(0.1, 1))
+    other_stages.observe(0.05, stage="fetch")
+    other_stages.observe(0.05, stage="layout")
+    other.counter("bytes_total", "bytes").inc(20)
+
+    text = r.render([other.snapshot()])
+    assert text.splitlines() == [
+        "# HELP stage_seconds stages",
+        "# TYPE stage_seconds histogram",
+        'stage_seconds_bucket{stage="fetch",le="0.1"} 2',
+        'stage_seconds_bucket{stage="fetch",le="1"} 3',
+        'stage_seconds_bucket{stage="fetch",le="+Inf"} 4',
+        'stage_seconds_sum{stage="fetch"} 5.6',
+        'stage_seconds_count{stage="fetch"} 4',
+        'stage_seconds_bucket{stage="layout",le="0.1"} 1',
+        'stage_seconds_bucket{stage="layout",le="1"} 1',
+        'stage_seconds_bucket{stage="layout",le="+Inf"} 1',
+        'stage_seconds_sum{stage="layout"} 0.05',
+        'stage_seconds_count{stage="layout"} 1',
+        "# HELP bytes_total bytes",
+        "# TYPE bytes_total counter",
+        "bytes_total 120",
+        "# HELP active active",
+        "# TYPE active gauge",
+        "active 1",
+        "# HELP hits_total hits",
+        "# TYPE hits_total counter",
+        'hits_total{cache="ti\\"le"} 3',
+    ]
+
+def test_serve_metrics():
+    import urllib.request
+    import urllib.error
+
+    httpd = serve_metrics(0, lambda: "up 1\n")
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    with urllib.request.urlopen(url + "/metrics") as response:
+        assert response.read() == b"up 1\n"
+    try:
+        urllib.request.urlopen(url + "/")
+        assert False
+    except urllib.error.HTTPError as e:
+        assert e.code == 404
+    httpd.shutdown()
+
+if __name__ == "__main__":
+    test_metrics()
+    test_serve_metrics()
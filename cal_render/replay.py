@@ -0,0 +1,399 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, asdict
+from urllib.parse import urlsplit, urlunsplit
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import threading
+import time
+
+# record and replay of calendar fetches, for benchmarks that don't depend on the network
+#
+# a stand-in server is started for every upstream server (scheme, host and port) in the secrets
+# file, and calendar urls are rewritten to point at them. paths are kept as they are, so CalDAV
+# hrefs still resolve. in record mode requests are forwarded upstream and the responses saved to
+# an archive directory. in replay mode they're served from the archive, optionally slowed down
+# or failing
+#
+#   python replay.py record --archive fixtures/ -d 2025-01-20
+#   python replay.py bench --archive fixtures/ -d 2025-01-20 --latency 0.05
+#   python replay.py bench --archive fixtures/ -d 2025-01-20 --render -r 1 --max-rss 150
+#   python replay.py serve --archive fixtures/ --write-secrets replay.toml
+#   python main.py --secrets replay.toml -d 2025-01-20 serve
+
+METHODS = ["GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS", "PROPFIND", "REPORT"]
+# not saved or forwarded, they're about the connection and not the content. responses are saved
+# uncompressed, so accept-encoding isn't forwarded either
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "content-encoding", "accept-encoding", "host", "proxy-connection", "upgrade"}
+
+def origin(url: str) -> str:
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, "", "", ""))
+
+def with_origin(url: str, new_origin: str) -> str:
+    parts = urlsplit(url)
+    new = urlsplit(new_origin)
+    return urlunsplit((new.scheme, new.netloc, parts.path, parts.query, parts.fragment))
+
+@dataclass
+class Exchange:
+    origin: str
+    method: str
+    path: str
+    depth: Optional[str]
+    request_sha256: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body_file: str # in the archive directory
+
+    def key(self) -> Tuple[str, str, str, Optional[str], str]:
+        return (self.origin, self.method, self.path, self.depth, self.request_sha256)
+
+# recorded responses. bodies are stored in their own files, next to an index
+class FixtureArchive:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.exchanges: Dict[Tuple[str, str, str, Optional[str], str], Exchange] = {}
+
+        index = os.path.join(path, "index.json")
+        if os.path.exists(index):
+            with open(index, "r") as f:
+                for data in json.load(f):
+                    data["headers"] = [tuple(h) for h in data["headers"]]
+                    e = Exchange(**data)
+                    self.exchanges[e.key()] = e
+
+    @staticmethod
+    def request_key(origin: str, method: str, path: str, depth: Optional[str], body: bytes):
+        return (origin, method, path, depth, hashlib.sha256(body).hexdigest())
+
+    def get(self, key) -> Optional[Tuple[Exchange, bytes]]:
+        e = self.exchanges.get(key)
+        if e is None:
+            return None
+        with open(os.path.join(self.path, e.body_file), "rb") as f:
+            return e, f.read()
+
+    def put(self, key, status: int, headers: List[Tuple[str, str]], body: bytes):
+        origin, method, path, depth, request_sha256 = key
+        body_file = hashlib.sha256(repr(key).encode()).hexdigest()[:32] + ".body"
+        e = Exchange(
+            origin=origin,
+            method=method,
+            path=path,
+            depth=depth,
+            request_sha256=request_sha256,
+            status=status,
+            headers=headers,
+            body_file=body_file,
+        )
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, body_file), "wb") as f:
+                f.write(body)
+            self.exchanges[key] = e
+            tmp = os.path.join(self.path, "index.json.tmp")
+            with open(tmp, "w") as f:
+                json.dump([asdict(x) for x in self.exchanges.values()], f, indent=1)
+            os.replace(tmp, os.path.join(self.path, "index.json"))
+
+    def origins(self) -> List[str]:
+        return sorted({e.origin for e in self.exchanges.values()})
+
+# forwards a request upstream, returning status, headers and body
+def forward(url: str, method: str, headers: Dict[str, str], body: bytes) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    import urllib.request
+    import urllib.error
+
+    request = urllib.request.Request(url, data=body if len(body) > 0 else None, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, list(response.headers.items()), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, list(e.headers.items()), e.read()
+
+# an HTTP server standing in for upstream
+class StandIn:
+    def __init__(
+        self,
+        archive: FixtureArchive,
+        upstream: str, # origin
+        *,
+        record: bool = False,
+        latency: float = 0, # seconds added to every response
+        jitter: float = 0, # up to this many more seconds, at random
+        failure_rate: float = 0, # chance of responding 503 instead
+        seed: Optional[int] = None,
+        port: int = 0,
+    ):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        self.archive = archive
+        self.upstream = upstream
+        self.record = record
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.requests = 0
+        self.failures = 0
+        self.misses = 0
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_any(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, headers, response = standin.respond(self.command, self.path, dict(self.headers.items()), body)
+                self.send_response(status)
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        for method in METHODS:
+            setattr(Handler, f"do_{method}", Handler.handle_any)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.origin = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def respond(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        self.requests += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return 503, [("Content-Type", "text/plain")], b"injected failure\n"
+
+        lower = {k.lower(): v for k, v in headers.items()}
+        key = FixtureArchive.request_key(self.upstream, method, path, lower.get("depth"), body)
+        if self.record:
+            forwarded = {k: v for k, v in headers.items() if k.lower() not in HOP_HEADERS}
+            status, response_headers, response = forward(self.upstream + path, method, forwarded, body)
+            response_headers = [(k, v) for k, v in response_headers if k.lower() not in HOP_HEADERS]
+            self.archive.put(key, status, response_headers, response)
+        else:
+            got = self.archive.get(key)
+            if got is None:
+                self.misses += 1
+                print(f"replay: nothing recorded for {method} {self.upstream}{path}")
+                return 404, [("Content-Type", "text/plain")], b"not recorded\n"
+            exchange, response = got
+            status, response_headers = exchange.status, exchange.headers
+
+        # absolute urls to upstream should come back here
+        response = response.replace(self.upstream.encode(), self.origin.encode())
+        response_headers = [(k, v.replace(self.upstream, self.origin)) for k, v in response_headers]
+        return status, response_headers, response
+
+# stand-ins for every upstream of the calendars, and the calendars pointed at them
+def stand_in_for(secrets_data: Any, archive: FixtureArchive, **kwargs) -> Tuple[Any, Dict[str, StandIn]]:
+    upstreams = sorted({origin(cal["url"]) for cal in secrets_data["calendar"]} | set(archive.origins() if not kwargs.get("record") else []))
+    standins = {u: StandIn(archive, u, **kwargs) for u in upstreams}
+    rewritten = dict(secrets_data)
+    rewritten["calendar"] = [
+        {**cal, "url": with_origin(cal["url"], standins[origin(cal["url"])].origin)}
+        for cal in secrets_data["calendar"]
+    ]
+    return rewritten, standins
+
+def main():
+    import toml
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser("cal-render-replay", description="Records calendar fetches, and replays them from a local stand-in server")
+    parser.add_argument("mode", choices=["record", "replay", "serve", "bench"], help="record: fetch through the stand-ins and save the responses. replay: fetch once from the archive. serve: run the stand-ins until interrupted. bench: time repeated fetches from the archive")
+    parser.add_argument("--secrets", dest="secrets_path", default=os.path.join(os.path.dirname(__file__), "secrets.toml"))
+    parser.add_argument("--archive", required=True, help="Directory of recorded responses")
+    parser.add_argument("-d", "--date", default=None, help="Date (in YYYY-MM-DD) to fetch for. should be the same when recording and replaying")
+    parser.add_argument("-n", "--n-days", default=7, type=int)
+    parser.add_argument("--latency", default=0, type=float, help="Seconds added to every response")
+    parser.add_argument("--jitter", default=0, type=float, help="Up to this many more seconds, at random")
+    parser.add_argument("--failure-rate", default=0, type=float, help="Chance of a request failing with 503")
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("-r", "--rounds", default=10, type=int, help="Fetches to time, for bench")
+    parser.add_argument("--write-secrets", help="For serve, where to write a secrets file pointing at the stand-ins")
+    parser.add_argument("--render", action="store_true", help="For bench, render a frame after every fetch")
+    parser.add_argument("--memory", action="store_true", help="For bench, trace memory use of each stage, see memory.py. slow")
+    parser.add_argument("--max-rss", type=float, help="For bench, fail if the peak resident set size goes over this many MiB")
+    env = parser.parse_args()
+
+    from fetch_calendar import Secrets
+    day = datetime.strptime(env.date, "%Y-%m-%d").date() if env.date is not None else datetime.today().date()
+
+    archive = FixtureArchive(env.archive)
+    rewritten, standins = stand_in_for(
+        toml.load(open(env.secrets_path, "r")),
+        archive,
+        record=env.mode == "record",
+        latency=env.latency,
+        jitter=env.jitter,
+        failure_rate=env.failure_rate,
+        seed=env.seed,
+    )
+    for upstream, s in standins.items():
+        print(f"{upstream} -> {s.origin}")
+    secrets = Secrets.from_obj(rewritten)
+
+    if env.mode in ("record", "replay"):
+        events = secrets.load_events(day, env.n_days)
+        print(f"{len(events)} events, {len(archive.exchanges)} recorded responses")
+
+    elif env.mode == "serve":
+        if env.write_secrets is not None:
+            with open(env.write_secrets, "w") as f:
+                toml.dump(rewritten, f)
+            print(f"wrote {env.write_secrets}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+    over_budget = None
+    if env.mode == "bench":
+        from timing import Timer
+        from memory import MEMORY, peak_rss
+
+        if env.memory:
+            MEMORY.start()
+        timer = Timer(enabled=False)
+        what = "render" if env.render else "fetch"
+
+        times = []
+        failed = 0
+        for _ in range(env.rounds):
+            t0 = time.perf_counter()
+            try:
+                with timer.stage("fetch"):
+                    table = secrets.load_table(day, env.n_days)
+                if env.render:
+                    render_frame(table, timer)
+            except Exception as e:
+                failed += 1
+                print(f"{what} failed: {e}")
+                continue
+            finally:
+                timer.print_report()
+            times.append(time.perf_counter() - t0)
+        if len(times) > 0:
+            print(f"{what}: min {min(times) * 1000:.1f} ms, median {statistics.median(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms")
+        print(f"{len(times)} ok, {failed} failed, {sum(s.requests for s in standins.values())} requests, {sum(s.misses for s in standins.values())} not recorded")
+
+        rss = peak_rss()
+        print(f"peak rss {rss / 2**20:.1f} MiB")
+        if env.max_rss is not None and rss > env.max_rss * 2**20:
+            over_budget = f"peak rss {rss / 2**20:.1f} MiB is over the budget of {env.max_rss} MiB"
+
+    for s in standins.values():
+        s.close()
+    if over_budget is not None:
+        raise SystemExit(over_budget)
+
+# the frame of the default display, the way serve renders it
+def render_frame(table, timer) -> bytes:
+    from dedup import dedup
+    from frame_cache import canonical_order
+    from layout import CalendarCanvas, Schedule
+    from serve import encode_chunks
+    from display import DEFAULT_DISPLAY
+    from data import Rectangle
+
+    with timer.stage("dedup"):
+        events = canonical_order(dedup(table).to_events())
+    with timer.stage("schedule"):
+        schedule = Schedule.from_events(events)
+    with timer.stage("layout"):
+        c = CalendarCanvas(bounding_rect=Rectangle(x0=0, y0=0, x1=DEFAULT_DISPLAY.width, y1=DEFAULT_DISPLAY.height), schedule=schedule)
+    with timer.stage("rasterize"):
+        return b"".join(encode_chunks(c))
+
+def test_record_replay():
+    import tempfile
+    import urllib.request
+    import urllib.error
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Upstream(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.reply(f"get {self.path} at {upstream_origin}/x".encode())
+
+        def do_REPORT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.reply(b"report " + body + b" depth " + self.headers["Depth"].encode())
+
+        def reply(self, body: bytes):
+            self.send_response(207 if self.command == "REPORT" else 200)
+            self.send_header("Content-Type", "text/calendar")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    upstream_origin = f"http://127.0.0.1:{upstream.server_address[1]}"
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    def fetch(origin: str, path: str, method: str = "GET", body: Optional[bytes] = None, headers: Dict[str, str] = {}):
+        request = urllib.request.Request(origin + path, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    with tempfile.TemporaryDirectory() as d:
+        secrets = {"calendar": [{"url": upstream_origin + "/cal.ics", "is_caldav": False}]}
+        rewritten, standins = stand_in_for(secrets, FixtureArchive(d), record=True)
+        s = standins[upstream_origin]
+        assert rewritten["calendar"][0]["url"] == s.origin + "/cal.ics"
+        recorded = [
+            fetch(s.origin, "/cal.ics"),
+            fetch(s.origin, "/dav/", "REPORT", b"<q/>", {"Depth": "1"}),
+        ]
+        assert recorded[0] == (200, f"get /cal.ics at {s.origin}/x".encode())
+        assert recorded[1] == (207, b"report <q/> depth 1")
+        s.close()
+        upstream.shutdown()
+        upstream.server_close()
+
+        # upstream is gone, and the archive is read back from disk
+        _, standins = stand_in_for(secrets, FixtureArchive(d), latency=0.05)
+        s = standins[upstream_origin]
+        t0 = time.perf_counter()
+        assert fetch(s.origin, "/cal.ics") == (200, f"get /cal.ics at {s.origin}/x".encode())
+        assert time.perf_counter() - t0 >= 0.05
+        assert fetch(s.origin, "/dav/", "REPORT", b"<q/>", {"Depth": "1"}) == recorded[1]
+        assert fetch(s.origin, "/dav/", "REPORT", b"<q/>", {"Depth": "0"})[0] == 404
+        assert s.misses == 1
+        s.close()
+
+        _, standins = stand_in_for(secrets, FixtureArchive(d), failure_rate=1)
+        s = standins[upstream_origin]
+        assert fetch(s.origin, "/cal.ics")[0] == 503
+        assert s.failures == 1
+        s.close()
+
+if __name__ == "__main__":
+    main()
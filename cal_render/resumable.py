@@ -0,0 +1,206 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import random
+import socket
+import struct
+import zlib
+
+from serve import TRANSACTION_SIZE
+
+# resumable transfers. an alternative to the firmware's protocol, told apart by the hello
+#
+# client: HELLO, frame id (zeros if none), index of the next chunk it needs
+# server: "hewwo", frame id, number of chunks, chunk size, index of the first chunk it'll send
+# then, for each chunk:
+#   server: index, length, crc32, data
+#   client: index, once the crc has been checked
+# the server keeps up to WINDOW chunks unacknowledged. if the connection drops, the client can
+# reconnect with the same frame id and get the rest of that same frame, from the first chunk it
+# hasn't acknowledged
+
+HELLO = b"hii^-^"
+CLIENT_HELLO = struct.Struct("!8sI")
+SERVER_HELLO = struct.Struct("!8sIII")
+CHUNK_HEADER = struct.Struct("!III")
+ACK = struct.Struct("!I")
+NO_FRAME = bytes(8)
+WINDOW = 4
+
+def frame_id(key: str) -> bytes:
+    return bytes.fromhex(key[:16])
+
+def recv_exact(conn: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        got = conn.recv(n - len(buf))
+        if len(got) == 0:
+            raise ConnectionError(f"connection closed after {len(buf)} of {n} bytes")
+        buf.extend(got)
+    return bytes(buf)
+
+# frames that have been sent recently, and how far each device got with them
+class TransferSessions:
+    def __init__(self, max_frames: int = 4):
+        self.max_frames = max_frames
+        self.frames: OrderedDict[bytes, bytes] = OrderedDict()
+        self.sent: Dict[Tuple[str, bytes], int] = {} # number of chunks sent to each device
+
+    def retain(self, fid: bytes, frame: bytes):
+        self.frames[fid] = frame
+        self.frames.move_to_end(fid)
+        while len(self.frames) > self.max_frames:
+            old, _ = self.frames.popitem(last=False)
+            self.sent = {k: v for k, v in self.sent.items() if k[1] != old}
+
+    def get(self, fid: bytes) -> Optional[bytes]:
+        return self.frames.get(fid)
+
+# server side. conn has already sent HELLO. get_frame gives (key, frame) of a fresh frame,
+# only called if the client isn't resuming. on_sent is called with the size of each chunk sent
+# returns the frame once the client has all of it
+def serve(conn: socket.socket, device: str, sessions: TransferSessions, get_frame, chunk_size: int = TRANSACTION_SIZE, on_sent=None) -> bytes:
+    fid, next_chunk = CLIENT_HELLO.unpack(recv_exact(conn, CLIENT_HELLO.size))
+
+    frame = sessions.get(fid) if fid != NO_FRAME else None
+    if frame is not None:
+        # the client knows what it has acknowledged, acks in flight may have been lost when the
+        # connection dropped. it can't have more than what we sent it though
+        start = min(next_chunk, sessions.sent.get((device, fid), 0))
+        print(f"resuming frame {fid.hex()} from chunk {start}")
+    else:
+        key, frame = get_frame()
+        fid = frame_id(key)
+        sessions.retain(fid, frame)
+        start = 0
+
+    n_chunks = -(-len(frame) // chunk_size)
+    conn.sendall(b"hewwo" + SERVER_HELLO.pack(fid, n_chunks, chunk_size, start))
+
+    def send_chunk(i: int):
+        data = frame[i * chunk_size:(i + 1) * chunk_size]
+        conn.sendall(CHUNK_HEADER.pack(i, len(data), zlib.crc32(data)) + data)
+        sessions.sent[(device, fid)] = max(sessions.sent.get((device, fid), 0), i + 1)
+        if on_sent is not None:
+            on_sent(len(data))
+
+    acked = start
+    sent = start
+    while acked < n_chunks:
+        while sent < n_chunks and sent - acked < WINDOW:
+            send_chunk(sent)
+            sent += 1
+        (i,) = ACK.unpack(recv_exact(conn, ACK.size))
+        if i != acked:
+            raise ConnectionError(f"expected ack for chunk {acked}, got {i}")
+        acked += 1
+    return frame
+
+# reference client. keeps what it has received between connections. source is the address to
+# connect from, the server picks the display by it
+class ResumableClient:
+    def __init__(self, host: str, port: int, source: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.source = source
+        self.fid = NO_FRAME
+        self.chunks: Dict[int, bytes] = {}
+        self.n_chunks: Optional[int] = None
+
+        self.connections = 0
+        self.chunks_received = 0
+
+    def next_chunk(self) -> int:
+        i = 0
+        while i in self.chunks:
+            i += 1
+        return i
+
+    def done(self) -> bool:
+        return self.n_chunks is not None and len(self.chunks) == self.n_chunks
+
+    # one connection. drop_after simulates the connection going away after that many chunks
+    def connect(self, drop_after: Optional[int] = None):
+        self.connections += 1
+        with socket.create_connection((self.host, self.port), source_address=None if self.source is None else (self.source, 0)) as s:
+            s.sendall(HELLO + CLIENT_HELLO.pack(self.fid, self.next_chunk()))
+            if recv_exact(s, 5) != b"hewwo":
+                raise ConnectionError("incorrect handshake")
+            fid, n_chunks, chunk_size, start = SERVER_HELLO.unpack(recv_exact(s, SERVER_HELLO.size))
+            if fid != self.fid:
+                # a different frame than what we have
+                self.fid = fid
+                self.chunks = {}
+            self.n_chunks = n_chunks
+
+            received = 0
+            for expected in range(start, n_chunks):
+                if drop_after is not None and received >= drop_after:
+                    return
+                i, length, crc = CHUNK_HEADER.unpack(recv_exact(s, CHUNK_HEADER.size))
+                data = recv_exact(s, length)
+                if i != expected or zlib.crc32(data) != crc:
+                    raise ConnectionError(f"bad chunk {i}")
+                self.chunks[i] = data
+                self.chunks_received += 1
+                received += 1
+                s.sendall(ACK.pack(i))
+
+    # reconnects until the whole frame has arrived, dropping the connection at random
+    def fetch(self, drop_rate: float = 0, max_connections: int = 100) -> bytes:
+        while not self.done():
+            if self.connections >= max_connections:
+                raise ConnectionError("giving up")
+            drop_after = None
+            if random.random() < drop_rate:
+                drop_after = random.randrange(self.n_chunks or 64) # don't know the size before the first connection
+            try:
+                self.connect(drop_after)
+            except (OSError, ConnectionError) as e:
+                print(f"connection failed: {e}")
+        return b"".join(self.chunks[i] for i in range(len(self.chunks)))
+
+def test_resume():
+    import threading
+
+    frame = bytes(random.randrange(7) for _ in range(10 * 1000))
+    n_fresh = 0
+    def get_frame():
+        nonlocal n_fresh
+        n_fresh += 1
+        return "ab" * 32, frame
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    sessions = TransferSessions()
+
+    def run():
+        while True:
+            conn, addr = server.accept()
+            with conn:
+                if recv_exact(conn, len(HELLO)) != HELLO:
+                    return
+                try:
+                    serve(conn, addr[0], sessions, get_frame, chunk_size=1000)
+                except (OSError, ConnectionError):
+                    pass
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+    client = ResumableClient("127.0.0.1", server.getsockname()[1])
+    client.connect(drop_after=3)
+    client.connect(drop_after=4)
+    assert len(client.chunks) == 7 and not client.done()
+    assert client.fetch() == frame
+    assert client.chunks_received == 10 # nothing sent twice
+    assert n_fresh == 1 # and rendered once
+
+    with socket.create_connection(server.getsockname()) as s:
+        s.sendall(b"bye!!!")
+    t.join()
+    server.close()
+
+if __name__ == "__main__":
+    test_resume()
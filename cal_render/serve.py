@@ -1,20 +1,628 @@
+from __future__ import annotations
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from dataclasses import dataclass
+from datetime import date
+import queue
+import socket
+import threading
+import time
+import traceback
+
 from canvas import Canvas, Background, CANVAS_WIDTH, CANVAS_HEIGHT
+from display import Display, DEFAULT_DISPLAY, display_for
+from frame_cache import FrameCache, frame_key, canonical_order
+from frame_archive import FrameArchive
+from wakes import WakeHistory, RefreshPolicy
+from timing import Timer
+from metrics import METRICS, Snapshot, LAST_REFRESH, CONNECTIONS, ACTIVE_CONNECTIONS, BYTES_SENT, observe_cache
 
-import socket
-from tqdm import tqdm
+# how much the display reads at a time, see eink_bridge/main/eink_bridge.c
+TRANSACTION_SIZE = 800 // 2 * 20
+
+# after a failed fetch or render, how long to wait before trying again. doubles with every failure
+RETRY_MIN = 60
+RETRY_MAX = 30 * 60
+
+# pixels in the order and encoding the display wants them, see display.Display. for the default
+# display that's palette indices, columns from right to left, top to bottom
+# rasterized lazily, chunk_size bytes at a time
+def encode_chunks(c: Canvas, chunk_size: int = TRANSACTION_SIZE, display: Display = DEFAULT_DISPLAY) -> Iterator[bytes]:
+    chunk = bytearray()
+    for xs, ys in display.lines():
+        chunk.extend(display.encode_line(bytes(c(x, y).to_screen_color_idx() for x, y in zip(xs, ys))))
+        while len(chunk) >= chunk_size:
+            yield bytes(chunk[:chunk_size])
+            del chunk[:chunk_size]
+    if len(chunk) > 0:
+        yield bytes(chunk)
+
+def encode(c: Canvas, display: Display = DEFAULT_DISPLAY) -> bytes:
+    from tqdm import tqdm
+
+    n_chunks = -(-display.frame_size() // TRANSACTION_SIZE)
+    return b"".join(tqdm(encode_chunks(c, display=display), total=n_chunks, unit="chunk"))
+
+# sends chunks while the next ones are being produced in another thread. returns everything sent
+def stream(conn: socket.socket, chunks: Iterator[bytes], depth: int = 2) -> bytes:
+    q: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                q.put(chunk)
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            q.put(e)
+            return
+        q.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    sent = []
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            conn.sendall(item)
+            sent.append(item)
+    except BaseException:
+        # unblock the producer so it can notice
+        stop.set()
+        while producer.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise
 
-def send(conn: socket.socket, c: Canvas):
+    return b"".join(sent)
+
+# inverse of encode, as an image
+def decode(frame: bytes, display: Display = DEFAULT_DISPLAY):
+    from PIL import Image
+    import numpy as np
+    from data import SCREEN_COLORS
+
+    rows = np.ascontiguousarray(display.decode(frame), dtype=np.uint8)
+    img = Image.frombytes("P", (display.width, display.height), rows.tobytes())
+    img.putpalette([channel for color in SCREEN_COLORS for channel in color.rgb()])
+    return img
+
+def handshake(conn: socket.socket) -> bool:
     header = conn.recv(6)
     if header != b"hii^_^":
         print("incorrect handshake:", repr(header))
-        return
+        return False
 
     print("correct handshake. sending back")
     conn.send(b"hewwo")
+    return True
+
+def send(conn: socket.socket, frame: bytes):
+    if not handshake(conn):
+        return
 
     print("sending image")
-    for i in tqdm(range(CANVAS_HEIGHT * CANVAS_WIDTH), unit="px", unit_scale=True):
-        y = i % CANVAS_HEIGHT
-        x = CANVAS_WIDTH - (i // CANVAS_HEIGHT) - 1
-        col = c(x, y)
-        conn.send(bytes([col.to_screen_color_idx()]))
+    conn.sendall(frame)
+
+# a rendered frame, ready to be sent. if frame is None, canvas still needs to be rasterized
+@dataclass
+class Prepared:
+    key: str
+    frame: Optional[bytes]
+    day: date
+    made_at: float
+
+    canvas: Optional[Canvas] = None
+    on_rasterized: Optional[Callable[[bytes], None]] = None
+    display: Display = DEFAULT_DISPLAY
+
+    def _rasterized(self, frame: bytes):
+        self.frame = frame
+        self.canvas = None
+        if self.on_rasterized is not None:
+            self.on_rasterized(frame)
+
+    def snapshot(self) -> Tuple[str, bytes]:
+        return self.key, self.rasterize()
+
+    def rasterize(self) -> bytes:
+        if self.frame is None:
+            assert(self.canvas is not None)
+            self._rasterized(encode(self.canvas, self.display))
+        return self.frame # type: ignore
+
+    # if the frame isn't rasterized yet, the first chunks are sent while the rest are rasterized.
+    # returns the frame sent
+    def send_to(self, conn: socket.socket) -> Optional[bytes]:
+        if self.frame is not None:
+            conn.sendall(self.frame)
+            return self.frame
+        assert(self.canvas is not None)
+        self._rasterized(stream(conn, encode_chunks(self.canvas, display=self.display)))
+        return self.frame
+
+# fetches calendars and renders frames for each display, ahead of time if it knows when devices
+# will wake up. events are fetched and scheduled once for all displays. when only some events
+# changed, only the rows they're on are rasterized again
+class Renderer:
+    def __init__(
+        self,
+        *,
+        secrets_path: str,
+        n_days: int,
+        dark_mode: bool,
+        render_date: Callable[[], date],
+        frame_cache: FrameCache,
+        wakes: WakeHistory,
+        policy: RefreshPolicy,
+        timer: Timer,
+        pixels_per_hour: int = 50,
+        pixels_per_break: int = 30,
+        streaming: bool = False,
+        displays: Optional[List[Display]] = None,
+        layout: str = "window", # see layout.make_schedule
+    ):
+        self.secrets_path = secrets_path
+        self.n_days = n_days
+        self.dark_mode = dark_mode
+        self.render_date = render_date
+        self.frame_cache = frame_cache
+        self.wakes = wakes
+        self.policy = policy
+        self.timer = timer
+        self.pixels_per_hour = pixels_per_hour
+        self.pixels_per_break = pixels_per_break
+        self.streaming = streaming # rasterize frames for waiting devices while sending them
+        self.displays = displays if displays is not None else [DEFAULT_DISPLAY]
+        self.layout = layout
+
+        from fetch_calendar import SecretsWatcher, FetchCache
+
+        self.secrets = SecretsWatcher(secrets_path)
+        self.fetch_cache = FetchCache() # for renders after the secrets changed, see frame_for_wake
+        self.prepared: Dict[str, Prepared] = {} # by display name
+        self.frame_states: Dict[str, FrameState] = {} # last rasterized frame of each display, see damage.py
+        self.failures = 0 # renders in a row that failed
+        self.retry_at: Optional[float] = None # no renders before this, after a failure
+        METRICS.collectors.append(self.collect_metrics)
+
+    # parses the secrets file again if it changed, and forgets what was fetched for calendars that
+    # are gone. returns whether anything changed
+    def reload_secrets(self) -> bool:
+        with self.timer.stage("secrets"):
+            change = self.secrets.check()
+        if change is None:
+            return False
+        print(f"Secrets changed: {len(change.refetch)} calendars to fetch, {len(change.restyled)} restyled, {len(change.removed)} removed")
+        for cal in change.removed:
+            self.fetch_cache.invalidate(cal.source_key())
+        return True
+
+    # a frame for each display, by name. lazy leaves rasterizing to whoever uses the frame. calendars
+    # fetched less than fetch_max_age seconds ago aren't fetched again, by default all are
+    def render(self, lazy: bool = False, fetch_max_age: Optional[float] = None) -> Dict[str, Prepared]:
+        from dedup import dedup
+
+        day = self.render_date()
+        self.reload_secrets()
+        secrets = self.secrets.load()
+
+        with self.timer.stage("fetch"):
+            table = secrets.load_table(day, self.n_days, self.fetch_cache, fetch_max_age)
+
+        with self.timer.stage("dedup"):
+            events = canonical_order(dedup(table).to_events())
+
+        schedule = None # only computed if some display needs rendering
+        prepared = {}
+        for display in self.displays:
+            key = frame_key(
+                events,
+                day=day,
+                n_days=self.n_days,
+                dark_mode=self.dark_mode,
+                pixels_per_hour=self.pixels_per_hour,
+                pixels_per_break=self.pixels_per_break,
+                display=display,
+                layout=self.layout,
+            )
+            frame = self.frame_cache.get(key)
+            if frame is not None:
+                print(f"Using cached frame {key[:12]} for {display.name}")
+                prepared[display.name] = Prepared(key=key, frame=frame, day=day, made_at=time.time(), display=display)
+                continue
+
+            print(f"Rendering frame {key[:12]} for {display.name}")
+            from layout import CalendarCanvas, make_schedule
+            from data import Rectangle
+            from damage import FrameState, rerender
+
+            if schedule is None:
+                with self.timer.stage("schedule"):
+                    schedule = make_schedule(events, self.layout)
+
+            with self.timer.stage("layout"):
+                c = CalendarCanvas(
+                    bounding_rect=Rectangle(x0=0, y0=0, x1=display.width, y1=display.height),
+                    schedule=schedule,
+                    dark_mode=self.dark_mode,
+                    pixels_per_hour=self.pixels_per_hour,
+                    pixels_per_break=self.pixels_per_break,
+                )
+
+            params = (self.dark_mode, self.pixels_per_hour, self.pixels_per_break)
+            with self.timer.stage("rerender"):
+                rerendered = rerender(self.frame_states.get(display.name), c, display, params)
+            if rerendered is not None:
+                frame, self.frame_states[display.name] = rerendered
+                self.frame_cache.put(key, frame)
+                prepared[display.name] = Prepared(key=key, frame=frame, day=day, made_at=time.time(), display=display)
+                continue
+
+            def on_rasterized(frame: bytes, key=key, c=c, display=display, params=params):
+                self.frame_cache.put(key, frame)
+                self.frame_states[display.name] = FrameState.from_frame(frame, c, display, params)
+
+            p = Prepared(
+                key=key,
+                frame=None,
+                day=day,
+                made_at=time.time(),
+                canvas=c,
+                on_rasterized=on_rasterized,
+                display=display,
+            )
+            if not lazy:
+                with self.timer.stage("rasterize"):
+                    p.rasterize()
+            prepared[display.name] = p
+        return prepared
+
+    # render, backing off when it fails. the exception is raised again
+    def try_render(self, lazy: bool = False, fetch_max_age: Optional[float] = None) -> Dict[str, Prepared]:
+        try:
+            prepared = self.render(lazy=lazy, fetch_max_age=fetch_max_age)
+        except Exception:
+            self.failures += 1
+            delay = min(RETRY_MIN * 2 ** (self.failures - 1), RETRY_MAX)
+            self.retry_at = time.time() + delay
+            print(f"Rendering failed, {self.failures} in a row. not trying again for {delay:.0f}s")
+            raise
+        self.failures = 0
+        self.retry_at = None
+        return prepared
+
+    # fetches and renders, and remembers the results for the next wakes
+    def refresh(self, lazy: bool = False) -> Dict[str, Prepared]:
+        prepared = self.try_render(lazy=lazy)
+        if len(self.prepared) > 0:
+            self.policy.observe(changed=any(p.key != self.prepared[name].key for name, p in prepared.items() if name in self.prepared))
+        self.prepared = prepared
+        LAST_REFRESH.set(min(p.made_at for p in prepared.values()))
+        return prepared
+
+    # the prepared frame for the device's display if it's recent enough, otherwise a fresh one. if
+    # rendering fails, or failed recently, the last prepared frame is used however old it is
+    def frame_for_wake(self, device: Optional[str] = None) -> Prepared:
+        now = time.time()
+        display = display_for(self.displays, device)
+        p = self.prepared.get(display.name)
+        if p is not None and self.retry_at is not None and now < self.retry_at:
+            print(f"Using prepared frame for {display.name} from {now - p.made_at:.0f}s ago, rendering failed recently")
+            return p
+
+        try:
+            if p is not None and p.day == self.render_date() and now - p.made_at <= self.policy.max_age():
+                if not self.reload_secrets():
+                    print(f"Using prepared frame for {display.name} from {now - p.made_at:.0f}s ago")
+                    return p
+
+                # the calendars are recent enough, only the ones fetching something new are fetched
+                made_at = min(q.made_at for q in self.prepared.values())
+                prepared = self.try_render(lazy=self.streaming, fetch_max_age=self.policy.max_age())
+                for q in prepared.values():
+                    q.made_at = min(q.made_at, made_at) # no fresher than what it was made from
+                self.prepared = prepared
+                return prepared[display.name]
+            return self.refresh(lazy=self.streaming)[display.name]
+        except Exception:
+            if p is None:
+                raise
+            traceback.print_exc()
+            print(f"Using prepared frame for {display.name} from {now - p.made_at:.0f}s ago instead")
+            return p
+
+    # seconds until we should prepare a frame for the next expected wake, None if there's no need
+    def time_to_refresh(self) -> Optional[float]:
+        now = time.time()
+        wake = self.wakes.next_wake_any(now)
+        if wake is None:
+            return None
+        made_at = min(p.made_at for p in self.prepared.values()) if len(self.prepared) > 0 else None
+        at = self.policy.refresh_at(wake, made_at)
+        if at is None:
+            return None
+        if self.retry_at is not None:
+            at = max(at, self.retry_at)
+        return max(0, at - now)
+
+    # returns when the device is expected to wake up next
+    def record_wake(self, device: str, t: float) -> Optional[float]:
+        self.wakes.record(device, t)
+        return self.wakes.next_wake(device, t)
+
+    def stats(self) -> str:
+        from tiles import TILE_CACHE
+        return f"Tile cache: {TILE_CACHE.stats()}, frame cache: {self.frame_cache.stats()}"
+
+    def collect_metrics(self):
+        from tiles import TILE_CACHE
+        from titles import PIPELINES
+        from layout import DAY_SCHEDULES
+
+        observe_cache("tile", TILE_CACHE.hits, TILE_CACHE.misses)
+        observe_cache("frame", self.frame_cache.hits, self.frame_cache.misses)
+        observe_cache("title", sum(p.hits for p in PIPELINES.values()), sum(p.misses for p in PIPELINES.values()))
+        observe_cache("day_schedule", DAY_SCHEDULES.hits, DAY_SCHEDULES.misses)
+        observe_cache("fetch", self.fetch_cache.hits, self.fetch_cache.misses)
+
+    # metrics recorded outside of this process. there are none, they're all in METRICS
+    def metrics_snapshot(self) -> Optional[Snapshot]:
+        return None
+
+# talks to the devices. renderer is either a Renderer, or a shared_frame.RendererProcess
+class Server:
+    def __init__(
+        self,
+        *,
+        port: int,
+        renderer,
+        timer: Timer,
+        archive: Optional[FrameArchive] = None, # keeps every frame sent
+        displays: Optional[List[Display]] = None, # of the renderer, to know how archived frames are encoded
+    ):
+        import resumable
+
+        self.port = port
+        self.renderer = renderer
+        self.timer = timer
+        self.sessions = resumable.TransferSessions()
+        self.archive = archive
+        self.displays = displays if displays is not None else [DEFAULT_DISPLAY]
+
+    def archive_frame(self, device: str, frame: bytes):
+        if self.archive is None:
+            return
+        with self.timer.stage("archive"):
+            self.archive.append(device, frame, display_for(self.displays, device))
+
+    # nothing going wrong with one connection stops the server
+    def handle(self, conn: socket.socket, addr):
+        ACTIVE_CONNECTIONS.inc()
+        try:
+            with self.timer.stage("wake"):
+                self._handle(conn, addr)
+        except Exception:
+            traceback.print_exc()
+            print(f"Failed to serve {addr[0]}")
+        finally:
+            conn.close()
+            ACTIVE_CONNECTIONS.dec()
+
+    def _handle(self, conn: socket.socket, addr):
+        import resumable
+
+        next_wake = self.renderer.record_wake(addr[0], time.time())
+        print(f"Connection from {addr}")
+
+        hello = conn.recv(6)
+        if hello == b"hii^_^":
+            CONNECTIONS.inc(protocol="firmware")
+            print("correct handshake. sending back")
+            conn.send(b"hewwo") # before the frame is ready, the device waits for it either way
+            frame = self.renderer.frame_for_wake(addr[0])
+            print(f"Sending content")
+            with self.timer.stage("send"):
+                sent = frame.send_to(conn)
+            if sent is not None: # exactly what was sent, a split renderer may have published another frame since
+                BYTES_SENT.inc(len(sent), protocol="firmware")
+                self.archive_frame(addr[0], sent)
+        elif hello == resumable.HELLO:
+            CONNECTIONS.inc(protocol="resumable")
+            print("resumable transfer")
+            with self.timer.stage("send"):
+                try:
+                    sent = resumable.serve(
+                        conn, addr[0], self.sessions, lambda: self.renderer.frame_for_wake(addr[0]).snapshot(),
+                        on_sent=lambda n: BYTES_SENT.inc(n, protocol="resumable"),
+                    )
+                except (OSError, ConnectionError) as e:
+                    print(f"transfer interrupted: {e}")
+                else:
+                    self.archive_frame(addr[0], sent)
+        else:
+            CONNECTIONS.inc(protocol="invalid")
+            print("incorrect handshake:", repr(hello))
+
+        print(self.renderer.stats())
+        print(f"Closing connection")
+        conn.close()
+
+        if next_wake is not None:
+            print(f"Expecting {addr[0]} back in {next_wake - time.time():.0f}s")
+
+    def run(self, once: bool = False):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", self.port))
+        s.listen(1)
+        print(f"Listening on port {self.port}")
+        self.timer.print_report()
+
+        try:
+            while True:
+                timeout = self.renderer.time_to_refresh()
+                try:
+                    if timeout is not None and timeout <= 0:
+                        raise socket.timeout() # settimeout(0) would make accept non-blocking instead
+                    s.settimeout(timeout)
+                    conn, addr = s.accept()
+                except socket.timeout:
+                    print(f"Preparing frame ahead of next wake")
+                    try:
+                        self.renderer.refresh()
+                    except Exception:
+                        traceback.print_exc() # renderer backs off, the last frame is served meanwhile
+                    self.timer.print_report()
+                    continue
+
+                conn.settimeout(None)
+                self.handle(conn, addr)
+                self.timer.print_report()
+
+                if once:
+                    break
+        finally:
+            s.close()
+
+def test_stream():
+    a, b = socket.socketpair()
+    chunks = [bytes([i]) * 1000 for i in range(20)]
+
+    received = bytearray()
+    def receive():
+        while len(received) < 20 * 1000:
+            received.extend(b.recv(4096))
+    t = threading.Thread(target=receive)
+    t.start()
+    assert stream(a, iter(chunks)) == b"".join(chunks)
+    t.join()
+    assert received == b"".join(chunks)
+
+    def failing():
+        yield b"x"
+        raise ValueError("oops")
+    try:
+        stream(a, failing())
+        assert False
+    except ValueError:
+        pass
+    a.close()
+    b.close()
+
+def test_fetch_errors():
+    import os
+    import tempfile
+    from datetime import datetime
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from metrics import CALENDAR_ERRORS
+
+    ics = "\r\n".join([
+        "BEGIN:VCALENDAR", "VERSION:2.0",
+        "BEGIN:VEVENT", "UID:a", "SUMMARY:Möte", "DTSTART:20250120T100000", "DTEND:20250120T110000", "END:VEVENT",
+        "END:VCALENDAR", "",
+    ]).encode()
+    failing = False
+    requests_made = 0
+
+    class Feed(BaseHTTPRequestHandler):
+        def do_GET(self):
+            nonlocal requests_made
+            requests_made += 1
+            self.send_response(503 if failing else 200)
+            self.send_header("Content-Length", "0" if failing else str(len(ics)))
+            self.end_headers()
+            if not failing:
+                self.wfile.write(ics)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Feed)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    display = Display(name="small", width=120, height=160, encoding="p4")
+
+    with tempfile.TemporaryDirectory() as d:
+        secrets_path = os.path.join(d, "secrets.toml")
+        with open(secrets_path, "w") as f:
+            f.write(f'[[calendar]]\nname = "flaky"\nis_caldav = false\nurl = "http://127.0.0.1:{httpd.server_address[1]}/cal.ics"\ncolor1 = "BLUE"\ncolor2 = "RED"\n')
+
+        timer = Timer(enabled=False)
+        renderer = Renderer(
+            secrets_path=secrets_path,
+            n_days=1,
+            dark_mode=False,
+            render_date=lambda: date(2025, 1, 20),
+            frame_cache=FrameCache(os.path.join(d, "frames")),
+            wakes=WakeHistory(),
+            policy=RefreshPolicy(),
+            timer=timer,
+            displays=[display],
+        )
+        server = Server(port=0, renderer=renderer, timer=timer, displays=[display])
+
+        # what a device gets when it wakes up, b"" if the connection is closed before the frame
+        def wake() -> bytes:
+            a, b = socket.socketpair()
+            a.sendall(b"hii^_^")
+            server.handle(b, ("10.0.0.2", 1234))
+            received = bytearray()
+            while True:
+                chunk = a.recv(65536)
+                if len(chunk) == 0:
+                    break
+                received.extend(chunk)
+            a.close()
+            assert received.startswith(b"hewwo") # even when there's no frame to send
+            return bytes(received[len(b"hewwo"):])
+
+        errors = lambda: CALENDAR_ERRORS.values.get(("flaky",), 0)
+        errors_before = errors()
+
+        frame = wake()
+        assert len(frame) == display.frame_size()
+
+        # the prepared frame is too old and fetching it again fails, the old one is sent
+        failing = True
+        renderer.prepared["small"].made_at -= 24 * 60 * 60
+        assert wake() == frame
+        assert errors() == errors_before + 1
+        assert renderer.retry_at is not None and renderer.retry_at > time.time()
+
+        # while backing off, nothing is fetched
+        made = requests_made
+        assert wake() == frame
+        assert requests_made == made and errors() == errors_before + 1
+
+        # with nothing to send, the connection is closed and the server keeps going
+        renderer.prepared.clear()
+        assert wake() == b""
+        assert errors() == errors_before + 2
+
+        # and when the calendar is back, so are new frames
+        failing = False
+        renderer.retry_at = None
+        assert wake() == frame
+        assert renderer.failures == 0
+    httpd.shutdown()
+
+def test_encode_chunks():
+    from data import Color
+
+    class Stripes(Canvas):
+        def __call__(self, x: int, y: int) -> Color:
+            return Color.RED if (x + 2 * y) % 7 == 0 else Color.WHITE
+
+    chunks = list(encode_chunks(Stripes()))
+    assert all(len(c) == TRANSACTION_SIZE for c in chunks)
+    frame = b"".join(chunks)
+    assert frame[0] == Stripes()(CANVAS_WIDTH - 1, 0).to_screen_color_idx()
+    assert frame[CANVAS_HEIGHT + 5] == Stripes()(CANVAS_WIDTH - 2, 5).to_screen_color_idx()
+    assert b"".join(encode_chunks(Stripes(), chunk_size=777)) == frame
@@ -0,0 +1,376 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass
+import fcntl
+import mmap
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import traceback
+
+# a file with two frame slots, shared between the renderer process (writing) and the server
+# process (reading). the renderer always writes the slot that isn't the newest one, and bumps the
+# generation when it's done. each slot is protected by a byte-range lock, so a reader holding a
+# slot can't have it overwritten under it, and never sees a half-written frame
+#
+# layout:
+#   0:            magic, slot size, generation of the newest frame
+#   64 + 128 * i: metadata of slot i (generation, length, made_at, key)
+#   4096 + slot_size * i: frame in slot i
+
+MAGIC = b"calfb\x00\x00\x01"
+HEADER = struct.Struct("<8sQQ")
+SLOT_META = struct.Struct("<QQd64s")
+HEADER_SIZE = 4096
+N_SLOTS = 2
+
+def default_framebuffer_path() -> str:
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cal-render.fb")
+
+# each display gets its own file
+def display_framebuffer_path(path: str, display_name: str) -> str:
+    return path if display_name == "default" else f"{path}.{display_name}"
+
+@dataclass
+class Slot:
+    generation: int
+    length: int
+    made_at: float
+    key: str
+    offset: int # of the frame in the file
+
+class SharedFramebuffer:
+    # create wipes any existing frames if the slot size doesn't match. each process should open
+    # its own SharedFramebuffer, as locks belong to a process and are dropped when any of its
+    # file descriptors for the file is closed
+    def __init__(self, path: str, slot_size: Optional[int] = None, create: bool = False):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+
+        if create:
+            assert(slot_size is not None)
+            size = HEADER_SIZE + N_SLOTS * slot_size
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(self.fd, HEADER.size, 0)
+                if len(header) < HEADER.size or HEADER.unpack(header)[:2] != (MAGIC, slot_size):
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, HEADER.pack(MAGIC, slot_size, 0), 0)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+        magic, self.slot_size, _ = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a frame buffer")
+        self.mm = mmap.mmap(self.fd, HEADER_SIZE + N_SLOTS * self.slot_size)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def generation(self) -> int:
+        return HEADER.unpack_from(self.mm, 0)[2]
+
+    def _slot_offset(self, i: int) -> int:
+        return HEADER_SIZE + i * self.slot_size
+
+    def _slot(self, i: int) -> Slot:
+        generation, length, made_at, key = SLOT_META.unpack_from(self.mm, 64 + 128 * i)
+        return Slot(
+            generation=generation,
+            length=length,
+            made_at=made_at,
+            key=key.rstrip(b"\x00").decode(),
+            offset=self._slot_offset(i),
+        )
+
+    def _lock(self, i: int, op: int):
+        fcntl.lockf(self.fd, op, self.slot_size, self._slot_offset(i), os.SEEK_SET)
+
+    def publish(self, frame: bytes, key: str, made_at: float) -> int:
+        assert(len(frame) <= self.slot_size)
+        generation = self.generation() + 1
+        i = generation % N_SLOTS
+
+        # waits for anyone still reading this slot
+        self._lock(i, fcntl.LOCK_EX)
+        try:
+            SLOT_META.pack_into(self.mm, 64 + 128 * i, 0, 0, 0.0, b"") # invalid while writing
+            offset = self._slot_offset(i)
+            self.mm[offset:offset + len(frame)] = frame
+            SLOT_META.pack_into(self.mm, 64 + 128 * i, generation, len(frame), made_at, key.encode())
+        finally:
+            self._lock(i, fcntl.LOCK_UN)
+
+        HEADER.pack_into(self.mm, 0, MAGIC, self.slot_size, generation)
+        return generation
+
+    # holds the newest slot for as long as the context is open, None if nothing is published
+    @contextmanager
+    def read(self) -> Iterator[Optional[Slot]]:
+        i = self.generation() % N_SLOTS
+        self._lock(i, fcntl.LOCK_SH)
+        try:
+            slot = self._slot(i)
+            yield slot if slot.generation != 0 else None
+        finally:
+            self._lock(i, fcntl.LOCK_UN)
+
+    def latest(self) -> Optional[Slot]:
+        with self.read() as slot:
+            return slot
+
+    # same interface as serve.Prepared. returns the frame sent, None if nothing was sent. the
+    # newest frame is copied while its slot is held and the copy is sent. sending straight from the
+    # file would leave the kernel reading the slot after it's let go, while the renderer may be
+    # writing the next frame to it
+    def send_to(self, conn: socket.socket) -> Optional[bytes]:
+        frame = self.copy()
+        if frame is None:
+            print("nothing rendered yet")
+            return None
+        conn.sendall(frame)
+        return frame
+
+    def snapshot(self) -> Tuple[str, bytes]:
+        with self.read() as slot:
+            if slot is None:
+                raise ValueError("nothing rendered yet")
+            return slot.key, self.mm[slot.offset:slot.offset + slot.length]
+
+    def copy(self) -> Optional[bytes]:
+        with self.read() as slot:
+            if slot is None:
+                return None
+            return self.mm[slot.offset:slot.offset + slot.length]
+
+# runs a serve.Renderer in its own process, so slow renders and parsing don't hold up the server.
+# finished frames are published to a SharedFramebuffer for each display, the server sends them
+# from there. has the same interface as Renderer
+class RendererProcess:
+    def __init__(self, make_renderer: Callable[[], Any], path: str, displays: List[Any]):
+        self.displays = displays
+        self.fbs = {
+            d.name: SharedFramebuffer(display_framebuffer_path(path, d.name), slot_size=d.frame_size(), create=True)
+            for d in displays
+        }
+
+        ctx = multiprocessing.get_context("fork")
+        self.lock = threading.Lock() # metrics are requested from another thread
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_run_renderer, args=(make_renderer, path, child_conn), daemon=True)
+        self.process.start()
+
+    # what the renderer process replied. its exceptions are raised as RuntimeErrors
+    def _call(self, *msg: Any) -> Any:
+        with self.lock:
+            self.conn.send(msg)
+            ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(f"renderer process: {result}")
+        return result
+
+    # for messages the renderer process doesn't reply to
+    def _send(self, *msg: Any):
+        with self.lock:
+            self.conn.send(msg)
+
+    def record_wake(self, device: str, t: float) -> Optional[float]:
+        return self._call("record_wake", device, t)
+
+    # the newest frame published for the device's display, while the renderer makes sure it's fresh
+    # enough for the next wake. only waits for the renderer when nothing is published yet
+    def frame_for_wake(self, device: Optional[str] = None) -> SharedFramebuffer:
+        from display import display_for
+
+        fb = self.fbs[display_for(self.displays, device).name]
+        if fb.generation() == 0:
+            return self.fbs[self._call("frame_for_wake", device)]
+        self._send("prepare", device)
+        return fb
+
+    # the renderer process prepares frames by itself
+    def time_to_refresh(self) -> Optional[float]:
+        return None
+
+    def refresh(self):
+        self._call("refresh")
+
+    def stats(self) -> str:
+        return self._call("stats")
+
+    # fetching, parsing and rendering are measured in the renderer process
+    def metrics_snapshot(self) -> Any:
+        return self._call("metrics")
+
+def _run_renderer(make_renderer: Callable[[], Any], path: str, conn):
+    renderer = make_renderer()
+    fbs = {d.name: SharedFramebuffer(display_framebuffer_path(path, d.name)) for d in renderer.displays}
+    published: Dict[str, Any] = {}
+
+    def publish(prepared: Dict[str, Any]):
+        for name, p in prepared.items():
+            if p is not published.get(name):
+                generation = fbs[name].publish(p.rasterize(), p.key, p.made_at)
+                print(f"Published frame {p.key[:12]} for {name} as generation {generation}")
+                published[name] = p
+
+    while True:
+        try:
+            has_msg = conn.poll(renderer.time_to_refresh())
+        except EOFError:
+            return # server is gone
+
+        if not has_msg:
+            print(f"Preparing frame ahead of next wake")
+            try:
+                publish(renderer.refresh())
+            except Exception:
+                traceback.print_exc() # renderer backs off, the last frame is served meanwhile
+            renderer.timer.print_report()
+            continue
+
+        try:
+            cmd, *args = conn.recv()
+        except EOFError:
+            return
+
+        if cmd == "prepare": # nobody waits for these
+            try:
+                renderer.frame_for_wake(*args)
+                publish(renderer.prepared)
+            except Exception:
+                traceback.print_exc()
+            renderer.timer.print_report()
+            continue
+
+        try:
+            result = None
+            if cmd == "record_wake":
+                result = renderer.record_wake(*args)
+            elif cmd == "frame_for_wake":
+                result = renderer.frame_for_wake(*args).display.name
+                publish(renderer.prepared)
+                renderer.timer.print_report()
+            elif cmd == "refresh":
+                publish(renderer.refresh())
+                renderer.timer.print_report()
+            elif cmd == "stats":
+                result = renderer.stats()
+            elif cmd == "metrics":
+                from metrics import METRICS
+                result = METRICS.snapshot()
+        except Exception as e:
+            traceback.print_exc()
+            conn.send((False, repr(e)))
+        else:
+            conn.send((True, result))
+
+def test_shared_framebuffer():
+    import tempfile
+    import multiprocessing
+    import time
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "fb")
+        fb = SharedFramebuffer(path, slot_size=1000, create=True)
+        assert fb.latest() is None
+        a, b = socket.socketpair()
+        assert fb.send_to(a) is None
+
+        def receive(n: int) -> bytes:
+            received = bytearray()
+            while len(received) < n:
+                received.extend(b.recv(n - len(received)))
+            return bytes(received)
+
+        assert fb.publish(b"a" * 1000, "ka", 1.0) == 1
+        assert fb.publish(b"b" * 500, "kb", 2.0) == 2
+        slot = fb.latest()
+        assert slot is not None and (slot.generation, slot.length, slot.key) == (2, 500, "kb")
+        assert fb.copy() == b"b" * 500
+        # what was sent, even if something else is published right after
+        sent = fb.send_to(a)
+        fb.publish(b"c" * 500, "kc", 3.0)
+        assert sent == receive(500) == b"b" * 500
+
+        # reopening keeps frames around
+        assert SharedFramebuffer(path, slot_size=1000, create=True).copy() == b"c" * 500
+
+        # a writer in another process, every frame should be all the same byte, and what send_to
+        # returns should be exactly what went out
+        ctx = multiprocessing.get_context("fork")
+        stop = ctx.Event()
+        def write():
+            w = SharedFramebuffer(path)
+            n = 0
+            while not stop.is_set():
+                w.publish(bytes([n % 256]) * 1000, str(n), time.time())
+                n += 1
+
+        p = ctx.Process(target=write)
+        p.start()
+        try:
+            for _ in range(300):
+                frame = fb.copy()
+                assert frame is not None and len(set(frame)) == 1
+                sent = fb.send_to(a)
+                assert sent is not None and len(set(sent)) == 1 and receive(len(sent)) == sent
+        finally:
+            stop.set()
+            p.join()
+        a.close()
+        b.close()
+        last = fb.copy()
+        assert last is not None and len(last) == 1000 and len(set(last)) == 1
+        fb.close()
+
+def test_renderer_process():
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    from display import DEFAULT_DISPLAY
+    from timing import Timer
+
+    # renders take a while, each one a frame of the next byte
+    class SlowRenderer:
+        displays = [DEFAULT_DISPLAY]
+
+        def __init__(self):
+            self.n = 0
+            self.prepared: Dict[str, Any] = {}
+            self.timer = Timer()
+
+        def time_to_refresh(self) -> Optional[float]:
+            return None
+
+        def frame_for_wake(self, device: Optional[str] = None) -> Any:
+            time.sleep(0.5)
+            self.n += 1
+            frame = bytes([self.n]) * 10
+            p = SimpleNamespace(display=DEFAULT_DISPLAY, key=str(self.n), made_at=time.time(), rasterize=lambda: frame)
+            self.prepared = {DEFAULT_DISPLAY.name: p}
+            return p
+
+    with tempfile.TemporaryDirectory() as d:
+        r = RendererProcess(SlowRenderer, os.path.join(d, "fb"), [DEFAULT_DISPLAY])
+        # nothing published, so the first wake waits for a frame
+        assert r.frame_for_wake("10.0.0.1").copy() == b"\x01" * 10
+        # after that, wakes get the newest frame right away while the next one is rendered
+        t = time.time()
+        assert r.frame_for_wake("10.0.0.1").copy() == b"\x01" * 10
+        assert time.time() - t < 0.25
+        # calls with replies still get their own reply, after the render
+        assert r._call("frame_for_wake", "10.0.0.1") == DEFAULT_DISPLAY.name
+        assert r.fbs[DEFAULT_DISPLAY.name].copy() == b"\x03" * 10
+        r.process.kill()
+        r.process.join()
+
+if __name__ == "__main__":
+    test_shared_framebuffer()
+    test_renderer_process()
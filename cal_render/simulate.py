@@ -0,0 +1,226 @@
+from __future__ import annotations
+from typing import List, Optional
+from dataclasses import dataclass
+import argparse
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from display import Display, DEFAULT_DISPLAY
+from serve import TRANSACTION_SIZE
+
+# mirrors eink_bridge/main/eink_bridge.c
+RECONNECT_ATTEMPTS = 5
+RECONNECT_TIME_S = 3
+
+@dataclass
+class Visit:
+    device: int
+    connect_attempts: int
+    handshake_s: float # handshake sent -> reply received
+    first_byte_s: float # reply received -> first byte of the frame
+    transfer_s: float # reply received -> whole frame received
+    frame: bytes
+
+    def throughput(self) -> float:
+        return len(self.frame) / self.transfer_s
+
+def recv_exact(s: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        got = s.recv(n - len(buf))
+        if len(got) == 0:
+            raise ConnectionError(f"connection closed after {len(buf)} of {n} bytes")
+        buf.extend(got)
+    return bytes(buf)
+
+# one wake of a device with the display, the way the firmware does it. source is the address to
+# connect from, the server picks the display by it
+def visit(host: str, port: int, device: int = 0, display: Display = DEFAULT_DISPLAY, source: Optional[str] = None) -> Visit:
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        try:
+            s = socket.create_connection((host, port), source_address=None if source is None else (source, 0))
+            break
+        except OSError:
+            if attempt == RECONNECT_ATTEMPTS:
+                raise
+            time.sleep(RECONNECT_TIME_S)
+
+    with s:
+        t0 = time.perf_counter()
+        s.sendall(b"hii^_^")
+        reply = recv_exact(s, 5)
+        if reply != b"hewwo":
+            raise ConnectionError(f"incorrect handshake: {reply!r}")
+        t1 = time.perf_counter()
+
+        size = display.frame_size()
+        chunks = [recv_exact(s, min(TRANSACTION_SIZE, size))]
+        t2 = time.perf_counter()
+        received = len(chunks[0])
+        while received < size:
+            chunks.append(recv_exact(s, min(TRANSACTION_SIZE, size - received)))
+            received += len(chunks[-1])
+        t3 = time.perf_counter()
+
+    return Visit(
+        device=device,
+        connect_attempts=attempt,
+        handshake_s=t1 - t0,
+        first_byte_s=t2 - t1,
+        transfer_s=t3 - t1,
+        frame=b"".join(chunks),
+    )
+
+# one wake using resumable transfers, reconnecting until the whole frame has arrived
+def visit_resumable(host: str, port: int, device: int = 0, drop_rate: float = 0, source: Optional[str] = None) -> Visit:
+    from resumable import ResumableClient
+
+    client = ResumableClient(host, port, source=source)
+    t0 = time.perf_counter()
+    frame = client.fetch(drop_rate=drop_rate)
+    t1 = time.perf_counter()
+    if client.connections > 1:
+        print(f"device {device}: {client.connections} connections, {client.chunks_received} chunks for {client.n_chunks}")
+
+    return Visit(
+        device=device,
+        connect_attempts=client.connections,
+        handshake_s=0,
+        first_byte_s=0,
+        transfer_s=t1 - t0,
+        frame=frame,
+    )
+
+# pixels with values that aren't in the display's palette
+def invalid_pixels(frame: bytes, display: Display = DEFAULT_DISPLAY) -> int:
+    import numpy as np
+
+    wire = np.frombuffer(frame, dtype=np.uint8)
+    if display.encoding == "p4":
+        wire = np.concatenate([wire >> 4, wire & 0xf])
+    return int((~np.isin(wire, display.palette)).sum())
+
+def summarize(name: str, values: List[float], unit: str, scale: float = 1) -> str:
+    values = [v * scale for v in values]
+    return f"{name:<14} min {min(values):9.1f} {unit}  median {statistics.median(values):9.1f} {unit}  max {max(values):9.1f} {unit}"
+
+def main():
+    parser = argparse.ArgumentParser("cal-render-simulate", description="Pretends to be one or more displays connecting to cal-render serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", default=2137, type=int)
+    parser.add_argument("-n", "--devices", default=1, type=int, help="Number of devices connecting at the same time")
+    parser.add_argument("-r", "--rounds", default=1, type=int, help="Number of times each device connects")
+    parser.add_argument("--png", help="Save the last received frame as a PNG here")
+    parser.add_argument("--resumable", action="store_true", help="Use resumable transfers instead of the firmware's protocol")
+    parser.add_argument("--drop-rate", default=0, type=float, help="With --resumable, chance of dropping each connection part way")
+    parser.add_argument("--secrets", default=os.path.join(os.path.dirname(__file__), "secrets.toml"), help="Secrets TOML file the server uses, for --display")
+    parser.add_argument("--display", help="Name of the [[display]] in --secrets to be, the default 480x800 p8 display if not given")
+    parser.add_argument("--source", help="Address to connect from, the server picks the display by it. the display's first device by default")
+    env = parser.parse_args()
+
+    display = DEFAULT_DISPLAY
+    if env.display is not None:
+        from display import load_displays
+        displays = load_displays(env.secrets)
+        matching = [d for d in displays if d.name == env.display]
+        if len(matching) == 0:
+            sys.exit(f"no display named {env.display!r}, there's {', '.join(d.name for d in displays)}")
+        display = matching[0]
+    source = env.source
+    if source is None and len(display.devices) > 0:
+        source = display.devices[0]
+
+    visits: List[Visit] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def device(i: int):
+        for _ in range(env.rounds):
+            try:
+                if env.resumable:
+                    v = visit_resumable(env.host, env.port, device=i, drop_rate=env.drop_rate, source=source)
+                else:
+                    v = visit(env.host, env.port, device=i, display=display, source=source)
+            except (OSError, ConnectionError) as e:
+                with lock:
+                    errors.append(f"device {i}: {e}")
+                continue
+            with lock:
+                visits.append(v)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=device, args=(i,)) for i in range(env.devices)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    for e in errors:
+        print("error:", e)
+    if len(visits) == 0:
+        print("no successful visits")
+        return
+
+    print(f"{len(visits)} visits, {len(errors)} failed, in {wall:.2f}s")
+    print(summarize("handshake", [v.handshake_s for v in visits], "ms", 1000))
+    print(summarize("first byte", [v.first_byte_s for v in visits], "ms", 1000))
+    print(summarize("transfer", [v.transfer_s for v in visits], "ms", 1000))
+    print(summarize("throughput", [v.throughput() for v in visits], "kB/s", 1 / 1000))
+    print(f"total throughput {sum(len(v.frame) for v in visits) / wall / 1000:.1f} kB/s")
+
+    last = visits[-1]
+    if len(last.frame) != display.frame_size():
+        print(f"warning: last frame is {len(last.frame)} bytes, {display.name} takes {display.frame_size()}")
+    n_invalid = invalid_pixels(last.frame, display)
+    if n_invalid != 0:
+        print(f"warning: last frame has {n_invalid} pixels with invalid colors")
+    if env.png is not None:
+        from serve import decode
+        decode(last.frame, display).save(env.png)
+        print(f"saved last frame to {env.png}")
+
+def test_visit():
+    from serve import send, encode, decode
+    from canvas import Canvas
+    from data import Color
+
+    class Corner(Canvas):
+        def __call__(self, x: int, y: int) -> Color:
+            return Color.RED if x < 10 and y < 20 else Color.BLUE
+
+    small = Display(name="small", width=120, height=160, encoding="p4", devices=("127.0.0.1",))
+    for display in (DEFAULT_DISPLAY, small):
+        frame = encode(Corner(), display)
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        peers = []
+
+        def serve_one():
+            conn, addr = server.accept()
+            peers.append(addr[0])
+            with conn:
+                send(conn, frame)
+
+        t = threading.Thread(target=serve_one)
+        t.start()
+        v = visit("127.0.0.1", server.getsockname()[1], display=display, source=display.devices[0] if display.devices else None)
+        t.join()
+        server.close()
+
+        assert v.frame == frame and len(v.frame) == display.frame_size()
+        assert peers == ["127.0.0.1"]
+        assert invalid_pixels(v.frame, display) == 0
+        img = decode(v.frame, display).convert("RGB")
+        assert img.size == (display.width, display.height)
+        for xy in [(0, 0), (9, 19), (10, 0), (0, 20), (display.width - 1, display.height - 1)]:
+            assert img.getpixel(xy) == Corner()(*xy).rgb()
+    assert invalid_pixels(b"\x08" * 10) == 10 and invalid_pixels(b"\x18" * 10, small) == 10
+
+if __name__ == "__main__":
+    main()
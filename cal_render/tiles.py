@@ -0,0 +1,143 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from canvas import Canvas, Background, CalendarEvent
+from data import Rectangle, Color, SCREEN_COLORS
+
+TRANSPARENT = Color.INVALID.to_screen_color_idx()
+
+# everything that decides what an event tile looks like. the dither patterns depend on (x + y) % 4,
+# so tiles can only be reused at positions with the same phase
+TileKey = Tuple[str, int, int, Color, Color, Optional[str], Optional[str], bool, bool, int]
+
+# a rasterized tile, drawn on top of inner at rect
+class CachedTile(Canvas):
+    def __init__(self, inner: Canvas, rect: Rectangle, pixels: bytes):
+        assert(len(pixels) == rect.width * rect.height)
+        self.inner = inner
+        self.rect = rect
+        self.pixels = pixels
+
+    def __call__(self, x: int, y: int) -> Color:
+        if (x, y) not in self.rect:
+            return self.inner(x, y)
+        idx = self.pixels[(y - self.rect.y0) * self.rect.width + (x - self.rect.x0)]
+        if idx == TRANSPARENT:
+            return self.inner(x, y)
+        return SCREEN_COLORS[idx]
+
+# LRU cache of rendered CalendarEvents, kept between renders
+class TileCache:
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.tiles: OrderedDict[TileKey, bytes] = OrderedDict()
+        self.n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {len(self)} tiles ({self.n_bytes} bytes)"
+
+    def clear(self):
+        self.tiles.clear()
+        self.n_bytes = 0
+
+    # drop-in replacement for CalendarEvent(...)
+    def event(
+        self,
+        inner: Canvas,
+        rect: Rectangle,
+        *,
+        title: str,
+        color1: Color,
+        color2: Color,
+        time_start: Optional[str],
+        time_end: Optional[str],
+    ) -> CachedTile:
+        key: TileKey = (
+            title,
+            rect.width, rect.height,
+            color1, color2,
+            time_start, time_end,
+            time_start is None, time_end is None, # skip_top, skip_bottom
+            (rect.x0 + rect.y0) % 4,
+        )
+
+        pixels = self.tiles.get(key)
+        if pixels is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return CachedTile(inner, rect, pixels)
+
+        self.misses += 1
+        # render on top of a transparent background so the tile is independent of what's below
+        event = CalendarEvent(
+            Background(Color.INVALID),
+            rect,
+            title=title,
+            color1=color1,
+            color2=color2,
+            time_start=time_start,
+            time_end=time_end,
+        )
+        pixels = event.rasterize(rect)
+        self.insert(key, pixels)
+        return CachedTile(inner, rect, pixels)
+
+    def insert(self, key: TileKey, pixels: bytes):
+        if len(pixels) > self.max_bytes:
+            return
+
+        old = self.tiles.pop(key, None)
+        if old is not None:
+            self.n_bytes -= len(old)
+
+        self.tiles[key] = pixels
+        self.n_bytes += len(pixels)
+
+        while self.n_bytes > self.max_bytes:
+            _, evicted = self.tiles.popitem(last=False)
+            self.n_bytes -= len(evicted)
+
+# shared between all renders in this process
+TILE_CACHE = TileCache()
+
+def test_tile_cache():
+    cache = TileCache(max_bytes=3 * 100 * 40)
+    kw = dict(title="Vattna lila blomma och murgröna", color1=Color.BLUE, color2=Color.RED, time_start="10:00", time_end=None)
+
+    bg = Background(Color.WHITE)
+    rect = Rectangle(x0=10, y0=20, width=100, height=40)
+    tile = cache.event(bg, rect, **kw)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # same phase, different position, should hit and look the same
+    moved = Rectangle(x0=13, y0=21, width=100, height=40)
+    moved_tile = cache.event(bg, moved, **kw)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    direct = CalendarEvent(bg, moved, **kw)
+    for y in range(moved.y0 - 2, moved.y1 + 2):
+        for x in range(moved.x0 - 2, moved.x1 + 2):
+            assert moved_tile(x, y) == direct(x, y)
+
+    # different phase should miss
+    cache.event(bg, Rectangle(x0=11, y0=20, width=100, height=40), **kw)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # evicts least recently used
+    cache.event(bg, rect, **kw)
+    cache.event(bg, rect, **{**kw, "title": "a"})
+    cache.event(bg, rect, **{**kw, "title": "b"})
+    assert len(cache) == 3
+    assert cache.n_bytes <= cache.max_bytes
+    cache.event(bg, Rectangle(x0=11, y0=20, width=100, height=40), **kw)
+    assert (cache.hits, cache.misses) == (2, 5)
+
+if __name__ == "__main__":
+    test_tile_cache()
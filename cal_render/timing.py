@@ -0,0 +1,38 @@
+from __future__ import annotations
+from typing import Callable, List, Tuple
+from contextlib import contextmanager
+import time
+
+from memory import MEMORY
+
+# measures how long each stage of a run takes. stages can be nested and repeated. with
+# memory.MEMORY started, their memory use is measured too
+class Timer:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.observers: List[Callable[[str, float], None]] = [] # called with each finished stage, even when disabled
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            with MEMORY.stage(name):
+                yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.stages.append((name, dt))
+            for observe in self.observers:
+                observe(name, dt)
+
+    def report(self) -> str:
+        lines = [f"{name:<24} {dt * 1000:9.1f} ms" for name, dt in self.stages]
+        lines.append(f"{'total':<24} {(time.perf_counter() - self.started) * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+    def print_report(self):
+        if self.enabled:
+            print(self.report())
+        self.stages.clear()
+        MEMORY.print_report()
@@ -0,0 +1,193 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+import json
+import re
+import time
+
+# rewrites event titles, configured per calendar in secrets.toml:
+#
+# [[calendar]]
+# titles = [
+#     { timeedit = true },
+#     { regex = "^Möte: (.*)$", replace = "\\1" },
+#     { strip_prefix = "[Jobb] " },
+# ]
+#
+# rules are applied in order. titles are memoized by the raw summary, so each distinct summary is
+# only processed once
+
+# prints summaries TimeEdit parsing didn't understand, at most max_reports per interval
+class OddballLog:
+    def __init__(
+        self,
+        interval: float = 3600,
+        max_reports: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+        out: Callable[[str], None] = print,
+    ):
+        self.interval = interval
+        self.max_reports = max_reports
+        self.clock = clock
+        self.out = out
+
+        self.window_start: Optional[float] = None
+        self.n_reported = 0
+        self.n_suppressed = 0
+
+    def report(self, summary: str):
+        now = self.clock()
+        if self.window_start is None or now - self.window_start >= self.interval:
+            if self.n_suppressed > 0:
+                self.out(f"... and {self.n_suppressed} more oddballs")
+            self.window_start = now
+            self.n_reported = 0
+            self.n_suppressed = 0
+
+        if self.n_reported < self.max_reports:
+            self.out(f"oddball: {summary!r}")
+            self.n_reported += 1
+        else:
+            self.n_suppressed += 1
+
+ODDBALLS = OddballLog()
+
+class TitleRule(ABC):
+    @abstractmethod
+    def apply(self, title: str) -> str:
+        pass
+
+TE_COURSE = re.compile(r"^(?:Kurskod: (?P<kurskod>[^.]+)\. Kursnamn: (?P<kursnamn>[^,]+)(, )?)+(?P<sak>.*)$")
+TE_RUBRIK = re.compile(r"^(?:Rubrik: )(?P<rubrik>.+)$")
+
+@dataclass
+class TimeEdit(TitleRule):
+    oddballs: OddballLog = ODDBALLS
+
+    def apply(self, title: str) -> str:
+        m = TE_COURSE.match(title)
+        if m:
+            kod = m.group("kurskod")
+            namn = m.group("kursnamn")
+            sak = m.group("sak")
+            return f"{kod} — {sak} ({namn})"
+
+        m = TE_RUBRIK.match(title)
+        if m:
+            return m.group("rubrik")
+
+        self.oddballs.report(title)
+        return title
+
+@dataclass
+class Regex(TitleRule):
+    pattern: re.Pattern
+    replace: str
+
+    def apply(self, title: str) -> str:
+        return self.pattern.sub(self.replace, title)
+
+@dataclass
+class StripPrefix(TitleRule):
+    prefix: str
+
+    def apply(self, title: str) -> str:
+        return title[len(self.prefix):] if title.startswith(self.prefix) else title
+
+def rule_from_obj(data: Any) -> TitleRule:
+    if data.get("timeedit", False):
+        return TimeEdit()
+    if "regex" in data:
+        return Regex(pattern=re.compile(data["regex"]), replace=data.get("replace", ""))
+    if "strip_prefix" in data:
+        return StripPrefix(prefix=data["strip_prefix"])
+    raise ValueError(f"unknown title rule {data!r}")
+
+class TitlePipeline:
+    def __init__(self, rules: List[TitleRule], memo_size: int = 4096):
+        self.rules = rules
+        self.memo_size = memo_size
+        self.memo: OrderedDict[str, str] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_obj(data: List[Any], memo_size: int = 4096) -> TitlePipeline:
+        return TitlePipeline([rule_from_obj(x) for x in data], memo_size=memo_size)
+
+    def __call__(self, title: str) -> str:
+        if title in self.memo:
+            self.hits += 1
+            self.memo.move_to_end(title)
+            return self.memo[title]
+        self.misses += 1
+
+        result = title
+        for rule in self.rules:
+            result = rule.apply(result)
+
+        self.memo[title] = result
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return result
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total > 0 else 0
+        return f"{len(self.memo)} titles, {self.hits}/{total} hits ({ratio:.0%})"
+
+# secrets.toml is reloaded for every render. pipelines are kept between reloads so their memos are too
+PIPELINES: Dict[str, TitlePipeline] = {}
+
+def pipeline_for(data: List[Any]) -> TitlePipeline:
+    key = json.dumps(data, sort_keys=True)
+    if key not in PIPELINES:
+        PIPELINES[key] = TitlePipeline.from_obj(data)
+    return PIPELINES[key]
+
+def test_titles():
+    pipeline = TitlePipeline.from_obj([
+        {"timeedit": True},
+        {"regex": r"^Möte: (.*)$", "replace": r"\1"},
+        {"strip_prefix": "[Jobb] "},
+    ])
+    assert pipeline("Kurskod: TATA24. Kursnamn: Linjär algebra, Föreläsning") == "TATA24 — Föreläsning (Linjär algebra)"
+    assert pipeline("Rubrik: Tenta") == "Tenta"
+    assert pipeline("Möte: planering") == "planering"
+    assert pipeline("[Jobb] Lunch") == "Lunch"
+    assert pipeline("[Jobb] Lunch") == "Lunch"
+    assert (pipeline.hits, pipeline.misses) == (1, 4)
+
+    small = TitlePipeline([StripPrefix("x")], memo_size=2)
+    for t in ["xa", "xb", "xc", "xa"]:
+        small(t)
+    assert list(small.memo) == ["xc", "xa"]
+
+    assert pipeline_for([{"strip_prefix": "a"}]) is pipeline_for([{"strip_prefix": "a"}])
+
+    try:
+        rule_from_obj({"uppercase": True})
+        assert False
+    except ValueError:
+        pass
+
+def test_oddball_log():
+    now = 0.0
+    lines: List[str] = []
+    log = OddballLog(interval=60, max_reports=2, clock=lambda: now, out=lines.append)
+    rule = TimeEdit(oddballs=log)
+
+    for i in range(5):
+        assert rule.apply(f"odd {i}") == f"odd {i}"
+    assert lines == ["oddball: 'odd 0'", "oddball: 'odd 1'"]
+
+    now = 61
+    rule.apply("odd 5")
+    assert lines[2:] == ["... and 3 more oddballs", "oddball: 'odd 5'"]
+
+if __name__ == "__main__":
+    test_titles()
+    test_oddball_log()
@@ -1,20 +1,26 @@
 from __future__ import annotations
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple
+from functools import lru_cache
 import json
 import os
 
 basepath = os.path.dirname(__file__)
 
-baselines = json.load(open(os.path.join(basepath, "ultlf/trimmed_baselines.json")))
-codepoints = json.load(open(os.path.join(basepath, "ultlf/codepoints.json")))
-data = json.load(open(os.path.join(basepath, "ultlf/data.json")))
+# the font is loaded the first time a glyph is needed, not on import
+@lru_cache(maxsize=None)
+def font() -> Tuple[List[int], List[List[str]], Dict[int, int]]:
+    baselines = json.load(open(os.path.join(basepath, "ultlf/trimmed_baselines.json")))
+    codepoints = json.load(open(os.path.join(basepath, "ultlf/codepoints.json")))
+    data = json.load(open(os.path.join(basepath, "ultlf/data.json")))
 
-codepoint2idx = {}
-for i, p in enumerate(codepoints):
-    if "X" in data[i][0]:
-        # invalid char
-        continue
-    codepoint2idx[p] = i
+    codepoint2idx = {}
+    for i, p in enumerate(codepoints):
+        if "X" in data[i][0]:
+            # invalid char
+            continue
+        codepoint2idx[p] = i
+
+    return baselines, data, codepoint2idx
 
 class UltlfCP:
     def __init__(
@@ -40,6 +46,7 @@ class UltlfCP:
 
     @staticmethod
     def from_ch(ch: str) -> UltlfCP:
+        baselines, data, codepoint2idx = font()
         if ord(ch) not in codepoint2idx:
             baseline = 7
             bitmap_ch = [
@@ -53,6 +60,7 @@ class UltlfCP:
             ]
         else:
             i = codepoint2idx[ord(ch)]
+            baseline = baselines[i]
             bitmap_ch = data[i]
-            bitmap = [[ch == "#" for ch in line] for line in bitmap_ch]
-        return UltlfCP(baselines[i], bitmap)
+        bitmap = [[ch == "#" for ch in line] for line in bitmap_ch]
+        return UltlfCP(baseline, bitmap)
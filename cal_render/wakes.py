@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import Dict, List, Optional
+import json
+import os
+import statistics
+
+def default_history_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cal-render", "wakes.json")
+
+# when each device has connected, to guess when it'll connect next
+class WakeHistory:
+    def __init__(
+        self,
+        path: Optional[str] = None, # None = don't persist
+        max_wakes: int = 16, # per device
+        min_interval: float = 60, # connections closer than this are retries, not wakes
+    ):
+        self.path = path
+        self.max_wakes = max_wakes
+        self.min_interval = min_interval
+        self.wakes: Dict[str, List[float]] = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                self.wakes = json.load(f)
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.wakes, f)
+        os.replace(tmp, self.path)
+
+    def record(self, device: str, t: float):
+        wakes = self.wakes.setdefault(device, [])
+        if len(wakes) > 0 and t - wakes[-1] < self.min_interval:
+            wakes[-1] = t
+        else:
+            wakes.append(t)
+        del wakes[:-self.max_wakes]
+        self.save()
+
+    # typical time between wakes. the median, so one missed wake doesn't throw it off
+    def interval(self, device: str) -> Optional[float]:
+        wakes = self.wakes.get(device, [])
+        if len(wakes) < 2:
+            return None
+        return statistics.median(b - a for a, b in zip(wakes, wakes[1:]))
+
+    # first expected wake after now. if the device missed a wake, assumes it keeps its rhythm
+    def next_wake(self, device: str, now: float) -> Optional[float]:
+        interval = self.interval(device)
+        if interval is None:
+            return None
+        t = self.wakes[device][-1] + interval
+        if t <= now:
+            t += interval * (((now - t) // interval) + 1)
+        return t
+
+    def next_wake_any(self, now: float) -> Optional[float]:
+        times = [self.next_wake(device, now) for device in self.wakes]
+        return min((t for t in times if t is not None), default=None)
+
+# how old a prepared frame may be when a device wakes up. grows while the rendered content stays
+# the same, so quiet calendars aren't fetched on every wake
+class RefreshPolicy:
+    def __init__(
+        self,
+        lead: float = 120, # prepare this long before an expected wake
+        min_max_age: float = 15 * 60,
+        max_max_age: float = 2 * 60 * 60,
+    ):
+        self.lead = lead
+        self.min_max_age = min_max_age
+        self.max_max_age = max_max_age
+        self.unchanged = 0 # refreshes in a row that rendered the same frame
+
+    def observe(self, changed: bool):
+        if changed:
+            self.unchanged = 0
+        else:
+            self.unchanged += 1
+
+    def max_age(self) -> float:
+        return min(self.max_max_age, self.min_max_age * 2 ** self.unchanged)
+
+    # when to refresh a frame made at made_at so it's fresh for a wake at wake
+    # None if it'll still be fresh enough
+    def refresh_at(self, wake: float, made_at: Optional[float]) -> Optional[float]:
+        if made_at is not None and wake - made_at <= self.max_age():
+            return None
+        return wake - self.lead
+
+def test_wake_history():
+    h = WakeHistory()
+    assert h.next_wake("a", 0) is None
+    for t in [1000, 2000, 2010, 3000, 4500, 5000]:
+        h.record("a", t)
+    # 2000 was retried at 2010, 4500 was off schedule
+    assert h.wakes["a"] == [1000, 2010, 3000, 4500, 5000]
+    assert h.interval("a") == 1000
+    assert h.next_wake("a", 5000) == 6000
+    assert h.next_wake("a", 7000) == 8000 # missed one
+
+    h.record("b", 100)
+    h.record("b", 5100)
+    assert h.next_wake_any(5000) == 6000
+    assert h.next_wake_any(6000) == 7000
+
+def test_refresh_policy():
+    p = RefreshPolicy(lead=100, min_max_age=1000, max_max_age=5000)
+    assert p.refresh_at(10000, None) == 9900
+    assert p.refresh_at(10000, 9500) is None
+    assert p.refresh_at(10000, 8000) == 9900
+
+    p.observe(changed=False)
+    p.observe(changed=False)
+    assert p.max_age() == 4000
+    assert p.refresh_at(10000, 8000) is None
+    p.observe(changed=False)
+    assert p.max_age() == 5000
+    p.observe(changed=True)
+    assert p.max_age() == 1000
+
+if __name__ == "__main__":
+    test_wake_history()
+    test_refresh_policy()